@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""\
+Time the hot paths of the rdt tools against synthetic rosetta checkouts.
+
+A fake rosetta checkout is generated for each scale.  It has a deep namespace 
+tree under 'source/src', settings files with the given number of entries, and 
+'init.MoverCreators.ihh' and 'init.MoverRegistrators.ihh' files with the given 
+number of lines.  The functions that scan and edit those files are then timed 
+against it.  No real rosetta checkout (or compiler) is needed.
+
+Usage:
+    internals.py [<benchmark>...] [options]
+
+Arguments:
+    <benchmark>
+        The names of the benchmarks to run.  By default, all of them are run.  
+        Use --list to see which benchmarks there are.
+
+Options:
+    -s, --scales LIST           [default: 100,1000,10000]
+        A comma-separated list of how many entries to put in the settings and 
+        init files of each synthetic checkout.
+
+    -n, --repeat NUM            [default: 10]
+        How many times to time each benchmark at each scale.
+
+    -o, --output PATH
+        Save the results to the given file, as JSON.
+
+    -c, --compare-to PATH
+        Compare the results to ones previously saved with --output, and exit 
+        with a non-zero status if any benchmark got slower.
+
+    -t, --threshold PERCENT     [default: 20]
+        How much slower (in percent) a benchmark has to get before --compare-to 
+        counts it as a regression.
+
+    -j, --json
+        Print the results as JSON rather than as a table.
+
+    -l, --list
+        List the benchmarks and exit.
+"""
+
+import os, sys, time, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCHMARKS = {}
+NAMES_PER_NAMESPACE = 10
+NAMESPACE_DEPTH = 6
+SETTINGS_FILES = 7
+
+def main():
+    import docopt, json
+    args = docopt.docopt(__doc__)
+
+    if args['--list']:
+        for name, function in BENCHMARKS.items():
+            print('{:<28} {}'.format(name, function.__doc__.strip()))
+        return
+
+    names = args['<benchmark>'] or list(BENCHMARKS)
+    scales = [int(x) for x in args['--scales'].split(',')]
+    num_runs = int(args['--repeat'])
+    results = run_benchmarks(names, scales, num_runs)
+
+    if args['--output']:
+        with open(args['--output'], 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args['--json']:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(results)
+
+    if args['--compare-to']:
+        with open(args['--compare-to']) as file:
+            baseline = json.load(file)
+        regressions = compare_results(
+                results, baseline, float(args['--threshold']))
+        sys.exit(bool(regressions))
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+def run_benchmarks(names, scales, num_runs):
+    import platform, tempfile
+    from statistics import median
+
+    results = dict(
+            python=platform.python_version(),
+            timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            results=[],
+    )
+    original_dir = os.getcwd()
+
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix='rdt_bench_') as root:
+            tree = SyntheticRosetta(root, scale)
+
+            # Most of the functions being timed look for rosetta relative to 
+            # the current working directory, like they would when run by a 
+            # developer, so run them from deep inside the checkout.
+
+            os.chdir(tree.deepest_dir)
+            try:
+                for name in names:
+                    function = BENCHMARKS[name](tree)
+                    samples = time_function(function, num_runs)
+                    results['results'].append(dict(
+                            benchmark=name,
+                            scale=scale,
+                            runs=num_runs,
+                            min_ms=min(samples),
+                            median_ms=median(samples),
+                    ))
+            finally:
+                os.chdir(original_dir)
+
+    return results
+
+def time_function(function, num_runs):
+    """
+    Call the given function the given number of times, with its output 
+    discarded, and return how many milliseconds each call took.
+    """
+    import contextlib
+
+    samples = []
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for i in range(num_runs):
+                start = time.perf_counter()
+                function()
+                samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+def compare_results(results, baseline, threshold):
+    """
+    Print and return the benchmarks that got more than <threshold> percent 
+    slower than they were in the baseline.  Medians are compared, since the 
+    minimum of a few runs is too easily thrown off by one lucky run.
+    """
+    previous = {
+            (x['benchmark'], x['scale']): x
+            for x in baseline['results']
+    }
+    regressions = []
+
+    for result in results['results']:
+        key = result['benchmark'], result['scale']
+        if key not in previous or previous[key]['median_ms'] == 0:
+            continue
+
+        change = 100 * (result['median_ms'] / previous[key]['median_ms'] - 1)
+        if change > threshold:
+            regressions.append((result, change))
+            print("Regression: {} at scale {} is {:.1f}% slower ({:.2f} ms -> {:.2f} ms)".format(
+                result['benchmark'], result['scale'], change,
+                previous[key]['median_ms'], result['median_ms']))
+
+    return regressions
+
+def print_results(results):
+    print("{:<28} {:>8} {:>12} {:>12}".format(
+        'benchmark', 'scale', 'min', 'median'))
+
+    for result in results['results']:
+        print("{:<28} {:>8} {:>9.3f} ms {:>9.3f} ms".format(
+            result['benchmark'], result['scale'],
+            result['min_ms'], result['median_ms']))
+
+
+class SyntheticRosetta:
+    """
+    A fake rosetta checkout, with just enough structure for the rdt tools to 
+    work in it.  <scale> is the number of names in the settings files and the 
+    number of lines in each of the mover init files.
+    """
+
+    def __init__(self, root, scale):
+        self.root = root
+        self.scale = scale
+        self.source_dir = os.path.join(root, 'source')
+        self.src_dir = os.path.join(self.source_dir, 'src')
+        self.test_dir = os.path.join(self.source_dir, 'test')
+        self.init_dir = os.path.join(self.src_dir, 'protocols', 'init')
+        self.build_dir = os.path.join(self.source_dir, 'cmake', 'build_debug')
+        self.cmake_output = os.path.join(self.build_dir, 'build.ninja')
+
+        # Spread the names over namespaces that are several levels deep, with 
+        # about ten names in each namespace.
+
+        self.namespaces = [
+                ['protocols'] + ['ns{}'.format((i // 10**j) % 10)
+                    for j in range(NAMESPACE_DEPTH - 1)] + ['leaf{}'.format(i)]
+                for i in range(max(1, scale // NAMES_PER_NAMESPACE))
+        ]
+        self.names = {
+                '/'.join(x): ['Mover{}'.format(i)
+                    for i in range(NAMES_PER_NAMESPACE)]
+                for x in self.namespaces
+        }
+        self.deepest_dir = os.path.join(self.src_dir, *self.namespaces[-1])
+
+        subprocess.check_call(('git', 'init', '--quiet', root))
+        for namespace in self.namespaces:
+            os.makedirs(os.path.join(self.src_dir, *namespace), exist_ok=True)
+        os.makedirs(self.init_dir, exist_ok=True)
+        os.makedirs(self.test_dir, exist_ok=True)
+        os.makedirs(self.build_dir, exist_ok=True)
+
+        self.write_settings_files()
+        self.write_init_files()
+
+        # Write the cmake output last, so that it's up to date.
+
+        with open(self.cmake_output, 'w') as file:
+            file.write('# ninja\n')
+
+    def write_settings_files(self):
+        namespaces = sorted(self.names)
+        chunk_size = -(-len(namespaces) // SETTINGS_FILES)
+
+        for i in range(SETTINGS_FILES):
+            path = os.path.join(
+                    self.src_dir, 'protocols.{}.src.settings'.format(i + 1))
+            write_settings_file(
+                    path, namespaces[i * chunk_size:(i + 1) * chunk_size],
+                    self.names)
+
+        test_names = {
+                x.split('/', 1)[1]: [y + 'Test' for y in self.names[x]]
+                for x in namespaces
+        }
+        write_settings_file(
+                os.path.join(self.test_dir, 'protocols.test.settings'),
+                sorted(test_names), test_names)
+
+    def write_init_files(self):
+        creators = []
+        registrators = []
+
+        for namespace in sorted(self.names):
+            for name in self.names[namespace]:
+                creators.append('#include <{}/{}Creator.hh>\n'.format(
+                    namespace, name))
+                registrators.append(
+                        'static MoverRegistrator< {0}::{1}Creator > reg_{1}Creator;\n'.format(
+                            namespace.replace('/', '::').split('::', 1)[1], name))
+
+        self.creators_ihh = os.path.join(self.init_dir, 'init.MoverCreators.ihh')
+        self.registrators_ihh = os.path.join(self.init_dir, 'init.MoverRegistrators.ihh')
+
+        with open(self.creators_ihh, 'w') as file:
+            file.writelines(sorted(creators))
+        with open(self.registrators_ihh, 'w') as file:
+            file.writelines(sorted(registrators))
+
+    def get_settings_path(self, namespace):
+        for name in sorted(os.listdir(self.src_dir)):
+            path = os.path.join(self.src_dir, name)
+            if name.endswith('.src.settings'):
+                with open(path) as file:
+                    if '"{}"'.format(namespace) in file.read():
+                        return path
+
+def write_settings_file(path, namespaces, names):
+    with open(path, 'w') as file:
+        file.write('sources = {\n')
+        for namespace in namespaces:
+            file.write('\t"{}": [\n'.format(namespace))
+            for name in names[namespace]:
+                file.write('\t\t"{}",\n'.format(name))
+            file.write('\t],\n')
+        file.write('}\ninclude_path = [\n]\nlibrary_path = [\n]\nlibraries = [\n]\nsubprojects = [\n]\n')
+
+
+@benchmark
+def insert_alphabetically(tree):
+    """Insert a line into the middle of init.MoverRegistrators.ihh (in memory)."""
+    from rosetta_dev_tools.boilerplate import insert_alphabetically
+
+    with open(tree.registrators_ihh) as file:
+        lines = file.readlines()
+
+    line = lines[len(lines) // 2].replace('Creator', 'NewCreator')
+    return lambda: insert_alphabetically(line, list(lines))
+
+@benchmark
+def insert_name_into_settings(tree):
+    """Add a name to an existing namespace in a settings file (dry run)."""
+    from rosetta_dev_tools.boilerplate import insert_name_into_settings, DRY_RUN
+
+    namespace = tree.namespaces[len(tree.namespaces) // 2]
+    path = tree.get_settings_path('/'.join(namespace))
+    return lambda: insert_name_into_settings(path, 'NewMover', namespace, DRY_RUN)
+
+@benchmark
+def is_cmake_output_stale(tree):
+    """Check whether cmake needs to be rerun."""
+    from rosetta_dev_tools.build import is_cmake_output_stale
+    return lambda: is_cmake_output_stale(tree.cmake_output)
+
+@benchmark
+def write_src_settings_line(tree):
+    """Find the right settings file for a name and add it (dry run)."""
+    from rosetta_dev_tools.boilerplate import write_src_settings_line, DRY_RUN
+
+    namespace = tree.namespaces[len(tree.namespaces) // 2]
+    name = '::'.join(namespace + ['NewMover'])
+    return lambda: write_src_settings_line(name, DRY_RUN)
+
+@benchmark
+def find_rosetta_installation(tree):
+    """Find the root of the checkout from deep in the namespace tree."""
+    from rosetta_dev_tools.helpers import find_rosetta_installation
+    return find_rosetta_installation
+
+@benchmark
+def stub_mover_dry_run(tree):
+    """Run 'rdt_stub mover --dry-run' from start to finish, in a new process."""
+
+    name = '::'.join(tree.namespaces[len(tree.namespaces) // 2] + ['NewMover'])
+    code = 'import sys; sys.argv = ["rdt_stub", "mover", {!r}, "--dry-run"]; from rosetta_dev_tools.boilerplate import main; main()'.format(name)
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+            x for x in (ROOT, env.get('PYTHONPATH')) if x)
+
+    # The dry run asks before showing each file, so answer all of its 
+    # questions up front.
+
+    return lambda: subprocess.run(
+            (sys.executable, '-c', code),
+            input=b'\n' * 20, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""\
+Measure how long each rdt command takes to start up.
+
+The rdt commands get run dozens of times an hour, often just to print a usage 
+message or to find out that there's nothing to do, so they need to start 
+quickly.  For each entry point listed in setup.py, this script measures how 
+long it takes to import the entry point's module (according to 'python -X 
+importtime') and how long it takes to run the command with --help from start 
+to finish.  The latter doesn't include the time it takes to start an 
+interpreter that does nothing, since that part is out of our hands.
+
+Usage:
+    startup.py [<command>...] [options]
+
+Arguments:
+    <command>
+        The commands to measure, e.g. 'rdt_build'.  By default, every command 
+        in setup.py is measured.
+
+Options:
+    -n, --repeat NUM            [default: 20]
+        How many times to run each measurement.  The median is reported.
+
+    -b, --budget MS             [default: 10]
+        How many milliseconds each command is allowed to take to print its 
+        help message, on top of the time it takes to start python.  Exit with 
+        a non-zero status if any command goes over budget.
+
+    -j, --json
+        Print the results as JSON rather than as a table.
+"""
+
+import os, sys, re, subprocess, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    import docopt
+    args = docopt.docopt(__doc__)
+
+    entry_points = find_entry_points()
+    commands = args['<command>'] or sorted(entry_points)
+    num_runs = int(args['--repeat'])
+    budget = float(args['--budget'])
+
+    baseline = median(time_command(('-c', 'pass')) for i in range(num_runs))
+    results = []
+
+    for command in commands:
+        module, function = entry_points[command]
+        import_time = median(
+                measure_import_time(module) for i in range(num_runs))
+        help_time = median(
+                time_command(get_help_command(command, module, function))
+                for i in range(num_runs))
+
+        results.append(dict(
+                command=command,
+                module=module,
+                import_ms=import_time,
+                help_ms=help_time - baseline,
+                over_budget=help_time - baseline > budget,
+        ))
+
+    if args['--json']:
+        import json
+        json.dump(dict(
+                python_ms=baseline,
+                budget_ms=budget,
+                results=results), sys.stdout, indent=2)
+        print()
+    else:
+        print_results(results, baseline, budget)
+
+    sys.exit(any(x['over_budget'] for x in results))
+
+def find_entry_points():
+    """
+    Return a dictionary mapping the name of each console script in setup.py to 
+    the module and function it runs.
+    """
+    with open(os.path.join(ROOT, 'setup.py')) as file:
+        setup_py = file.read()
+
+    pattern = re.compile(r'''['"](\w+)\s*=\s*([\w.]+):(\w+)['"]''')
+    return {x[0]: (x[1], x[2]) for x in pattern.findall(setup_py)}
+
+def get_help_command(command, module, function):
+    # Run the entry point the same way the script installed by setuptools 
+    # would, but without depending on the script being installed.
+
+    code = 'import sys; sys.argv[0] = {!r}; from {} import {}; {}()'.format(
+            command, module, function, function)
+    return '-c', code, '--help'
+
+def time_command(args):
+    start = time.perf_counter()
+    subprocess.run(
+            (sys.executable,) + tuple(args),
+            cwd=ROOT, env=get_environment(),
+            stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+def measure_import_time(module):
+    """
+    Return how many milliseconds it took to import the given module, including 
+    everything it imported, according to 'python -X importtime'.
+    """
+    process = subprocess.run(
+            (sys.executable, '-X', 'importtime', '-c', 'import ' + module),
+            cwd=ROOT, env=get_environment(),
+            stderr=subprocess.PIPE, check=True)
+
+    # Each line looks like: 'import time: self [us] | cumulative | name'.  The 
+    # module itself is the last line that names it.
+
+    cumulative = 0
+    for line in process.stderr.decode().splitlines():
+        fields = [x.strip() for x in line.split(':', 1)[-1].split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            cumulative = int(fields[1])
+
+    return cumulative / 1000
+
+def get_environment():
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+            x for x in (ROOT, env.get('PYTHONPATH')) if x)
+    env.pop('RDT_TRACE', None)
+    return env
+
+def median(xs):
+    xs = sorted(xs)
+    middle = len(xs) // 2
+    return xs[middle] if len(xs) % 2 else (xs[middle - 1] + xs[middle]) / 2
+
+def print_results(results, baseline, budget):
+    print("Python startup: {:.1f} ms (not included below)".format(baseline))
+    print("Budget for --help: {:.1f} ms".format(budget))
+    print()
+    print("{:<16} {:>10} {:>10}".format('command', 'import', '--help'))
+
+    for result in results:
+        print("{:<16} {:>7.1f} ms {:>7.1f} ms{}".format(
+            result['command'], result['import_ms'], result['help_ms'],
+            '  OVER BUDGET' if result['over_budget'] else ''))
+
+
+if __name__ == '__main__':
+    main()
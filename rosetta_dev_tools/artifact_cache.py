@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+
+"""\
+Share object files and test binaries between rosetta checkouts.
+
+When the cache is enabled, cmake is configured to run every compile and link 
+command through this module (as a compiler launcher, like ccache).  Each 
+command is looked up in the cache by a hash of everything that determines its 
+output:
+
+- Compiling: the compiler (its path, size, and modification time), the flags,
+  and the preprocessed source file.
+- Linking: the compiler, the flags, and the contents of every object file and
+  library being linked.
+
+If the same command was already run (in this checkout or any other one using 
+the same cache), its output is copied into the build directory instead of 
+running the command again.  The path to the root of the checkout is replaced 
+with a placeholder before hashing, so that clones in different directories can 
+share the same entries.  One caveat is that objects taken from the cache still 
+refer to the source files of the checkout that compiled them in their 
+debugging information.
+
+The cache is a directory that can be shared by many users and checkouts, even 
+on a network filesystem.  For several users to share it, they need to be in 
+the same group, and the cache directory needs to belong to that group and be 
+group-writable (ideally with the setgid bit set, so everything created in it 
+belongs to the group too).  Every directory in the cache is made 
+group-writable as it's created, regardless of the umask, so that anyone in the 
+group can add entries and trim other people's.  Each entry is written to a temporary directory and 
+then renamed into place, so readers never see half-written entries and 
+concurrent writers can't corrupt each other.  Entries are marked as used 
+whenever they're read, and the least recently used entries are deleted when 
+the cache grows bigger than its size limit.
+"""
+
+import os, sys
+from . import helpers
+
+CACHE_VARIABLE = 'RDT_CACHE_DIR'
+ACTIVE_VARIABLE = 'RDT_ACTIVE_CACHE'
+BASE_DIR_VARIABLE = 'RDT_CACHE_BASE_DIR'
+STATS_VARIABLE = 'RDT_CACHE_STATS'
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'rdt_artifacts')
+LAUNCHER_MODULE = 'rosetta_dev_tools.artifact_cache'
+KEY_VERSION = b'rdt-artifact-cache-1'
+BASE_DIR_PLACEHOLDER = b'@ROSETTA@'
+TRIM_FRACTION = 0.9
+STALE_TEMP_AGE = 3600
+READ_SIZE = 1 << 20
+
+def main(argv=None):
+    """
+    Run the given compile or link command, taking its output from the cache 
+    if possible.  This is what cmake runs in place of the compiler.  Unless 
+    rdt_build enabled the cache, the command is just run as is.
+    """
+    command = sys.argv[1:] if argv is None else argv
+    cache_dir = os.environ.get(ACTIVE_VARIABLE)
+
+    if not cache_dir:
+        os.execvp(command[0], command)
+
+    cache = ArtifactCache(cache_dir)
+    sys.exit(cache.run(
+            command,
+            base_dir=os.environ.get(BASE_DIR_VARIABLE),
+            stats_path=os.environ.get(STATS_VARIABLE)))
+
+def get_cache_dir(cache_dir=None):
+    """
+    Return the cache directory to use: the given one, the one in
+    $RDT_CACHE_DIR, or '~/.cache/rdt_artifacts', in that order.
+    """
+    cache_dir = cache_dir or os.environ.get(CACHE_VARIABLE) or DEFAULT_CACHE_DIR
+    return os.path.abspath(os.path.expanduser(cache_dir))
+
+def get_launcher():
+    return sys.executable, '-m', LAUNCHER_MODULE
+
+def get_cache_cmake_args():
+    # Cmake splits launchers on semicolons.  The linker launcher needs cmake 
+    # 3.21 or newer, and older versions just ignore it.
+
+    launcher = ';'.join(get_launcher())
+    return (
+            '-DCMAKE_C_COMPILER_LAUNCHER=' + launcher,
+            '-DCMAKE_CXX_COMPILER_LAUNCHER=' + launcher,
+            '-DCMAKE_CXX_LINKER_LAUNCHER=' + launcher,
+    )
+
+def is_launcher_configured(build_path):
+    """
+    Return true if cmake was told to run the compiler in the given build 
+    directory through the cache.
+    """
+    try:
+        with open(os.path.join(build_path, 'CMakeCache.txt')) as file:
+            return any(
+                    x.startswith('CMAKE_CXX_COMPILER_LAUNCHER') and
+                    LAUNCHER_MODULE in x
+                    for x in file)
+    except IOError:
+        return False
+
+def strip_launcher(arguments):
+    """
+    Remove the cache launcher from the front of the given compile command, if 
+    it's there, so that tools reading the command see the real compiler.
+    """
+    if len(arguments) > 3 and list(arguments[1:3]) == ['-m', LAUNCHER_MODULE]:
+        return arguments[3:]
+    return arguments
+
+def enable(cache_dir, rosetta_path, stats_path):
+    """
+    Turn the cache on for any build tool started by this process after this 
+    point.  Hits and misses are recorded in <stats_path>.
+    """
+    os.environ[ACTIVE_VARIABLE] = cache_dir
+    os.environ[BASE_DIR_VARIABLE] = rosetta_path
+    os.environ[STATS_VARIABLE] = stats_path
+
+    with open(stats_path, 'w'):
+        pass
+
+def read_stats(stats_path):
+    """
+    Return how many compile and link commands were taken from the cache and 
+    how many had to be run, as a dictionary like {'hit': 12, 'miss': 3}.
+    """
+    stats = {'hit': 0, 'miss': 0}
+
+    try:
+        with open(stats_path) as file:
+            for line in file:
+                outcome = line.split()[0] if line.strip() else None
+                if outcome in stats:
+                    stats[outcome] += 1
+    except IOError:
+        pass
+
+    return stats
+
+def parse_size(size):
+    """
+    Convert a size like '20G' or '500M' into a number of bytes.
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+
+    try:
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise BadCacheSize(size)
+
+def get_compile_job(command):
+    """
+    Return a CompileJob for the given command, or None if the command isn't a 
+    single compilation that can be cached.
+    """
+    arguments = list(command[1:])
+
+    if '-c' not in arguments or '-o' not in arguments[:-1]:
+        return None
+    if any(x in arguments for x in ('-E', '-M', '-MM', '-fsyntax-only', '-')):
+        return None
+
+    # The dependency file is written by the preprocessor, so it has to be 
+    # named explicitly or it would end up somewhere unexpected.
+
+    if ('-MD' in arguments or '-MMD' in arguments) and '-MF' not in arguments:
+        return None
+
+    return CompileJob(command)
+
+def get_link_job(command):
+    """
+    Return a LinkJob for the given command, or None if the command isn't a 
+    link that can be cached.
+    """
+    arguments = list(command[1:])
+
+    if '-c' in arguments or '-o' not in arguments[:-1]:
+        return None
+
+    # Binaries with an rpath (i.e. shared library builds) load libraries from 
+    # the build directory that linked them, so they can't be shared.
+
+    if any('rpath' in x for x in arguments):
+        return None
+
+    return LinkJob(command)
+
+def normalize(data, base_dirs):
+    for base_dir in base_dirs:
+        data = data.replace(base_dir, BASE_DIR_PLACEHOLDER)
+    return data
+
+def get_base_dirs(base_dir):
+    """
+    Return the ways the root of the checkout might be spelled in a command, 
+    longest first, as bytes.
+    """
+    if not base_dir:
+        return []
+
+    spellings = {os.path.abspath(base_dir), os.path.realpath(base_dir)}
+    return sorted((x.encode() for x in spellings), key=len, reverse=True)
+
+def hash_file(hash, path):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(READ_SIZE), b''):
+            hash.update(chunk)
+
+def hash_compiler(hash, compiler):
+    """
+    Identify the compiler by its path, size, and modification time, which is 
+    much faster than hashing the whole binary and changes whenever the 
+    compiler is upgraded.
+    """
+    import shutil
+
+    path = os.path.realpath(shutil.which(compiler) or compiler)
+    stat = os.stat(path)
+    hash.update('{}\0{}\0{}\0'.format(path, stat.st_size, stat.st_mtime_ns).encode())
+
+def get_output_path(arguments):
+    return arguments[arguments.index('-o') + 1]
+
+def make_shared_dir(path):
+    """
+    Create the given directory (if it doesn't exist yet) and make it writable 
+    by its group, so that other users sharing the cache can add and remove 
+    entries in it.  If the directory belongs to someone else, its permissions 
+    are theirs to set, so it's left alone.
+    """
+    import stat
+
+    os.makedirs(path, exist_ok=True)
+
+    try:
+        mode = os.stat(path).st_mode
+        if mode & stat.S_IRWXG != stat.S_IRWXG:
+            os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXG)
+    except OSError:
+        pass
+
+def copy_atomically(source, destination):
+    """
+    Copy the given file such that the destination either doesn't change or is 
+    completely replaced, even if this process is killed partway through.
+    """
+    import shutil
+
+    temp_path = '{}.rdt_tmp{}'.format(destination, os.getpid())
+    try:
+        shutil.copy(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ArtifactCache:
+    """
+    A directory of cached build outputs.  Each entry is a directory named 
+    after its key (sharded by the first two characters of the key), 
+    containing one file for each output of the command and one for anything 
+    it wrote to stderr (e.g. warnings), which is replayed on every hit.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.temp_dir = os.path.join(cache_dir, 'tmp')
+
+    def run(self, command, base_dir=None, stats_path=None):
+        """
+        Run the given command, or take its output from the cache.  Return the 
+        exit status of the command.
+        """
+        import subprocess
+
+        job = get_compile_job(command) or get_link_job(command)
+        if job is None:
+            return subprocess.call(command)
+
+        # If the key can't be worked out (e.g. because the preprocessor 
+        # failed), run the command anyway, so the user sees the real error.
+
+        try:
+            key = job.get_key(get_base_dirs(base_dir))
+        except (OSError, subprocess.CalledProcessError):
+            key = None
+
+        if key and self.restore(key, job.get_outputs()):
+            self.record(stats_path, 'hit', job)
+            return 0
+
+        process = subprocess.run(command, stderr=subprocess.PIPE)
+        sys.stderr.buffer.write(process.stderr)
+        sys.stderr.flush()
+
+        if key and process.returncode == 0:
+            self.store(key, job.get_outputs(), process.stderr)
+            self.record(stats_path, 'miss', job)
+
+        return process.returncode
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, outputs):
+        """
+        Copy the outputs of the given entry into place.  Return false if there 
+        is no such entry, or if it was deleted while being copied.
+        """
+        entry_dir = self.get_entry_dir(key)
+
+        try:
+            for name, path in outputs:
+                copy_atomically(os.path.join(entry_dir, name), path)
+
+            with open(os.path.join(entry_dir, 'stderr'), 'rb') as file:
+                sys.stderr.buffer.write(file.read())
+                sys.stderr.flush()
+        except OSError:
+            return False
+
+        # Mark the entry as recently used.  This might not be allowed if 
+        # someone else created the entry, and that's fine.
+
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+
+        return True
+
+    def store(self, key, outputs, stderr):
+        """
+        Add an entry with the given outputs to the cache.  If another process 
+        added the same entry first, keep theirs.
+        """
+        import shutil
+
+        entry_dir = self.get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        make_shared_dir(self.cache_dir)
+        make_shared_dir(self.temp_dir)
+        make_shared_dir(os.path.dirname(entry_dir))
+        temp_dir = os.path.join(self.temp_dir, '{}.{}'.format(
+            os.getpid(), os.urandom(8).hex()))
+
+        # The entry itself has to be group-writable too, because moving a 
+        # directory to a different parent (which is how entries are trimmed) 
+        # requires permission to write to it.
+
+        make_shared_dir(temp_dir)
+
+        try:
+            for name, path in outputs:
+                shutil.copy(path, os.path.join(temp_dir, name))
+            with open(os.path.join(temp_dir, 'stderr'), 'wb') as file:
+                file.write(stderr)
+
+            os.rename(temp_dir, entry_dir)
+
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def record(self, stats_path, outcome, job):
+        # Each line is written with a single call to an append-only file, so 
+        # lines from concurrent jobs don't get mixed up.
+
+        if stats_path:
+            with open(stats_path, 'a') as file:
+                file.write('{} {} {}\n'.format(outcome, job.kind, job.output))
+
+    def find_entries(self):
+        """
+        Return the path, size, and last time of use of every entry.
+        """
+        entries = []
+
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+
+            for key in os.listdir(shard_dir):
+                entry_dir = os.path.join(shard_dir, key)
+                try:
+                    size = sum(
+                            os.path.getsize(os.path.join(entry_dir, x))
+                            for x in os.listdir(entry_dir))
+                    entries.append((entry_dir, size, os.stat(entry_dir).st_mtime))
+                except OSError:
+                    continue
+
+        return entries
+
+    def trim(self, max_size):
+        """
+        Delete the least recently used entries until the cache takes up less 
+        than <max_size> bytes.  The cache is trimmed a little further than 
+        that, so it isn't trimmed again after every build.  Return the size 
+        of the cache and how many bytes were deleted.  If another process is 
+        already trimming the cache, or the lock can't be opened (e.g. because 
+        another user created it and it isn't group-writable), do nothing and 
+        return None for the size.
+        """
+        import fcntl, shutil, stat, time
+
+        if not os.path.isdir(self.cache_dir):
+            return 0, 0
+
+        lock_path = os.path.join(self.cache_dir, 'trim.lock')
+
+        try:
+            lock = open(lock_path, 'a')
+        except OSError:
+            return None, 0
+
+        # Let the rest of the group open the lock too.  This only works if the 
+        # lock is ours, which it is if we just created it.
+
+        try:
+            mode = stat.S_IMODE(os.fstat(lock.fileno()).st_mode)
+            os.chmod(lock_path, mode | stat.S_IRGRP | stat.S_IWGRP)
+        except OSError:
+            pass
+
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None, 0
+
+            # Clean up after writers that were killed before they could move 
+            # their entries into place.
+
+            if os.path.isdir(self.temp_dir):
+                for name in os.listdir(self.temp_dir):
+                    path = os.path.join(self.temp_dir, name)
+                    try:
+                        if time.time() - os.stat(path).st_mtime > STALE_TEMP_AGE:
+                            shutil.rmtree(path, ignore_errors=True)
+                    except OSError:
+                        pass
+
+            entries = self.find_entries()
+            total_size = sum(x[1] for x in entries)
+            deleted_size = 0
+
+            if total_size <= max_size:
+                return total_size, 0
+
+            # Move each entry out of the way before deleting it, so that a 
+            # reader never finds an entry with some files missing.
+
+            make_shared_dir(self.temp_dir)
+
+            for entry_dir, size, last_used in sorted(entries, key=lambda x: x[2]):
+                if total_size - deleted_size <= TRIM_FRACTION * max_size:
+                    break
+
+                doomed_dir = os.path.join(self.temp_dir, 'deleted.' + os.path.basename(entry_dir))
+                try:
+                    os.rename(entry_dir, doomed_dir)
+                except OSError:
+                    continue
+
+                shutil.rmtree(doomed_dir, ignore_errors=True)
+                deleted_size += size
+
+            return total_size - deleted_size, deleted_size
+
+
+class CompileJob:
+    """
+    A command that compiles one source file into an object file (and, with 
+    split DWARF, a *.dwo file).
+    """
+    kind = 'compile'
+
+    def __init__(self, command):
+        self.command = list(command)
+        self.arguments = self.command[1:]
+        self.output = get_output_path(self.arguments)
+
+    def get_outputs(self):
+        outputs = [('output', self.output)]
+        if '-gsplit-dwarf' in self.arguments:
+            outputs.append(('dwo', os.path.splitext(self.output)[0] + '.dwo'))
+        return outputs
+
+    def get_key(self, base_dirs):
+        import hashlib
+
+        hash = hashlib.sha256(KEY_VERSION + b'\0compile\0')
+        hash_compiler(hash, self.command[0])
+
+        # The names of the output and dependency files don't affect what gets 
+        # compiled, and the same file has the same name in every checkout 
+        # anyway.
+
+        skip = False
+        for argument in self.arguments:
+            if skip:
+                skip = False
+            elif argument in ('-o', '-MF', '-MT', '-MQ'):
+                skip = True
+            else:
+                hash.update(normalize(argument.encode(), base_dirs) + b'\0')
+
+        hash.update(normalize(os.getcwd().encode(), base_dirs) + b'\0')
+
+        # The skeleton object file left by split DWARF refers to its *.dwo file 
+        # by absolute path, so those objects can only be shared by builds in 
+        # the same place.
+
+        if '-gsplit-dwarf' in self.arguments:
+            hash.update(os.getcwd().encode() + b'\0')
+
+        hash.update(normalize(self.preprocess(), base_dirs))
+        return hash.hexdigest()
+
+    def preprocess(self):
+        """
+        Run the preprocessor and return its output.  The dependency file that 
+        the build tool expects is written as a side effect.
+        """
+        import subprocess
+
+        preprocess_command = [self.command[0]]
+        skip = False
+
+        for argument in self.arguments:
+            if skip:
+                skip = False
+            elif argument == '-o':
+                skip = True
+            elif argument != '-c':
+                preprocess_command.append(argument)
+
+        preprocess_command.append('-E')
+        return subprocess.check_output(
+                preprocess_command, stderr=subprocess.DEVNULL)
+
+
+class LinkJob:
+    """
+    A command that links object files and libraries into a binary.
+    """
+    kind = 'link'
+
+    def __init__(self, command):
+        self.command = list(command)
+        self.arguments = self.command[1:]
+        self.output = get_output_path(self.arguments)
+
+    def get_outputs(self):
+        return [('output', self.output)]
+
+    def get_key(self, base_dirs):
+        import hashlib
+
+        hash = hashlib.sha256(KEY_VERSION + b'\0link\0')
+        hash_compiler(hash, self.command[0])
+        hash.update(normalize(os.getcwd().encode(), base_dirs) + b'\0')
+
+        for argument in self.arguments:
+            hash.update(normalize(argument.encode(), base_dirs) + b'\0')
+
+        # Hash the contents of everything being linked, including the objects 
+        # listed in response files and any libraries from the checkout that 
+        # are found through -L and -l.
+
+        for path in self.find_inputs(base_dirs):
+            hash.update(normalize(path.encode(), base_dirs) + b'\0')
+            hash_file(hash, path)
+
+        return hash.hexdigest()
+
+    def find_inputs(self, base_dirs):
+        import shlex
+
+        arguments = []
+        for argument in self.arguments:
+            if argument.startswith('@'):
+                with open(argument[1:]) as file:
+                    arguments += shlex.split(file.read())
+            else:
+                arguments.append(argument)
+
+        inputs = [
+                x for x in arguments
+                if not x.startswith('-') and x != self.output and os.path.isfile(x)
+        ]
+
+        library_dirs = [
+                x[2:] for x in arguments
+                if x.startswith('-L') and any(
+                    os.path.abspath(x[2:]).encode().startswith(y) for y in base_dirs)
+        ]
+        for name in (x[2:] for x in arguments if x.startswith('-l')):
+            for library_dir in library_dirs:
+                for extension in '.so', '.a':
+                    path = os.path.join(library_dir, 'lib' + name + extension)
+                    if os.path.isfile(path):
+                        inputs.append(path)
+
+        return inputs
+
+
+class BadCacheSize (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Couldn't understand the cache size '{0}'.  Give a number of bytes,
+            optionally followed by K, M, G, or T (e.g. '20G')."""
+
+    def __init__(self, size):
+        super().__init__(size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""\
+Track the performance of rosetta across a range of commits.
+
+Each commit in the given range is checked out into a separate git worktree, 
+built, and benchmarked.  The wall time and peak memory usage of each benchmark 
+are saved in '.rdt_history', and commits that have already been benchmarked 
+are not built or run again.  Once every commit has been measured, change-point 
+detection is used to find the commits that made each benchmark slower (or 
+more memory hungry).
+
+Usage:
+    rdt_bench <commits> <benchmark>... [options]
+
+Arguments:
+    <commits>
+        The commits to benchmark.  This can either be a single commit or a 
+        range of commits that 'git rev-list' understands, e.g.  
+        'master~20..master'.
+
+    <benchmark>
+        Either the name of a saved unit test alias, or a 
+        command line to run from the 'source/' directory of the checked-out 
+        commit, e.g. 'bin/score_jd2.default.linuxgccrelease -s 1ubq.pdb'.  Any 
+        benchmark containing a space is taken to be a command line.
+
+Options:
+    -b, --build <build>         [default: release]
+        Which build configuration to compile and benchmark.
+
+    -p, --project <project>
+        Which project to build before running command line benchmarks.  By 
+        default, all of rosetta is built.
+
+    -n, --repeat NUM            [default: 3]
+        How many times to run each benchmark at each commit.
+
+    -w, --worktree <path>
+        Where to check out the commits being benchmarked.  The same worktree is 
+        reused between runs, so that each build only has to recompile what 
+        changed since the last one.  By default, the worktree is placed next to 
+        your rosetta checkout.
+
+    -t, --threshold PERCENT     [default: 5]
+        How big a change (in percent) has to be before it's reported.
+
+    -r, --report-only
+        Don't build or run anything, just analyze the results that have already 
+        been saved for the given commits.
+
+    -f, --rerun
+        Benchmark every commit again, even if it has already been benchmarked.
+
+    -j, --jobs NUM
+        The number of compilation jobs to run concurrently.
+
+    -v, --verbose
+        Output each command line that gets run, in case something needs to be 
+        debugged.
+"""
+
+import os
+from . import helpers
+
+def main():
+    args = helpers.parse_args(__doc__)
+
+    try:
+        rosetta_path = helpers.find_rosetta_installation()
+        commits = list_commits(rosetta_path, args['<commits>'])
+        benchmarks = [Benchmark(x) for x in args['<benchmark>']]
+        build = args['--build']
+
+        if not args['--report-only']:
+            run_benchmarks(
+                    rosetta_path, commits, benchmarks, build,
+                    project=args['--project'],
+                    num_runs=int(args['--repeat']),
+                    worktree_path=args['--worktree'],
+                    rerun=args['--rerun'],
+                    nprocs=args['--jobs'],
+                    verbose=args['--verbose'],
+            )
+
+        print_report(
+                rosetta_path, commits, benchmarks, build,
+                threshold=float(args['--threshold']))
+
+    except KeyboardInterrupt:
+        helpers.exit_interrupted()
+
+    except helpers.FatalBuildError as error:
+        error.exit_gracefully()
+
+def list_commits(rosetta_path, spec):
+    """
+    Return the full hashes of the commits described by the given revision 
+    specification, oldest first.  A single commit is returned by itself rather 
+    than with all of its ancestors.
+    """
+    import subprocess
+
+    if '..' in spec:
+        command = 'git', 'rev-list', '--reverse', spec
+    else:
+        command = 'git', 'rev-parse', '--verify', spec + '^{commit}'
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout = subprocess.check_output(
+                    command, cwd=rosetta_path, stderr=devnull)
+    except subprocess.CalledProcessError:
+        raise BadCommitRange(spec)
+
+    commits = stdout.decode().split()
+    if not commits:
+        raise BadCommitRange(spec)
+
+    return commits
+
+def describe_commit(rosetta_path, commit):
+    import subprocess
+
+    command = 'git', 'log', '-1', '--format=%h %s', commit
+    stdout = subprocess.check_output(command, cwd=rosetta_path)
+    return stdout.decode().strip()
+
+def run_benchmarks(rosetta_path, commits, benchmarks, build, project=None, num_runs=3, worktree_path=None, rerun=False, nprocs=None, verbose=False):
+    from . import history
+    from .build import build_rosetta
+
+    worktree_path = worktree_path or get_default_worktree(rosetta_path)
+
+    for commit in commits:
+        title = describe_commit(rosetta_path, commit)
+
+        # Skip any benchmarks that have already been run for this commit.  If 
+        # all of them have, there's no need to check out or build this commit.
+
+        todo = [x for x in benchmarks
+                if rerun or not find_results(x, commit, build)]
+
+        if not todo:
+            print("Already benchmarked {}".format(title))
+            continue
+
+        print("Benchmarking {}".format(title))
+        checkout_commit(rosetta_path, worktree_path, commit, verbose)
+
+        # Build everything the benchmarks need.  If the build fails, record 
+        # that fact so the commit isn't rebuilt every time this is run.
+
+        projects = {x.get_project(project) for x in todo}
+        error_code = 0
+
+        for target in sorted(projects, key=lambda x: x or ''):
+            error_code = error_code or build_rosetta(
+                    build, target,
+                    nprocs=nprocs,
+                    verbose=verbose,
+                    rosetta_path=worktree_path,
+            )
+
+        # Run each benchmark the requested number of times, and record the 
+        # wall time and peak memory usage of each run.
+
+        for benchmark in todo:
+            runs = []
+            status = 'build failed' if error_code else 'ok'
+
+            for i in range(num_runs if not error_code else 0):
+                usage = benchmark.run(worktree_path, build, verbose)
+                if usage.returncode != 0:
+                    status = 'failed'
+                    break
+                runs.append(usage.to_dict())
+
+            history.add_record(
+                    'commit_benchmark',
+                    benchmark=benchmark.name,
+                    build=build,
+                    commit=commit,
+                    status=status,
+                    runs=runs,
+            )
+
+def get_default_worktree(rosetta_path):
+    rosetta_path = rosetta_path.rstrip(os.sep)
+    return rosetta_path + '.rdt_bench'
+
+def checkout_commit(rosetta_path, worktree_path, commit, verbose=False):
+    """
+    Check out the given commit in the benchmarking worktree, creating the 
+    worktree first if necessary.
+    """
+    if not os.path.exists(worktree_path):
+        command = 'git', 'worktree', 'add', '--detach', worktree_path, commit
+        helpers.shell_command(rosetta_path, command, verbose=verbose)
+    else:
+        command = 'git', 'checkout', '--quiet', '--detach', commit
+        helpers.shell_command(worktree_path, command, verbose=verbose)
+
+def find_results(benchmark, commit, build):
+    """
+    Return the most recent record of the given benchmark being run on the 
+    given commit, or None if it's never been run there.
+    """
+    from . import history
+
+    records = history.find_records(
+            'commit_benchmark',
+            benchmark=benchmark.name, commit=commit, build=build)
+    return records[-1] if records else None
+
+def find_change_points(values, threshold=5, alpha=0.01, min_size=1):
+    """
+    Find the indices where the given series of measurements shifts to a new 
+    level, using binary segmentation.  <values> is a list with one entry per 
+    commit, each of which is a list of measurements from that commit (or an 
+    empty list, if the commit couldn't be measured).
+
+    Each segment is split at the point that minimizes the total squared error 
+    of the two halves.  The split is accepted if the two halves differ by more 
+    than <threshold> percent and a Welch's t-test says the difference is 
+    significant at the <alpha> level.  Return a list of (index, before, after) 
+    tuples, where <before> and <after> are the mean values on either side.
+    """
+    change_points = []
+
+    def split(start, end):
+        best = None
+
+        for i in range(start + min_size, end - min_size + 1):
+            left = [x for xs in values[start:i] for x in xs]
+            right = [x for xs in values[i:end] for x in xs]
+            if not left or not right:
+                continue
+
+            cost = sum_squared_error(left) + sum_squared_error(right)
+            if best is None or cost < best[0]:
+                best = cost, i, left, right
+
+        if best is None:
+            return
+
+        cost, i, left, right = best
+        before, after = mean(left), mean(right)
+
+        if before == 0 or abs(after - before) / before * 100 < threshold:
+            return
+        if welch_p_value(left, right) > alpha:
+            return
+
+        change_points.append((i, before, after))
+        split(start, i)
+        split(i, end)
+
+    split(0, len(values))
+    return sorted(change_points)
+
+def mean(xs):
+    return sum(xs) / len(xs)
+
+def sum_squared_error(xs):
+    m = mean(xs)
+    return sum((x - m)**2 for x in xs)
+
+def welch_p_value(left, right):
+    """
+    Return the two-sided p-value of Welch's t-test for the given samples.  The 
+    t distribution is approximated by a normal distribution, which is plenty 
+    accurate for deciding whether a change is worth pointing out.
+    """
+    import math
+
+    n1, n2 = len(left), len(right)
+    var1 = sum_squared_error(left) / (n1 - 1) if n1 > 1 else 0
+    var2 = sum_squared_error(right) / (n2 - 1) if n2 > 1 else 0
+    standard_error = math.sqrt(var1 / n1 + var2 / n2)
+
+    if standard_error == 0:
+        return 0.0 if mean(left) != mean(right) else 1.0
+
+    t = (mean(right) - mean(left)) / standard_error
+    return math.erfc(abs(t) / math.sqrt(2))
+
+def print_report(rosetta_path, commits, benchmarks, build, threshold=5):
+    from nonstdlib import print_color
+
+    metrics = [
+            ('wall_time', 'time', lambda x: '{:.3f}s'.format(x)),
+            ('max_rss', 'memory', helpers.format_bytes),
+    ]
+
+    for benchmark in benchmarks:
+        records = [find_results(benchmark, x, build) for x in commits]
+        series = {
+                key: [[run[key] for run in x['runs']] if x else [] for x in records]
+                for key, title, formatter in metrics
+        }
+        change_points = {
+                key: dict((i, (before, after)) for i, before, after in
+                    find_change_points(series[key], threshold))
+                for key, title, formatter in metrics
+        }
+
+        print()
+        print_color(benchmark.name, 'white', 'bold')
+
+        for i, commit in enumerate(commits):
+            record = records[i]
+            columns = []
+
+            if record is None:
+                columns.append('not benchmarked')
+            elif record['status'] != 'ok':
+                columns.append(record['status'])
+            else:
+                for key, title, formatter in metrics:
+                    columns.append('{} {:>10}'.format(
+                        title, formatter(mean(series[key][i]))))
+
+            line = '  {:<50} {}'.format(
+                    describe_commit(rosetta_path, commit)[:50],
+                    '  '.join(columns))
+
+            # Point out the commits where the benchmark changed.  Getting 
+            # slower or bigger is a regression, getting faster or smaller is 
+            # an improvement.
+
+            notes = []
+            for key, title, formatter in metrics:
+                if i in change_points[key]:
+                    before, after = change_points[key][i]
+                    notes.append('{} {:+.1f}%'.format(
+                        title, 100 * (after / before - 1)))
+
+            if not notes:
+                print(line)
+            elif any(x.split()[-1].startswith('+') for x in notes):
+                print_color(line + '  <-- ' + ', '.join(notes), 'red', 'bold')
+            else:
+                print_color(line + '  <-- ' + ', '.join(notes), 'green', 'bold')
+
+
+class Benchmark:
+    """
+    Something that can be run to measure the performance of rosetta: either a 
+    unit test alias or an arbitrary command line.
+    """
+
+    def __init__(self, name):
+        from .unit_test import pick_unit_test
+
+        self.name = name
+        self.is_command = ' ' in name.strip()
+
+        if not self.is_command:
+            self.library, self.suite, self.test = \
+                    pick_unit_test(None, None, alias=name)
+
+    def __repr__(self):
+        return 'Benchmark({!r})'.format(self.name)
+
+    def get_project(self, default=None):
+        if self.is_command:
+            return default
+        else:
+            return self.library + '.test'
+
+    def run(self, rosetta_path, build, verbose=False):
+        from .unit_test import get_unit_test_dir, get_unit_test_command
+
+        if self.is_command:
+            directory = os.path.join(rosetta_path, 'source')
+            command = self.name
+        else:
+            directory = get_unit_test_dir(build, rosetta_path)
+            command = get_unit_test_command(
+                    self.library, self.suite, self.test, verbose)
+
+        return helpers.measured_shell_command(
+                directory, command,
+                check=False, one_line=not verbose, verbose=verbose)
+
+
+class BadCommitRange (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            '{0}' doesn't describe any commits.  Give either a single commit or
+            a range like 'master~10..master'."""
+
+    def __init__(self, spec):
+        super().__init__(spec)
+
+
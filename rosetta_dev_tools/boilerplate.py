@@ -40,12 +40,11 @@ Options:
         needed if a header file will be written.
 """
 
-import sys, os, re, shutil, glob
+import sys, os
 from . import helpers
 
 def main():
-    import docopt
-    args = docopt.docopt(__doc__)
+    args = helpers.parse_args(__doc__)
     command = args['<type>']
     name = args['<name>']
     parent = args['--parent']
@@ -246,6 +245,8 @@ def insert_line_into_file(path, line, dry_run=False):
     write_file(path, content, summary, dry_run)
 
 def insert_name_into_settings(path, name, namespace, dry_run):
+    import re
+
     # Parse the settings file into a set of blocks, where each block represents 
     # one namespace and all of its files.  The blocks are stored in a ordered 
     # dictionary, where the key is the name of the block's namespace.
@@ -646,6 +647,8 @@ public:
     dry_run=dry_run)
 
 def write_src_settings_line(name, dry_run=False):
+    import glob
+
     name, namespace = get_fully_qualified_name(name)
     namespace_path = '/'.join(namespace)
     settings_glob = os.path.join(
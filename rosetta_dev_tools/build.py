@@ -10,51 +10,306 @@ variables and rebuild rosetta from scratch.
 
 Usage:
     rdt_build [<build>] [<project>] [options]
+    rdt_build --check <file>... [options]
+    rdt_build --what-if [<change>...] [options]
+    rdt_build --gc [options]
 
 Options:
     -f, --clean
         Remove all the files generated by previous compilations.  
 
+    -c, --check
+        Compile just the object files for the given source files, without 
+        linking anything.  This is a quick way to make sure that the file 
+        you're editing compiles.  Use --build to pick the build configuration.
+
+    -s, --syntax-only
+        With --check, only check the given files for syntax and type errors 
+        (i.e. compile with -fsyntax-only), which is even faster.  No object 
+        files are written.
+
+    -b, --build <build>
+        Which build configuration to use with --check or --what-if.  The 
+        default is 'debug'.
+
+    -w, --what-if
+        Predict what would be rebuilt, and how long it would take with the 
+        given number of --jobs, without building anything.  The changes can be 
+        given as a list of files (e.g. a header you're about to edit) or as a 
+        git revision you're about to check out.  By default, the uncommitted 
+        changes in your checkout are used.  The prediction is based on the 
+        headers each file included and the time each target took the last time 
+        it was built, so the build directory must have been built with ninja 
+        at least once.
+
+    -g, --gc
+        Reclaim disk space from the build directories.  Any build directory 
+        that hasn't been built or tested in --max-age days is emptied, except 
+        for its 'CMakeLists.txt', so it can still be built again from scratch.  
+        If --max-size is given, the least recently used build directories are 
+        emptied until the rest fit.  Saved integration test outputs that are 
+        older than that are deleted too.
+
+    --max-age DAYS              [default: 30]
+        How long a build directory can go unused before --gc evicts it.
+
+    --max-size SIZE
+        How much space all the build directories together can take up (e.g. 
+        '200G') before the least recently used ones are evicted by --gc.
+
+    --compress-debug
+        With --gc, compress the debugging information in every object file and 
+        binary that's left, using objcopy.  Modification times are preserved, 
+        so nothing is rebuilt.
+
+    --dedup
+        With --gc, replace identical object files in different build 
+        directories with hard links to one copy.
+
+    -n, --dry-run
+        With --gc, report what would be evicted and how much space would be 
+        reclaimed, without changing anything.
+
+    -l, --fast-link
+        Reconfigure the build directory so that linking is as fast as possible:
+        use lld or gold (whichever is installed) instead of the default linker, 
+        keep debugging information in separate *.dwo files (split DWARF), and 
+        give each binary a gdb index.  This causes one full rebuild, but makes 
+        every link after that much faster.  The setting sticks until the build 
+        directory is cleaned, or until --default-link is given.
+
+    --shared-libs
+        Reconfigure the build directory to build each library as a shared 
+        library, so that changing one library doesn't require relinking every 
+        binary that uses it.  This can be combined with --fast-link.
+
+    --default-link
+        Undo --fast-link and --shared-libs, i.e. reconfigure the build 
+        directory to link the way it did originally.  The flags that were 
+        added for those options are removed, but any other flags cached in the 
+        build directory are kept.
+
+    --time-relink
+        Measure how long it takes to relink the given project (by default, 
+        protocols.test) without recompiling anything.  The time is saved and 
+        compared with the times measured for other link configurations, so you 
+        can see how much --fast-link or --shared-libs helps.
+
+    -m, --adaptive
+        Run as many jobs at once as there's memory for, rather than a fixed 
+        number.  The memory each target needed in previous builds is 
+        remembered, and the number of jobs is adjusted as the build runs so 
+        that your machine doesn't start swapping.  With this option, --jobs 
+        sets the maximum number of jobs.  Requires ninja 1.13 or GNU make 4.0.
+
+    -C, --cache
+        Take object files and test binaries from a cache that can be shared by 
+        every checkout on the machine (or on the network), rather than 
+        compiling them, whenever the same file was already compiled with the 
+        same flags.  Newly compiled files are added to the cache.  The first 
+        time this is used, the build directory is reconfigured to run the 
+        compiler through the cache.
+
+    --cache-dir DIR
+        Where to keep the cache.  The default is $RDT_CACHE_DIR, or 
+        '~/.cache/rdt_artifacts' if that isn't set.  To share the cache with 
+        other people, put them all in one group, and use a directory that 
+        belongs to that group and is group-writable with the setgid bit set 
+        (e.g. 'chgrp rosetta DIR; chmod 2775 DIR').  Everything rdt creates in 
+        the cache is made group-writable, whatever your umask.
+
+    --cache-size SIZE           [default: 20G]
+        How big the cache can get before the least recently used files are 
+        deleted from it.
+
     -j, --jobs NUM
         The number of compilation jobs to run concurrently to use.  By default, 
         ninja will choose a number based on how many CPUs your machine has.
 
+    --trace FILE
+        Record how long each stage of the build takes (including each target 
+        built by ninja) and write it to the given file in Chrome's trace 
+        format, which can be opened in chrome://tracing or ui.perfetto.dev.  
+        Setting $RDT_TRACE to a file name does the same thing.
+
     -v, --verbose
         Output each command line that gets run, in case something needs to be 
         debugged.
 """
 
-import sys, os, nonstdlib
-from . import helpers
+import sys, os
+from . import helpers, tracing
+from .compile_commands import update_compile_commands, find_compile_command
 
 def main():
-    import docopt
-    args = docopt.docopt(__doc__)
+    args = helpers.parse_args(__doc__)
+    tracing.start_tracing(args['--trace'])
 
     try:
+        if args['--check']:
+            error_code = check_files(
+                    args['<file>'],
+                    build=args['--build'],
+                    syntax_only=args['--syntax-only'],
+                    nprocs=args['--jobs'],
+                    verbose=args['--verbose'],
+            )
+            sys.exit(error_code)
+
+        if args['--gc']:
+            from .artifact_cache import parse_size
+            from .build_gc import collect_garbage
+
+            collect_garbage(
+                    max_age=float(args['--max-age']),
+                    max_size=args['--max-size'] and parse_size(args['--max-size']),
+                    compress=args['--compress-debug'],
+                    dedup=args['--dedup'],
+                    nprocs=args['--jobs'],
+                    dry_run=args['--dry-run'],
+                    verbose=args['--verbose'],
+            )
+            sys.exit(0)
+
+        if args['--what-if']:
+            predict_rebuild(
+                    args['<change>'],
+                    build=args['--build'],
+                    nprocs=args['--jobs'],
+                    verbose=args['--verbose'],
+            )
+            sys.exit(0)
+
         error_code = build_rosetta(
                 build=args['<build>'],
                 project=args['<project>'],
                 clean=args['--clean'],
                 nprocs=args['--jobs'],
                 verbose=args['--verbose'],
+                fast_link=args['--fast-link'],
+                shared_libs=args['--shared-libs'],
+                default_link=args['--default-link'],
+                adaptive=args['--adaptive'],
+                cache=args['--cache'],
+                cache_dir=args['--cache-dir'],
+                cache_size=args['--cache-size'],
         )
+
+        if args['--time-relink'] and not error_code:
+            error_code = time_relink(
+                    build=args['<build>'],
+                    project=args['<project>'],
+                    nprocs=args['--jobs'],
+                    verbose=args['--verbose'],
+            )
+
         sys.exit(error_code)
 
     except KeyboardInterrupt:
-        pass
+        helpers.exit_interrupted()
 
     except helpers.FatalBuildError as error:
         error.exit_gracefully()
 
-def build_rosetta(build=None, project=None, clean=False, nprocs=None, verbose=False):
+def build_rosetta(build=None, project=None, clean=False, nprocs=None, verbose=False, rosetta_path=None, cmake_args=(), fast_link=False, shared_libs=False, default_link=False, adaptive=False, cache=False, cache_dir=None, cache_size=None):
+    """
+    Build the given project in the given build configuration.  Any extra 
+    <cmake_args> are passed to cmake when the build directory is configured, 
+    which only happens when the cmake output is missing or stale.  If 
+    <default_link> is set, the build directory is reconfigured to undo 
+    <fast_link> and <shared_libs> if necessary.  If <adaptive> is set, 
+    <nprocs> is the most jobs that will be run at once, but fewer will be run 
+    if there isn't enough memory.  If <cache> is set, build outputs are taken 
+    from and added to the artifact cache in <cache_dir>, which is kept under 
+    <cache_size>.  Return the exit status of the build tool.
+    """
+    link_config = None
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+
+    # The link configuration is only checked when one is asked for, so that 
+    # commands that just need something built don't undo --fast-link.
+
+    if fast_link or shared_libs or default_link:
+        build_path = os.path.join(
+                rosetta_path, 'source', 'cmake', 'build_' + (build or 'debug'))
+        link_config = choose_link_config(fast_link, shared_libs)
+        cmake_args = get_link_cmake_args(link_config, build_path, cmake_args)
+
+    if cache:
+        from . import artifact_cache
+        cache_dir = artifact_cache.get_cache_dir(cache_dir)
+        cache_size = artifact_cache.parse_size(cache_size or '20G')
+        cmake_args = tuple(cmake_args) + artifact_cache.get_cache_cmake_args()
+
+    build_path, build_tool = configure_build(
+            build, clean=clean, verbose=verbose,
+            rosetta_path=rosetta_path, cmake_args=cmake_args,
+            link_config=link_config, cache=cache)
+
+    if cache:
+        stats_path = os.path.join(build_path, '.rdt_cache_stats')
+        artifact_cache.enable(cache_dir, rosetta_path, stats_path)
+
+    # Execute the ninja command to build rosetta.
+
+    build_command = build_tool,
+    if project is not None:
+        build_command += project,
+        if not project.endswith('.test'):
+            build_command += project + '_symlink',
+
+    if adaptive:
+        from .scheduler import run_adaptive_build
+        build_function = lambda: run_adaptive_build(
+                build_path, build_command, max_jobs=nprocs, verbose=verbose)
+    else:
+        if nprocs is not None:
+            build_command += '-j', nprocs
+
+        build_function = lambda: helpers.shell_command(
+                build_path, build_command, check=False, verbose=verbose)
+
+    if cache:
+        build_function = report_cache_usage(
+                build_function, cache_dir, cache_size, stats_path)
+
+    # If the build is being traced, add a span for every target that ninja 
+    # built, using the times ninja wrote to its log.
+
+    if not tracing.is_enabled():
+        return build_function()
+
+    import time
+
+    log_offset = tracing.get_ninja_log_size(build_path)
+    start_time = time.perf_counter()
+
+    with tracing.span('build', project=project or 'all', adaptive=adaptive):
+        error_code = build_function()
+
+    if 'ninja' in os.path.basename(build_tool):
+        tracing.trace_ninja_log(build_path, log_offset, start_time)
+
+    return error_code
+
+def configure_build(build=None, clean=False, verbose=False, rosetta_path=None, cmake_args=(), link_config=None, cache=False):
+    """
+    Make sure the given build directory is ready to be built, i.e. that the 
+    cmake output for it exists and is up to date.  If a <link_config> is given 
+    and differs from the one the directory was configured with, or if <cache> 
+    is set and the directory isn't configured to use the artifact cache yet, 
+    cmake is run again even if its output is up to date.  Return the path to 
+    the build directory and the build tool (ninja or make) that should be used 
+    to build it.
+    """
     import subprocess
+    from .artifact_cache import is_launcher_configured
 
     # Initialize the settings and paths that we'll use for this build.  This 
     # involves setting some default values and making sure some paths exist.
 
     build = build or 'debug'
-    rosetta_path = helpers.find_rosetta_installation()
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
     cmake_path = os.path.join(rosetta_path, 'source', 'cmake')
     build_path = os.path.join(cmake_path, 'build_' + build)
 
@@ -72,7 +327,7 @@ def build_rosetta(build=None, project=None, clean=False, nprocs=None, verbose=Fa
     # whatever information is necessary for the rest of this program to be 
     # agnostic to the choice of build tool.
 
-    with open(os.devnull) as devnull:
+    with open(os.devnull) as devnull, tracing.span('find_build_tool'):
         build_tool_candidates = 'ninja', 'ninja-build', 'make',
         build_tools = subprocess.check_output(
                 'which ' + ' '.join(build_tool_candidates) + ' || true',
@@ -97,24 +352,377 @@ def build_rosetta(build=None, project=None, clean=False, nprocs=None, verbose=Fa
     # *.settings file were modified more recently than the ninja build script.
 
     make_project = 'python2', 'make_project.py', 'all'
-    make_build_tool = 'cmake', '-G', cmake_generator, '-Wno-dev'
+    make_build_tool = (
+            'cmake', '-G', cmake_generator, '-Wno-dev',
+            '-DCMAKE_EXPORT_COMPILE_COMMANDS=ON') + tuple(cmake_args)
+
+    with tracing.span('is_cmake_output_stale'):
+        reconfigure = (
+                link_config is not None and
+                link_config != read_link_config(build_path))
+        add_cache = cache and not is_launcher_configured(build_path)
+        is_stale = reconfigure or add_cache or is_cmake_output_stale(cmake_output)
+
+    if is_stale:
+        with tracing.span('make_project.py'):
+            helpers.shell_command(cmake_path, make_project, one_line=True, verbose=verbose)
+        with tracing.span('cmake'):
+            helpers.shell_command(build_path, make_build_tool, one_line=True, verbose=verbose)
+
+    if reconfigure:
+        write_link_config(build_path, link_config)
+
+    # Export the compile command for every source file, for the benefit of 
+    # --check and any other tools that need to know how files are compiled.  
+    # This only does anything if cmake just regenerated its output.
+
+    with tracing.span('update_compile_commands'):
+        update_compile_commands(build_path, build_tool, cmake_output, verbose)
+
+    return build_path, build_tool
+
+def report_cache_usage(build_function, cache_dir, cache_size, stats_path):
+    """
+    Wrap the given build function so that, once the build finishes, the 
+    artifact cache is trimmed to its size limit and the number of files taken 
+    from the cache is reported.
+    """
+    from . import artifact_cache
+
+    def build_and_report():
+        error_code = build_function()
+
+        stats = artifact_cache.read_stats(stats_path)
+        current_size, deleted_size = artifact_cache.ArtifactCache(cache_dir).trim(cache_size)
+        num_commands = stats['hit'] + stats['miss']
+
+        if num_commands:
+            print("Artifact cache: {} of {} files reused ({:.0f}%)".format(
+                stats['hit'], num_commands, 100 * stats['hit'] / num_commands))
+        if current_size is not None:
+            print("Artifact cache size: {} of {}{}".format(
+                helpers.format_bytes(current_size),
+                helpers.format_bytes(cache_size),
+                " ({} freed)".format(helpers.format_bytes(deleted_size))
+                    if deleted_size else ""))
+
+        return error_code
+
+    return build_and_report
+
+def check_files(paths, build=None, syntax_only=False, nprocs=None, verbose=False):
+    """
+    Compile only the object files corresponding to the given source files, 
+    without linking anything.  If <syntax_only> is set, run each compile 
+    command with -fsyntax-only instead of building the object files.  Return 
+    non-zero if any of the files failed to compile.
+    """
+    build_path, build_tool = configure_build(build, verbose=verbose)
+
+    if 'ninja' not in os.path.basename(build_tool):
+        raise CheckRequiresNinja()
+
+    commands = [find_source_command(build_path, x) for x in paths]
+
+    # Let ninja build the object files.  It will compile them in parallel and 
+    # won't touch anything else, since nothing else was asked for.
+
+    if not syntax_only:
+        check_command = (build_tool,) + tuple(x.output for x in commands)
+        if nprocs is not None:
+            check_command += '-j', nprocs
+
+        return helpers.shell_command(
+                build_path, check_command, check=False, verbose=verbose)
+
+    # To just check syntax, run the compile command for each file with 
+    # -fsyntax-only (and without any of the output arguments).
+
+    syntax_commands = [
+            [x.arguments[0]] + x.flags + ['-fsyntax-only', x.path]
+            for x in commands
+    ]
+    return run_commands_in_parallel(
+            build_path, syntax_commands, nprocs=nprocs, verbose=verbose)
+
+def predict_rebuild(changes, build=None, nprocs=None, verbose=False):
+    """
+    Print what would be rebuilt if the given files changed (or if the given 
+    git revision were checked out), and how long it would take.
+    """
+    from . import rebuild_cost
+
+    import shutil
+
+    # Don't configure the build directory, since running cmake could take 
+    # longer than the answer is worth.  The prediction is based on whatever 
+    # ninja knew the last time it ran.
 
-    if is_cmake_output_stale(cmake_output):
-        helpers.shell_command(cmake_path, make_project, one_line=True, verbose=verbose)
-        helpers.shell_command(build_path, make_build_tool, one_line=True, verbose=verbose)
+    rosetta_path = helpers.find_rosetta_installation()
+    build_path = os.path.join(
+            rosetta_path, 'source', 'cmake', 'build_' + (build or 'debug'))
+    build_tool = shutil.which('ninja') or shutil.which('ninja-build') or 'make'
+
+    return rebuild_cost.predict_rebuild(
+            build_path, build_tool, changes,
+            rosetta_path=rosetta_path, nprocs=nprocs, verbose=verbose)
+
+def find_source_command(build_path, path):
+    """
+    Return the compile command for the given source file, which includes the 
+    name of the object file it compiles to.
+    """
+    path = os.path.realpath(path)
+
+    if not path.endswith(('.cc', '.cpp', '.c')):
+        raise NotASourceFile(path)
+
+    command = find_compile_command(path, build_path)
+
+    if command is None or command.output is None:
+        raise NoObjectTarget(path)
+
+    return command
+
+def run_commands_in_parallel(directory, commands, nprocs=None, verbose=False):
+    """
+    Run each of the given commands in the given directory, several at a time.  
+    The output from each command is collected and printed once that command 
+    finishes, so that the output from different commands isn't interleaved.  
+    Return the highest exit status of any command.
+    """
+    from . import processes
+
+    def show(result):
+        if result.output:
+            print(result.text, end='')
+
+    results = processes.run(processes.run_processes(
+            commands, directory, nprocs=nprocs, capture=True,
+            on_finished=show, verbose=verbose))
+
+    return max((x.returncode for x in results), default=0)
+
+def choose_link_config(fast_link=False, shared_libs=False):
+    """
+    Decide how the build should be linked.  The fastest linker that's 
+    installed is used for --fast-link, but if neither lld nor gold is 
+    available, split DWARF still helps by keeping debug info out of the link.
+    """
+    import shutil
+
+    linker = 'default'
+
+    if fast_link:
+        for candidate in 'lld', 'gold':
+            if shutil.which('ld.' + candidate):
+                linker = candidate
+                break
+        else:
+            print("Warning: neither lld nor gold is installed, so the default "
+                  "linker will be used.")
+
+    return dict(
+            linker=linker,
+            split_dwarf=fast_link,
+            gdb_index=fast_link and linker != 'default',
+            shared_libs=shared_libs,
+    )
+
+def get_link_cmake_args(link_config, build_path, cmake_args=()):
+    """
+    Return the given cmake arguments, plus whatever else is needed to build 
+    with the given link configuration.  The link flags are added to the flags 
+    already cached in the build directory (or given in <cmake_args>) rather 
+    than replacing them, and any flags left over from a different link 
+    configuration are removed.  Variables that don't need to change aren't 
+    passed to cmake at all.
+    """
+    compile_flags = []
+    link_flags = []
+
+    if link_config['linker'] != 'default':
+        link_flags.append('-fuse-ld=' + link_config['linker'])
+    if link_config['split_dwarf']:
+        compile_flags.append('-gsplit-dwarf')
+
+    # The default (bfd) linker doesn't know how to build gdb indices.
+
+    if link_config['gdb_index']:
+        link_flags.append('-Wl,--gdb-index')
+
+    new_flags = {
+            'CMAKE_C_FLAGS': compile_flags,
+            'CMAKE_CXX_FLAGS': compile_flags,
+            'CMAKE_EXE_LINKER_FLAGS': link_flags,
+            'CMAKE_SHARED_LINKER_FLAGS': link_flags,
+    }
+
+    # Flags that were given explicitly (e.g. for profiling) take the place of 
+    # the cached values, so the link flags are added to them instead of one 
+    # definition silently overriding the other.
+
+    cached = read_cmake_cache(build_path)
+    explicit = {}
+    other_args = []
+
+    for arg in cmake_args:
+        name, equals, value = arg[2:].partition('=')
+        name = name.split(':')[0]
+        if arg.startswith('-D') and equals and name in new_flags:
+            explicit[name] = value
+        else:
+            other_args.append(arg)
 
-    # Execute the ninja command to build rosetta.
+    link_args = []
 
-    build_command = build_tool,
-    if project is not None:
-        build_command += project,
-        if not project.endswith('.test'):
-            build_command += project + '_symlink',
+    for name, flags in new_flags.items():
+        old_value = explicit.get(name, cached.get(name, ''))
+        kept = [x for x in old_value.split() if not is_link_config_flag(x)]
+        value = ' '.join(kept + flags)
+
+        if name in explicit or value != ' '.join(cached.get(name, '').split()):
+            link_args.append('-D{}={}'.format(name, value))
+
+    is_shared = cached.get('BUILD_SHARED_LIBS', 'OFF').upper() in ('ON', 'TRUE', 'YES', '1')
+    if link_config['shared_libs'] != is_shared:
+        link_args.append('-DBUILD_SHARED_LIBS={}'.format(
+            'ON' if link_config['shared_libs'] else 'OFF'))
+
+    return tuple(other_args) + tuple(link_args)
+
+def is_link_config_flag(flag):
+    return flag in ('-gsplit-dwarf', '-Wl,--gdb-index') or \
+            flag.startswith('-fuse-ld=')
+
+def read_cmake_cache(build_path):
+    """
+    Return the variables cached in the given build directory's 
+    'CMakeCache.txt', as a dictionary of strings.  An empty dictionary is 
+    returned if the directory hasn't been configured yet.
+    """
+    variables = {}
+
+    try:
+        file = open(os.path.join(build_path, 'CMakeCache.txt'))
+    except IOError:
+        return variables
+
+    with file:
+        for line in file:
+            if line.startswith(('#', '//')) or '=' not in line:
+                continue
+            name, value = line.rstrip('\n').split('=', 1)
+            variables[name.split(':')[0]] = value
+
+    return variables
+
+def read_link_config(build_path):
+    """
+    Return the link configuration the given build directory was last 
+    configured with, or the default configuration if it was never changed.
+    """
+    import json
+
+    try:
+        with open(os.path.join(build_path, '.rdt_link_config')) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return choose_link_config()
+
+def write_link_config(build_path, link_config):
+    import json
+
+    with open(os.path.join(build_path, '.rdt_link_config'), 'w') as file:
+        json.dump(link_config, file, sort_keys=True)
+
+def time_relink(build=None, project=None, nprocs=None, verbose=False):
+    """
+    Measure how long it takes to relink the given project, and compare that 
+    time to the relink times measured in other link configurations.  The 
+    project must already be up to date, so that deleting its binary causes 
+    only the link step to be rerun.
+    """
+    from . import history
+
+    build = build or 'debug'
+    project = project or 'protocols.test'
+    build_path, build_tool = configure_build(build, verbose=verbose)
+    binary_path = os.path.join(build_path, project)
+
+    if not os.path.exists(binary_path):
+        raise NoBinaryToRelink(project)
+
+    os.remove(binary_path)
+
+    relink_command = build_tool, project
     if nprocs is not None:
-        build_command += '-j', nprocs
+        relink_command += '-j', nprocs
+
+    usage = helpers.measured_shell_command(
+            build_path, relink_command, check=False, verbose=verbose)
+    if usage.returncode:
+        return usage.returncode
+
+    # Record the time, then show it next to the most recent time for every 
+    # other link configuration that's been tried.
+
+    link_config = read_link_config(build_path)
+    history.add_record(
+            'relink',
+            build=build,
+            project=project,
+            link_config=link_config,
+            **usage.to_dict()
+    )
+
+    latest = {}
+    for record in history.find_records('relink', build=build, project=project):
+        key = describe_link_config(record['link_config'])
+        latest[key] = record
+
+    current = describe_link_config(link_config)
+    print()
+    print("Relink times for {} ({}):".format(project, build))
+    for key, record in sorted(latest.items(), key=lambda x: x[1]['wall_time']):
+        print("  {:>8.2f}s  {}{}".format(
+            record['wall_time'], key, '  (current)' if key == current else ''))
+
+    return 0
+
+def describe_link_config(link_config):
+    features = ['{} linker'.format(link_config['linker'])]
+    if link_config['split_dwarf']:
+        features.append('split DWARF')
+    if link_config['gdb_index']:
+        features.append('gdb index')
+    if link_config['shared_libs']:
+        features.append('shared libraries')
+    return ', '.join(features)
+
+def derive_build_dir(build, base_build, rosetta_path=None):
+    """
+    Create a new build directory, build_<build>, that is configured just like 
+    build_<base_build>.  This makes it possible to keep a build with special 
+    compiler flags (e.g. for profiling) alongside the regular builds without 
+    ever forcing the regular builds to be recompiled.  Nothing happens if the 
+    directory already exists.
+    """
+    import shutil
+
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+    cmake_path = os.path.join(rosetta_path, 'source', 'cmake')
+    build_path = os.path.join(cmake_path, 'build_' + build)
+    base_path = os.path.join(cmake_path, 'build_' + base_build)
 
-    return helpers.shell_command(
-            build_path, build_command, check=False, verbose=verbose)
+    if os.path.exists(os.path.join(build_path, 'CMakeLists.txt')):
+        return
+
+    require_cmake_path(base_path, 'CMakeLists.txt')
+    os.makedirs(build_path, exist_ok=True)
+    shutil.copy(
+            os.path.join(base_path, 'CMakeLists.txt'),
+            os.path.join(build_path, 'CMakeLists.txt'))
 
 def wipe_old_build(build_path):
     for subpath in os.listdir(build_path):
@@ -169,6 +777,43 @@ class NoBuildToolFound (helpers.FatalBuildError):
         super().__init__()
 
 
+class CheckRequiresNinja (helpers.FatalBuildError):
+    exit_status = 2
+    exit_message = """\
+            The --check option only works with ninja, because there's no simple
+            way to ask make which object file a source file compiles to."""
+
+
+class NotASourceFile (helpers.FatalBuildError):
+    exit_status = 4
+    exit_message = """\
+            '{0}' isn't a source file.  Only *.cc files can be checked; to check
+            a header, check one of the source files that includes it."""
+
+    def __init__(self, path):
+        super().__init__(path)
+
+
+class NoObjectTarget (helpers.FatalBuildError):
+    exit_status = 4
+    exit_message = """\
+            Couldn't find an object file for '{0}'.  Make sure the file is
+            listed in one of the *.settings files."""
+
+    def __init__(self, path):
+        super().__init__(path)
+
+
+class NoBinaryToRelink (helpers.FatalBuildError):
+    exit_status = 4
+    exit_message = """\
+            Couldn't find the '{0}' binary to relink.  Make sure the project
+            name is right and that it builds successfully."""
+
+    def __init__(self, project):
+        super().__init__(project)
+
+
 class MissingCMakeFiles (helpers.FatalBuildError):
     exit_status = 3
     exit_message = """\
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+"""\
+Reclaim the disk space used by build directories.
+
+Each build directory in 'source/cmake' can grow to many gigabytes, and old 
+configurations tend to pile up.  There are three ways to get that space back:
+
+- Evict build directories that haven't been used in a while, or the least
+  recently used ones if all the build directories together are bigger than a 
+  size budget.  An evicted directory keeps its 'CMakeLists.txt', so it can 
+  still be built again, from scratch.
+
+- Compress the debugging information in object files and binaries, which
+  usually makes debug builds much smaller.  gdb reads compressed debugging 
+  information just fine.
+
+- Replace identical object files in different build directories with hard
+  links to a single copy.
+
+Files are never touched in a way that would make ninja rebuild anything:
+modification times are preserved, and when identical objects are linked 
+together, the oldest modification time is kept.  An object is only linked to 
+an older copy if that copy is still newer than every file the object was 
+compiled from, according to ninja's dependency log.
+"""
+
+import os
+from . import helpers
+
+SECONDS_PER_DAY = 24 * 60 * 60
+USAGE_MARKERS = '.ninja_log', '.ninja_deps', 'CMakeCache.txt', 'Makefile'
+DEBUG_SUFFIXES = '.o', '.dwo', '.so', '.test'
+
+def collect_garbage(max_age=30, max_size=None, compress=False, dedup=False, nprocs=None, dry_run=False, verbose=False, rosetta_path=None):
+    """
+    Evict the build directories that haven't been used in <max_age> days, then 
+    the least recently used ones until the rest fit in <max_size> bytes.  
+    Optionally compress debugging information and hard link identical object 
+    files in the build directories that are left.  Return the number of bytes 
+    reclaimed.  If <dry_run> is set, just report what would be done.
+    """
+    import time
+    from .build import wipe_old_build
+
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+    builds = find_build_dirs(rosetta_path)
+    evicted = choose_evictions(builds, max_age, max_size, now=time.time())
+    reclaimed = 0
+
+    for build in evicted:
+        print("{} build_{} (last used {}, {}).".format(
+            'Would evict' if dry_run else 'Evicting',
+            build.name, format_age(build.last_used),
+            helpers.format_bytes(build.size)))
+
+        if not dry_run:
+            wipe_old_build(build.path)
+
+        reclaimed += build.unique_size
+
+    reclaimed += evict_integration_outputs(rosetta_path, max_age, dry_run)
+
+    kept = [x for x in builds if x not in evicted]
+
+    if compress:
+        reclaimed += compress_debug_sections(
+                rosetta_path, kept, nprocs, dry_run, verbose)
+
+    if dedup:
+        reclaimed += link_identical_objects(kept, dry_run)
+
+    print("{} {}.".format(
+        'Would reclaim' if dry_run else 'Reclaimed',
+        helpers.format_bytes(reclaimed)))
+
+    return reclaimed
+
+def find_build_dirs(rosetta_path):
+    """
+    Return every build directory in 'source/cmake' that has been built (or at 
+    least configured), most recently used first.
+    """
+    from . import history
+
+    cmake_path = os.path.join(rosetta_path, 'source', 'cmake')
+    last_tested = {}
+
+    for record in history.find_records():
+        if record.get('build'):
+            last_tested[record['build']] = max(
+                    record.get('time', 0), last_tested.get(record['build'], 0))
+
+    builds = []
+
+    for name in sorted(os.listdir(cmake_path)):
+        path = os.path.join(cmake_path, name)
+        if not name.startswith('build_') or not os.path.isdir(path):
+            continue
+
+        # Directories without any build markers have never been built, or 
+        # were already evicted, so there's nothing in them to reclaim (even if 
+        # the history says they were used).
+
+        build = BuildDir(name[len('build_'):], path)
+        last_built = build.get_last_built()
+        if last_built == 0:
+            continue
+
+        build.last_used = max(last_built, last_tested.get(build.name, 0))
+        build.size, build.unique_size = get_disk_usage(
+                path, keep=[os.path.join(path, 'CMakeLists.txt')])
+        builds.append(build)
+
+    return sorted(builds, key=lambda x: -x.last_used)
+
+def choose_evictions(builds, max_age=None, max_size=None, now=0):
+    """
+    Return the build directories that should be evicted: the ones that haven't 
+    been used in <max_age> days, plus the least recently used ones that don't 
+    fit in <max_size> bytes.  <builds> must be sorted most recently used 
+    first.
+    """
+    evicted = []
+    total_size = 0
+
+    for build in builds:
+        if max_age is not None and now - build.last_used > max_age * SECONDS_PER_DAY:
+            evicted.append(build)
+            continue
+
+        # The most recently used build is never evicted for size, since it's 
+        # probably the one you're about to build again.
+
+        total_size += build.size
+        if max_size is not None and total_size > max_size and build is not builds[0]:
+            evicted.append(build)
+
+    return evicted
+
+def get_disk_usage(path, keep=()):
+    """
+    Return the number of bytes of disk space used by the given directory, and 
+    how many of those would be freed by deleting it (i.e. not counting files 
+    that are hard linked from somewhere else).  Files in <keep> wouldn't be 
+    deleted, so they aren't counted at all.
+    """
+    inodes = {}
+
+    for dir, subdirs, files in os.walk(path):
+        for name in files:
+            if os.path.join(dir, name) in keep:
+                continue
+            try:
+                stat = os.lstat(os.path.join(dir, name))
+            except FileNotFoundError:
+                continue
+
+            key = stat.st_dev, stat.st_ino
+            seen, nlink, size = inodes.get(key, (0, stat.st_nlink, stat.st_blocks * 512))
+            inodes[key] = seen + 1, nlink, size
+
+    total = sum(size for seen, nlink, size in inodes.values())
+    unique = sum(size for seen, nlink, size in inodes.values() if seen >= nlink)
+    return total, unique
+
+def evict_integration_outputs(rosetta_path, max_age, dry_run=False):
+    """
+    Delete the saved integration test outputs that haven't been reused in 
+    <max_age> days.  These would be regenerated by running the tests again.
+    """
+    import shutil, time
+    from .integration import get_cache_dir
+
+    outputs_path = get_cache_dir(rosetta_path, 'outputs')
+    reclaimed = 0
+
+    if max_age is None or not os.path.isdir(outputs_path):
+        return reclaimed
+
+    for test in sorted(os.listdir(outputs_path)):
+        path = os.path.join(outputs_path, test)
+        if time.time() - os.path.getmtime(path) < max_age * SECONDS_PER_DAY:
+            continue
+
+        size, unique_size = get_disk_usage(path)
+        reclaimed += unique_size
+
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+
+    if reclaimed:
+        print("{} old integration test outputs ({}).".format(
+            'Would delete' if dry_run else 'Deleted',
+            helpers.format_bytes(reclaimed)))
+
+    return reclaimed
+
+def compress_debug_sections(rosetta_path, builds, nprocs=None, dry_run=False, verbose=False):
+    """
+    Compress the debugging information in every object file and binary in the 
+    given build directories with objcopy.  Files that were already compressed 
+    (and haven't changed since) are remembered in the state database and 
+    skipped.
+    """
+    import shutil
+    from . import processes, state
+
+    objcopy = shutil.which('objcopy')
+    if objcopy is None:
+        raise NoObjcopy()
+
+    store = state.open_state(rosetta_path)
+    compressed = store.get_cache('compressed_debug')
+    paths = []
+
+    for build in builds:
+        for path in find_files(build.path, DEBUG_SUFFIXES):
+            stat = os.stat(path)
+            if compressed.get(path) != [stat.st_size, stat.st_mtime_ns]:
+                paths.append(path)
+
+    if dry_run or not paths:
+        print("{} files to compress.".format(len(paths)))
+        return 0
+
+    print("Compressing debugging information in {} files...".format(len(paths)))
+
+    # objcopy writes a new file, so put the old modification time back 
+    # afterwards.  Otherwise ninja would think every binary needed to be 
+    # relinked.
+
+    before = {x: os.stat(x) for x in paths}
+    updates = {}
+    reclaimed = 0
+
+    def record(result):
+        nonlocal reclaimed
+
+        path = result.command[-1]
+        old_stat = before[path]
+
+        # Files objcopy can't handle (e.g. LTO objects) are remembered too, so 
+        # they aren't tried again every time.
+
+        if result.returncode != 0:
+            updates[path] = [old_stat.st_size, old_stat.st_mtime_ns]
+            if verbose:
+                print(result.text, end='')
+            return
+
+        os.utime(path, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+        new_stat = os.stat(path)
+        updates[path] = [new_stat.st_size, new_stat.st_mtime_ns]
+
+        if old_stat.st_nlink == 1:
+            reclaimed += max(0, (old_stat.st_blocks - new_stat.st_blocks) * 512)
+
+    commands = [
+            (objcopy, '--compress-debug-sections=zlib', x) for x in paths]
+    processes.run(processes.run_processes(
+        commands, nprocs=nprocs, capture=True, on_finished=record,
+        verbose=verbose))
+
+    # Forget about files that don't exist anymore, e.g. because their build 
+    # directory was evicted.
+
+    missing = [x for x in compressed if not os.path.exists(x)]
+    store.update_cache('compressed_debug', updates, missing)
+
+    print("Compressed {} files ({}).".format(
+        len(updates), helpers.format_bytes(reclaimed)))
+
+    return reclaimed
+
+def link_identical_objects(builds, dry_run=False):
+    """
+    Replace identical object files in the given build directories with hard 
+    links to a single copy.  Only files of the same size are compared, and 
+    each file is only read once.
+
+    This is safe because neither compiler writes into an existing object file:
+    the GNU assembler deletes the old file before writing a new one, and clang 
+    writes to a temporary file that it renames into place.  So recompiling an 
+    object in one build directory never changes the copy in another.
+
+    The linked files all share the oldest modification time, so nothing that 
+    was linked from them looks out of date.  But ninja would recompile an 
+    object that ends up older than one of its inputs, so objects are left 
+    alone unless ninja's dependency log shows that they'd still be newer than 
+    all their inputs.  Split DWARF files aren't tracked by ninja, so they can 
+    always be linked.
+    """
+    import hashlib
+    from collections import Counter, defaultdict
+    from .artifact_cache import hash_file
+
+    by_size = defaultdict(list)
+    newest_inputs = {}
+
+    for build in builds:
+        newest_inputs.update(find_newest_inputs(build.path))
+
+        for path in find_files(build.path, ('.o', '.dwo')):
+            stat = os.lstat(path)
+            if stat.st_size > 0:
+                by_size[stat.st_dev, stat.st_size].append((path, stat))
+
+    reclaimed = 0
+    num_linked = 0
+    num_skipped = 0
+
+    def is_safe(path, mtime_ns):
+        if path.endswith('.dwo'):
+            return True
+        path = os.path.normpath(path)
+        return newest_inputs.get(path, float('inf')) <= mtime_ns
+
+    for (dev, size), files in by_size.items():
+        if len({stat.st_ino for path, stat in files}) < 2:
+            continue
+
+        # Group the files by their contents, hashing each inode only once.
+
+        digests = {}
+        by_digest = defaultdict(list)
+        links = Counter(stat.st_ino for path, stat in files)
+
+        for path, stat in files:
+            if stat.st_ino not in digests:
+                digest = hashlib.sha256()
+                hash_file(digest, path)
+                digests[stat.st_ino] = digest.digest()
+            by_digest[digests[stat.st_ino]].append((path, stat))
+
+        for group in by_digest.values():
+            # Keep the oldest copy, so no object looks newer than what was 
+            # linked from it.
+
+            group.sort(key=lambda x: x[1].st_mtime_ns)
+            keep_path, keep_stat = group[0]
+            freed_inodes = set()
+
+            for path, stat in group[1:]:
+                if stat.st_ino == keep_stat.st_ino:
+                    continue
+
+                if not is_safe(path, keep_stat.st_mtime_ns):
+                    num_skipped += 1
+                    continue
+
+                if not dry_run:
+                    tmp_path = '{}.rdt_tmp{}'.format(path, os.getpid())
+                    os.link(keep_path, tmp_path)
+                    os.replace(tmp_path, path)
+
+                num_linked += 1
+
+                # Only count each inode once, and only if this was its last 
+                # link.
+
+                if stat.st_ino not in freed_inodes and links[stat.st_ino] >= stat.st_nlink:
+                    freed_inodes.add(stat.st_ino)
+                    reclaimed += stat.st_blocks * 512
+
+    print("{} {} identical object files ({}).".format(
+        'Would link' if dry_run else 'Linked', num_linked,
+        helpers.format_bytes(reclaimed)))
+
+    if num_skipped:
+        print("Skipped {} identical object files that would have looked older "
+              "than their inputs.".format(num_skipped))
+
+    return reclaimed
+
+def find_newest_inputs(build_path):
+    """
+    Return a dictionary mapping the path of each target in the given build 
+    directory's ninja dependency log to the modification time (in 
+    nanoseconds) of the newest file it depended on the last time it was 
+    built.  Inputs that don't exist anymore count as infinitely new, because 
+    ninja will rebuild their targets anyway.
+    """
+    import subprocess
+    from .rebuild_cost import read_deps_log
+
+    deps_path = os.path.join(build_path, '.ninja_deps')
+    if not os.path.exists(deps_path):
+        return {}
+
+    try:
+        paths, deps = read_deps_log(deps_path, build_path, 'ninja')
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    paths = [os.path.normpath(os.path.join(build_path, x)) for x in paths]
+    mtimes = {}
+
+    def get_mtime(id):
+        if id not in mtimes:
+            try:
+                mtimes[id] = os.stat(paths[id]).st_mtime_ns
+            except (OSError, IndexError):
+                mtimes[id] = float('inf')
+        return mtimes[id]
+
+    return {
+            paths[output]: max((get_mtime(x) for x in inputs), default=0)
+            for output, inputs in deps.items()
+            if output < len(paths)
+    }
+
+def find_files(root, suffixes):
+    for dir, subdirs, files in os.walk(root):
+        for name in files:
+            if name.endswith(suffixes):
+                yield os.path.join(dir, name)
+
+def format_age(timestamp):
+    import time
+
+    days = (time.time() - timestamp) / SECONDS_PER_DAY
+    if days < 1:
+        return 'today'
+    if days < 2:
+        return 'yesterday'
+    return '{:.0f} days ago'.format(days)
+
+
+class BuildDir:
+    """
+    A build directory, and when it was last built or tested.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.last_used = 0
+        self.size = 0
+        self.unique_size = 0
+
+    def __repr__(self):
+        return 'BuildDir({!r})'.format(self.name)
+
+    def get_last_built(self):
+        times = [0]
+        for name in USAGE_MARKERS:
+            try:
+                times.append(os.path.getmtime(os.path.join(self.path, name)))
+            except OSError:
+                pass
+        return max(times)
+
+
+class NoObjcopy (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Couldn't find 'objcopy', which is needed to compress debugging
+            information.  It's part of binutils."""
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""\
+Export and look up the command used to compile each source file in a build.
+
+Every build directory gets a 'compile_commands.json' file (the format used by 
+clang tooling), which is only regenerated when cmake regenerates the build 
+files.  Because that file is several megabytes for rosetta and has to be 
+parsed in full to find anything, it is also indexed into a small SQLite 
+database ('compile_commands.db') keyed by the path of each source file.  Most 
+lookups only need to touch the index.
+"""
+
+import os
+from . import helpers
+
+def update_compile_commands(build_path, build_tool, cmake_output, verbose=False):
+    """
+    Make sure 'compile_commands.json' and its index are up to date with the 
+    given cmake output (i.e. 'build.ninja' or 'Makefile').
+    """
+    json_path = get_json_path(build_path)
+
+    # Ninja can write the compile commands on its own.  With make, cmake has 
+    # to write them when it configures the build directory, so there's 
+    # nothing to do here if cmake didn't (e.g. because the build directory 
+    # was configured before this feature existed).
+
+    if is_older(json_path, cmake_output):
+        if 'ninja' in os.path.basename(build_tool):
+            export_compile_commands(build_path, build_tool, verbose)
+
+    if os.path.exists(json_path) and is_older(get_index_path(build_path), json_path):
+        index_compile_commands(build_path)
+
+def export_compile_commands(build_path, build_tool, verbose=False):
+    import subprocess
+
+    json_path = get_json_path(build_path)
+    command = build_tool, '-t', 'compdb'
+
+    if verbose:
+        print('$ cd', build_path)
+        print('$', ' '.join(command), '>', json_path)
+
+    stdout = subprocess.check_output(command, cwd=build_path)
+
+    # If the build runs the compiler through the artifact cache, ninja lists 
+    # the cache as the compiler.  Take it out, so that other tools (and 
+    # --syntax-only) see the real compiler.
+
+    from .artifact_cache import LAUNCHER_MODULE, strip_launcher
+
+    if LAUNCHER_MODULE.encode() in stdout:
+        import json
+
+        entries = json.loads(stdout.decode())
+        for entry in entries:
+            if 'arguments' in entry:
+                entry['arguments'] = strip_launcher(entry['arguments'])
+            else:
+                entry['command'] = entry['command'].split(' -m {} '.format(LAUNCHER_MODULE), 1)[-1]
+        stdout = json.dumps(entries, indent=2).encode()
+
+    with open(json_path + '.tmp', 'wb') as file:
+        file.write(stdout)
+    os.replace(json_path + '.tmp', json_path)
+
+def index_compile_commands(build_path):
+    """
+    Copy every entry from 'compile_commands.json' into an SQLite database, 
+    keyed by the absolute path of the source file.  The database is built 
+    under a temporary name and moved into place, so readers never see a 
+    half-built index.
+    """
+    import json, sqlite3
+
+    with open(get_json_path(build_path)) as file:
+        entries = json.load(file)
+
+    index_path = get_index_path(build_path)
+    temp_path = index_path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    db = sqlite3.connect(temp_path)
+    try:
+        db.execute('''\
+                CREATE TABLE commands (
+                    file TEXT PRIMARY KEY,
+                    directory TEXT,
+                    arguments TEXT,
+                    output TEXT)''')
+        db.executemany(
+                'INSERT OR REPLACE INTO commands VALUES (?, ?, ?, ?)',
+                (parse_entry(x) for x in entries))
+        db.commit()
+    finally:
+        db.close()
+
+    os.replace(temp_path, index_path)
+
+def parse_entry(entry):
+    """
+    Convert one entry from 'compile_commands.json' into a row for the index.  
+    Entries can give the command either as a string or as a list of arguments, 
+    and may or may not say which file the command outputs.
+    """
+    import json, shlex
+
+    directory = entry['directory']
+    file = os.path.realpath(os.path.join(directory, entry['file']))
+
+    if 'arguments' in entry:
+        arguments = entry['arguments']
+    else:
+        arguments = shlex.split(entry['command'])
+
+    output = entry.get('output')
+    if output is None and '-o' in arguments[:-1]:
+        output = arguments[arguments.index('-o') + 1]
+
+    return file, directory, json.dumps(arguments), output
+
+def find_compile_command(path, build_path):
+    """
+    Return the compile command for the given source file in the given build 
+    directory, or None if the file isn't compiled in that build.  The command 
+    is returned as a CompileCommand object.
+    """
+    import json, sqlite3
+
+    index_path = get_index_path(build_path)
+    if not os.path.exists(index_path):
+        return None
+
+    db = sqlite3.connect('file:{}?mode=ro'.format(index_path), uri=True)
+    try:
+        row = db.execute(
+                'SELECT directory, arguments, output FROM commands WHERE file = ?',
+                (os.path.realpath(path),)).fetchone()
+    finally:
+        db.close()
+
+    if row is None:
+        return None
+
+    directory, arguments, output = row
+    return CompileCommand(
+            os.path.realpath(path), directory, json.loads(arguments), output)
+
+def get_compile_flags(path, build='debug', rosetta_path=None):
+    """
+    Return the flags (e.g. include paths, definitions, and warnings) used to 
+    compile the given source file in the given build, or None if the file 
+    isn't compiled in that build.  A relative path is taken to be relative to 
+    the 'source' directory, not the working directory.
+    """
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+    source_path = os.path.join(rosetta_path, 'source')
+    build_path = os.path.join(source_path, 'cmake', 'build_' + build)
+    command = find_compile_command(os.path.join(source_path, path), build_path)
+    return command.flags if command else None
+
+def get_json_path(build_path):
+    return os.path.join(build_path, 'compile_commands.json')
+
+def get_index_path(build_path):
+    return os.path.join(build_path, 'compile_commands.db')
+
+def is_older(path, reference):
+    """
+    Return true if the given path doesn't exist or is older than the reference.
+    """
+    if not os.path.exists(path):
+        return True
+    if not os.path.exists(reference):
+        return False
+    return os.path.getmtime(path) < os.path.getmtime(reference)
+
+
+class CompileCommand:
+    """
+    The command used to compile one source file, as recorded in 
+    'compile_commands.json'.
+    """
+
+    def __init__(self, path, directory, arguments, output):
+        self.path = path
+        self.directory = directory
+        self.arguments = arguments
+        self.output = output
+
+    def __repr__(self):
+        return 'CompileCommand({!r})'.format(self.path)
+
+    @property
+    def flags(self):
+        """
+        The arguments to the compiler, without the compiler itself, the input 
+        and output files, or the arguments that control dependency files.
+        """
+        flags = []
+        skip_next = False
+
+        for word in self.arguments[1:]:
+            if skip_next:
+                skip_next = False
+            elif word in ('-o', '-MF', '-MT', '-MQ'):
+                skip_next = True
+            elif word in ('-c', '-MD', '-MMD'):
+                continue
+            elif os.path.realpath(os.path.join(self.directory, word)) == os.path.realpath(self.path):
+                continue
+            else:
+                flags.append(word)
+
+        return flags
+
+
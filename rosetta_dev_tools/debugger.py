@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""\
+Start gdb on unit test binaries as quickly as possible.
+
+Most of the time gdb takes to start up on a big debug binary is spent building 
+an index of its debugging symbols.  That index only has to be built once per 
+link: either it's added to the binary itself (with 'gdb-add-index'), or gdb 
+saves it in an index cache keyed by the binary's build id, so that it's thrown 
+away as soon as the binary is relinked.
+
+Even with an index, loading the symbols still takes a while, so gdb can also be 
+kept running in a tmux session between runs of the same test.  Reattaching to 
+that session is instant, and gdb rereads the symbols on its own (using the 
+index) if the binary was relinked in the meantime.
+"""
+
+import os
+from . import helpers
+
+INDEX_SECTIONS = '.gdb_index', '.debug_names'
+INDEX_CACHE_SIZE = 5
+
+def get_index_cache_dir(rosetta_path=None):
+    return os.path.join(
+            rosetta_path or helpers.find_rosetta_installation(),
+            '.rdt_gdb_cache')
+
+def get_gdb_command(rosetta_path=None):
+    """
+    Return the command to start gdb with its index cache pointed at the 
+    directory where rdt keeps indices.  Versions of gdb older than 8.3 don't 
+    have an index cache, but they'll just complain and start normally.
+    """
+    cache_dir = get_index_cache_dir(rosetta_path)
+    return (
+            'gdb',
+            '-iex', 'set index-cache directory ' + cache_dir,
+            '-iex', 'set index-cache enabled on',
+    )
+
+def prepare_gdb_index(binary_path, rosetta_path=None, verbose=False):
+    """
+    Make sure gdb won't have to index the given binary from scratch.  Nothing 
+    needs to be done if the binary already has an index (e.g. because it was 
+    linked with '--gdb-index').  Otherwise the index is added to the binary 
+    with 'gdb-add-index' if it's installed, or else left for gdb to build and 
+    save in its index cache the first time it loads the binary.
+    """
+    import shutil
+
+    cache_dir = get_index_cache_dir(rosetta_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    prune_index_cache(cache_dir)
+
+    if has_index_section(binary_path):
+        return
+
+    if shutil.which('gdb-add-index'):
+        print("Indexing debug symbols in {} (only needed once per link)...".format(
+            os.path.basename(binary_path)))
+        command = 'gdb-add-index', binary_path
+        error_code = helpers.shell_command(
+                os.path.dirname(binary_path), command,
+                check=False, one_line=not verbose, verbose=verbose)
+        if not error_code:
+            return
+
+    if not os.path.exists(os.path.join(cache_dir, get_build_id(binary_path) + '.gdb-index')):
+        print("gdb will index {} and cache the result, so this startup will be slower than the next.".format(
+            os.path.basename(binary_path)))
+
+def has_index_section(binary_path):
+    """
+    Return true if the given binary has a section that gdb can use as an index 
+    for its debugging symbols.
+    """
+    import subprocess
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout = subprocess.check_output(
+                    ('readelf', '--section-headers', '--wide', binary_path),
+                    stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+    sections = {
+            word for line in stdout.decode(errors='replace').splitlines()
+            for word in line.replace('[', ' ').replace(']', ' ').split()
+    }
+    return any(x in sections for x in INDEX_SECTIONS)
+
+def get_build_id(binary_path):
+    """
+    Return the build id the linker stamped on the given binary, which is the 
+    same key gdb uses for its index cache.  If the binary doesn't have a build 
+    id, return a hash of its contents instead.
+    """
+    import subprocess, re, hashlib
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout = subprocess.check_output(
+                    ('readelf', '--notes', binary_path), stderr=devnull)
+        match = re.search(r'Build ID:\s*([0-9a-f]+)', stdout.decode(errors='replace'))
+        if match:
+            return match.group(1)
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    hash = hashlib.sha1()
+    with open(binary_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+def prune_index_cache(cache_dir, keep=INDEX_CACHE_SIZE):
+    """
+    Delete all but the most recently used indices from the cache.  Each index 
+    belongs to one link of one binary, and indices for multi-GB binaries are 
+    big, so there's no point keeping more than a few around.
+    """
+    indices = [
+            os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+            if x.endswith('.gdb-index')
+    ]
+    indices.sort(key=os.path.getmtime, reverse=True)
+
+    for path in indices[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def attach_gdb_session(name, directory, command, rosetta_path=None, verbose=False):
+    """
+    Attach to the tmux session running gdb for the given alias, starting it 
+    first if necessary.  The session is restarted if the test it was started 
+    for is different from the given command (e.g. because the alias was 
+    changed to point at a different test).  Detaching from the session (with 
+    Ctrl-b d) leaves gdb running, ready for the next run.
+    """
+    import shutil, json, subprocess
+
+    if not shutil.which('tmux'):
+        raise TmuxNotFound()
+
+    session = get_session_name(name)
+    signature = json.dumps([directory] + list(command))
+
+    if is_session_running(session):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                stdout = subprocess.check_output(
+                        ('tmux', 'show-environment', '-t', session, 'RDT_GDB_COMMAND'),
+                        stderr=devnull)
+        except subprocess.CalledProcessError:
+            stdout = b''
+        if stdout.decode().strip().partition('=')[2] != signature:
+            helpers.shell_command(
+                    directory, ('tmux', 'kill-session', '-t', session),
+                    verbose=verbose)
+
+    if not is_session_running(session):
+        gdb_command = get_gdb_command(rosetta_path) + ('--args',) + tuple(command)
+        helpers.shell_command(
+                directory,
+                ('tmux', 'new-session', '-d', '-s', session, '-c', directory) + gdb_command,
+                verbose=verbose)
+        helpers.shell_command(
+                directory,
+                ('tmux', 'set-environment', '-t', session, 'RDT_GDB_COMMAND', signature),
+                verbose=verbose)
+    else:
+        print("Reusing the gdb session for '{}'.".format(name))
+
+    print("Detach with Ctrl-b d to keep gdb running for next time.")
+    helpers.shell_command(
+            directory, ('tmux', 'attach-session', '-t', session),
+            check=False, interactive=True, verbose=verbose)
+
+def get_session_name(name):
+    import re
+    return 'rdt_gdb_' + re.sub(r'[^\w-]', '_', name)
+
+def is_session_running(session):
+    import subprocess
+
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(
+                ('tmux', 'has-session', '-t', session),
+                stdout=devnull, stderr=devnull) == 0
+
+
+class TmuxNotFound (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Can't keep a gdb session running because 'tmux' isn't installed."""
+
+    def __init__(self):
+        super().__init__()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""\
+Serve documentation generated by rdt_doxygen from a local web server.
+
+Each directory being served is watched for changes, and its documentation is 
+incrementally regenerated whenever one of its source files changes.  Every 
+HTML page is served with a small script that polls the server and reloads the 
+page once new documentation is ready.
+"""
+
+import os, threading, mimetypes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import doxygen
+
+RELOAD_SCRIPT = '''\
+<script>
+(function() {{
+    var version = "{version}";
+    setInterval(function() {{
+        var request = new XMLHttpRequest();
+        request.onload = function() {{
+            if (request.status == 200 && request.responseText != version) {{
+                location.reload();
+            }}
+        }};
+        request.open("GET", "/__version__/{key}");
+        request.send();
+    }}, 1000);
+}})();
+</script>
+'''
+
+def serve_documentation(target_dirs, port=8000, open_browser=True, poll_interval=1.0, **kwargs):
+    """
+    Generate documentation for each of the given directories, then serve it on 
+    the given port until the user presses Ctrl-C.  Any keyword arguments are 
+    passed on to doxygen.generate_documentation().
+    """
+    import subprocess
+
+    # Generate the documentation for each directory once before starting the 
+    # server, so there's something to look at right away.  Only honor --force 
+    # for this first round.
+
+    force = kwargs.pop('force', False)
+    sites = {}
+
+    for target_dir in target_dirs:
+        site = DocSite(target_dir, **kwargs)
+        site.regenerate(force=force)
+        sites[site.key] = site
+
+    # Start a thread for each directory that watches for changes to its source 
+    # files.  The threads are daemons, so they'll die with the server.
+
+    for site in sites.values():
+        thread = threading.Thread(
+                target=site.watch, args=(poll_interval,), daemon=True)
+        thread.start()
+
+    # Serve the documentation.  Only listen on the loopback interface, since 
+    # this is only meant to be seen by the person running the command.
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), DocRequestHandler)
+    server.daemon_threads = True
+    server.sites = sites
+
+    if len(sites) == 1:
+        site = next(iter(sites.values()))
+        url = 'http://localhost:{}/{}/{}'.format(port, site.key, site.index)
+    else:
+        url = 'http://localhost:{}/'.format(port)
+
+    print("Serving documentation at {}".format(url))
+    print("Press Ctrl-C to stop.")
+
+    if open_browser:
+        subprocess.Popen(('firefox', '-new-window', url))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class DocSite:
+    """
+    One directory being served, along with the version number of its current 
+    documentation.  The version is bumped every time the documentation is 
+    regenerated, which is how open pages know to reload.
+    """
+
+    def __init__(self, target_dir, **kwargs):
+        self.target_dir = target_dir
+        self.output_dir = doxygen.get_output_dir(target_dir)
+        self.key = os.path.basename(self.output_dir)
+        self.kwargs = kwargs
+        self.version = 0
+        self.index = ''
+        self.snapshot = None
+
+    def regenerate(self, force=False):
+        self.snapshot = self.take_snapshot()
+        index_html = doxygen.generate_documentation(
+                self.target_dir, force=force, **self.kwargs)
+        self.index = os.path.relpath(index_html, self.output_dir)
+        self.version += 1
+
+    def watch(self, poll_interval):
+        import time, traceback
+
+        while True:
+            time.sleep(poll_interval)
+
+            if self.take_snapshot() == self.snapshot:
+                continue
+
+            # Keep watching even if doxygen fails, so the user can fix whatever 
+            # the problem was without restarting the server.
+
+            try:
+                self.regenerate()
+            except Exception:
+                traceback.print_exc()
+
+    def take_snapshot(self):
+        """
+        Return the size and modification time of every source file in the 
+        directory.  This is much cheaper than hashing the files, and is only 
+        used to decide when it's worth asking doxygen.py to look for changes.
+        """
+        snapshot = {}
+        recursive = self.kwargs.get('recursive', False)
+
+        for path in doxygen.find_source_files(self.target_dir, recursive):
+            try:
+                stat = os.stat(path)
+                snapshot[path] = stat.st_mtime_ns, stat.st_size
+            except FileNotFoundError:
+                pass
+
+        return snapshot
+
+
+class DocRequestHandler (BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        from urllib.parse import urlsplit, unquote
+
+        path = unquote(urlsplit(self.path).path)
+        parts = path.strip('/').split('/', 1)
+        sites = self.server.sites
+
+        # The root page lists every directory being served.
+
+        if path == '/':
+            return self.send_listing()
+
+        # Open pages poll this URL to find out when they should reload.
+
+        if parts[0] == '__version__' and len(parts) == 2 and parts[1] in sites:
+            return self.send_content(
+                    str(sites[parts[1]].version).encode(), 'text/plain')
+
+        if parts[0] not in sites:
+            return self.send_error(404)
+
+        # Everything else is a file in one of the output directories.  Make 
+        # sure the request can't escape from that directory.
+
+        site = sites[parts[0]]
+
+        # Send requests for the directory itself to the index page, so that 
+        # the relative links in the page resolve inside the directory.  There 
+        # isn't one until the documentation has been generated once.
+
+        if len(parts) == 1 or not parts[1]:
+            if not site.index:
+                return self.send_error(404)
+            return self.send_redirect('/{}/{}'.format(site.key, site.index))
+
+        rel_path = parts[1]
+        file_path = os.path.realpath(os.path.join(site.output_dir, rel_path))
+
+        if not file_path.startswith(os.path.realpath(site.output_dir) + os.sep):
+            return self.send_error(403)
+        if not os.path.isfile(file_path):
+            return self.send_error(404)
+
+        with open(file_path, 'rb') as file:
+            content = file.read()
+
+        content_type = mimetypes.guess_type(file_path)[0]
+        content_type = content_type or 'application/octet-stream'
+
+        if content_type == 'text/html':
+            script = RELOAD_SCRIPT.format(version=site.version, key=site.key)
+            content = inject_script(content, script.encode())
+
+        self.send_content(content, content_type)
+
+    def send_listing(self):
+        from html import escape
+
+        links = [
+                '<li><a href="/{}/{}">{}</a></li>'.format(
+                    escape(key), escape(site.index), escape(site.target_dir))
+                for key, site in sorted(self.server.sites.items())
+        ]
+        content = '<html><body><h1>Documentation</h1><ul>\n{}\n</ul></body></html>'
+        content = content.format('\n'.join(links))
+        self.send_content(content.encode(), 'text/html')
+
+    def send_redirect(self, location):
+        from urllib.parse import quote
+
+        self.send_response(301)
+        self.send_header('Location', quote(location))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_content(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request; the reload polling would 
+        # drown out the doxygen output.
+        pass
+
+def inject_script(content, script):
+    index = content.rfind(b'</body>')
+    if index < 0:
+        return content + script
+    return content[:index] + script + content[index:]
+
+
@@ -3,12 +3,18 @@
 """\
 Generate documentation for a small number of files you're actively developing.
 
+The documentation is kept in a persistent directory for each target directory, 
+and doxygen is only re-run on the parts of that directory that have changed 
+since the last time this command was run.  The unchanged parts are linked 
+against using doxygen tag files.
+
 Usage:
-    rdt_doxygen [<directory>] [options]
+    rdt_doxygen [<directory>...] [options]
 
 Arguments:
     <directory>         [default: .]
-        The directory to generate documentation for.
+        The directory to generate documentation for.  More than one directory 
+        can be given, in which case each is documented separately.
 
 Options:
     -r, --recursive
@@ -21,39 +27,536 @@ Options:
         command, because otherwise you'd have to open a web browser window 
         yourself.  After that, though, you would specify this option and reuse 
         the window you already have.
+
+    -j, --jobs NUM
+        The number of doxygen processes to run at once.  Each unit of the 
+        target directory (see --shard-depth) is documented by its own process.  
+        By default, one process is run for each CPU.
+
+    -d, --shard-depth NUM       [default: 1]
+        How deep into the target directory to split it into separately 
+        documented units, when --recursive is given.  Each directory at this 
+        depth (and everything below it) becomes one unit, while the directories 
+        above it are documented without their subdirectories.  Splitting a big 
+        tree more finely lets more of it be documented in parallel.
+
+    -s, --serve
+        Serve the documentation from a local web server, and keep regenerating 
+        it whenever the source files change.  Any page open in a browser will 
+        reload itself as soon as the new documentation is ready.  If several 
+        directories are given, they are all served at once.
+
+    -p, --port NUM              [default: 8000]
+        The port to serve the documentation from, if --serve is given.
+
+    -f, --force
+        Discard any previously generated documentation for this directory and 
+        regenerate everything from scratch.
+
+    -v, --verbose
+        Output each command line that gets run, along with all of the output 
+        from doxygen, in case something needs to be debugged.
 """
 
-import os, shutil, docopt
+import os
 from . import helpers
 
+OUTPUT_ROOT = '/tmp/rosetta_doxygen'
+SOURCE_EXTENSIONS = '.hh', '.cc', '.ihh', '.h', '.hpp', '.cpp'
+
 def main():
-    args = docopt.docopt(__doc__)
-    target_dir = args['<directory>'] or '.'
+    args = helpers.parse_args(__doc__)
+    target_dirs = [os.path.abspath(x) for x in args['<directory>'] or ['.']]
+    doxygen_kwargs = dict(
+            recursive=args['--recursive'],
+            shard_depth=int(args['--shard-depth']),
+            nprocs=int(args['--jobs'] or os.cpu_count() or 1),
+            verbose=args['--verbose'],
+    )
+
+    try:
+        if args['--serve']:
+            from .doc_server import serve_documentation
+            serve_documentation(
+                    target_dirs,
+                    port=int(args['--port']),
+                    open_browser=not args['--quiet'],
+                    force=args['--force'],
+                    **doxygen_kwargs
+            )
+            return
+
+        for target_dir in target_dirs:
+            index_html = generate_documentation(
+                    target_dir, force=args['--force'], **doxygen_kwargs)
+
+            # Show the resulting documentation in a Firefox window (unless the 
+            # user specified '-q').
+
+            if not args['--quiet']:
+                firefox_command = 'firefox', '-new-window', index_html
+                helpers.shell_command(target_dir, firefox_command)
+
+    except KeyboardInterrupt:
+        helpers.exit_interrupted()
+
+    except helpers.FatalBuildError as error:
+        error.exit_gracefully()
+
+def generate_documentation(target_dir, recursive=False, shard_depth=1, nprocs=1, force=False, verbose=False):
+    """
+    Run doxygen on every part of the given directory that has changed since the 
+    last time documentation was generated for it, and return the path to the 
+    HTML page that should be shown to the user.
+    """
+
+    # Find the persistent output directory for the target directory, and make 
+    # sure no other process is updating it at the same time.
+
+    output_dir = get_output_dir(target_dir)
+    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+
+    with lock_output_dir(output_dir):
+        return update_documentation(
+                target_dir, output_dir, recursive, shard_depth, nprocs, force,
+                verbose)
+
+def update_documentation(target_dir, output_dir, recursive, shard_depth, nprocs, force, verbose):
+    import shutil
+
+    # If the user asked to start from scratch, remove anything that was 
+    # generated previously.
+
+    if force and os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Split the target directory into units that can be documented 
+    # independently, then hash the input files for each unit to figure out 
+    # which ones have changed.
+
+    manifest = load_manifest(output_dir)
+    units = find_doc_units(target_dir, output_dir, recursive, shard_depth)
+
+    for unit in units:
+        unit.hash_inputs(manifest.get(unit.name, {}).get('files', {}))
+
+    # Forget about any units that were documented previously but that no 
+    # longer exist, e.g. because the --recursive flag changed.
+
+    unit_names = {unit.name for unit in units}
+    for name in list(manifest):
+        if name not in unit_names:
+            stale_dir = os.path.join(output_dir, 'units', manifest[name]['slug'])
+            shutil.rmtree(stale_dir, ignore_errors=True)
+            del manifest[name]
+
+    stale_units = [x for x in units if x.is_stale(manifest)]
+
+    if not stale_units:
+        print("Documentation is up to date.")
+
+    # Units that have never been documented don't have tag files yet, so the 
+    # other units wouldn't be able to link to them.  Generate just the tag 
+    # files for those units first.  This is much faster than generating the 
+    # HTML, because doxygen doesn't have to render any pages or sources.
+
+    untagged_units = [x for x in stale_units if not os.path.exists(x.tag_file)]
+
+    if len(untagged_units) > 1:
+        run_doxygen_in_parallel(
+                untagged_units, units, nprocs, tags_only=True, verbose=verbose)
+
+    # Run doxygen on each unit that changed.  The manifest is saved after each 
+    # unit, so an interrupted run doesn't lose the work that was finished.
+
+    def on_unit_finished(unit):
+        manifest[unit.name] = unit.to_manifest()
+        save_manifest(output_dir, manifest)
+
+    run_doxygen_in_parallel(
+            stale_units, units, nprocs,
+            on_finished=on_unit_finished, verbose=verbose)
+
+    return write_index(output_dir, target_dir, units)
+
+def get_output_dir(target_dir):
+    """
+    Return the directory where documentation for the given directory should be 
+    kept.  The directory is keyed by the absolute path of the target, so that 
+    documentation for different directories never collides.
+    """
+    import hashlib
+
+    target_dir = os.path.realpath(target_dir)
+    key = hashlib.sha1(target_dir.encode('utf8')).hexdigest()[:10]
+    name = '{}-{}'.format(os.path.basename(target_dir) or 'root', key)
+    return os.path.join(OUTPUT_ROOT, name)
+
+def lock_output_dir(output_dir):
+    """
+    Return a context manager that holds an exclusive lock on the given output 
+    directory.  The lock file is kept next to the output directory rather than 
+    in it, so that --force can delete the whole directory while holding it.
+    """
+    import fcntl, contextlib
+
+    @contextlib.contextmanager
+    def lock():
+        with open(output_dir + '.lock', 'w') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    return lock()
+
+def find_source_files(target_dir, recursive=False):
+    """
+    Return the paths of all the source files in the given directory (and its 
+    subdirectories, if <recursive> is set) that doxygen would document.
+    """
+    if not recursive:
+        return [os.path.join(target_dir, x)
+                for x in sorted(os.listdir(target_dir))
+                if x.endswith(SOURCE_EXTENSIONS)
+                and os.path.isfile(os.path.join(target_dir, x))]
+
+    paths = []
+    for dir, subdirs, files in os.walk(target_dir):
+        subdirs[:] = sorted(x for x in subdirs if not x.startswith('.'))
+        paths += [os.path.join(dir, x)
+                for x in sorted(files) if x.endswith(SOURCE_EXTENSIONS)]
+    return paths
+
+def find_doc_units(target_dir, output_dir, recursive=False, shard_depth=1):
+    """
+    Split the target directory into units that doxygen will be run on 
+    separately.  Without --recursive there is just one unit, containing the 
+    source files directly in the target directory.  With --recursive, each 
+    directory <shard_depth> levels below the target becomes its own unit, so a 
+    change in one subdirectory doesn't require the others to be regenerated, 
+    and so the units can be documented in parallel.
+    """
+    units = []
+
+    def add_units(rel_path, depth):
+        if not recursive or depth < shard_depth:
+            units.append(DocUnit(target_dir, output_dir, rel_path, recursive=False))
+        else:
+            units.append(DocUnit(target_dir, output_dir, rel_path, recursive=True))
+            return
+
+        if recursive:
+            path = os.path.join(target_dir, rel_path)
+            for subdir in sorted(os.listdir(path)):
+                if os.path.isdir(os.path.join(path, subdir)) and not subdir.startswith('.'):
+                    add_units(os.path.normpath(os.path.join(rel_path, subdir)), depth + 1)
+
+    add_units('.', 0)
+    return [x for x in units if x.find_inputs()]
+
+def run_doxygen_in_parallel(units, all_units, nprocs, on_finished=None, tags_only=False, verbose=False):
+    """
+    Run doxygen on each of the given units, with up to <nprocs> doxygen 
+    processes running at once.  The optional <on_finished> callback is invoked 
+    for each unit as soon as it's done.
+    """
+    import asyncio, subprocess
+    from . import processes
+
+    async def run_one(unit, limiter):
+        async with limiter:
+            doxyfile = write_doxyfile(unit, all_units, tags_only, verbose)
+            result = await processes.run_process(
+                    ('doxygen', doxyfile), unit.unit_dir, verbose=verbose)
 
-    # Make a temporary directory for the doxygen build.
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(
+                    result.returncode, result.command)
+        if on_finished:
+            on_finished(unit)
 
-    root = '/tmp/rosetta_doxygen'
-    html = os.path.join(root, 'html', 'annotated.html')
-    if os.path.exists(root):
-        shutil.rmtree(root)
-    os.mkdir(root)
+    # The Doxyfile for each unit is written just before doxygen is started, 
+    # so that it links to the tag files of any units that finished before it.  
+    # If one unit fails, the others are cancelled, which kills their doxygen 
+    # processes.
 
-    # Run doxygen on the specified directory, then show the resulting 
-    # documentation in a Firefox window (unless the user specified '-q').
+    async def run_all():
+        limiter = asyncio.Semaphore(max(nprocs, 1))
+        tasks = [asyncio.ensure_future(run_one(x, limiter)) for x in units]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    processes.run(run_all())
+
+def write_doxyfile(unit, all_units, tags_only=False, verbose=False):
+    """
+    Write the doxygen configuration file for the given unit and return its 
+    path.
+    """
+    import shutil
+
+    # Clear out the HTML from the last run, so that pages for classes that have 
+    # since been removed don't linger.
+
+    if os.path.exists(unit.html_dir) and not tags_only:
+        shutil.rmtree(unit.html_dir)
+    os.makedirs(unit.unit_dir, exist_ok=True)
+
+    # Write a configuration file for doxygen.  Each unit gets its own tag file, 
+    # and references to the other units are resolved through their tag files.  
+    # The locations in TAGFILES are relative to this unit's html/ directory.
+
+    tag_files = []
+    for other in all_units:
+        if other is not unit and os.path.exists(other.tag_file):
+            html_location = os.path.relpath(other.html_dir, unit.html_dir)
+            tag_files.append(quote('{}={}'.format(other.tag_file, html_location)))
 
     doxygen_config = [
-            'OUTPUT_DIRECTORY = ' + root,
+            'PROJECT_NAME = ' + quote(unit.title),
+            'OUTPUT_DIRECTORY = ' + quote(unit.unit_dir),
+            'INPUT = ' + ' '.join(quote(x) for x in unit.input_paths),
+            'FILE_PATTERNS = ' + ' '.join('*' + x for x in SOURCE_EXTENSIONS),
+            'RECURSIVE = ' + ('YES' if unit.recursive else 'NO'),
+            'STRIP_FROM_PATH = ' + quote(unit.target_dir),
             'EXTRACT_ALL = YES',
             'EXTRACT_PRIVATE = YES',
-            'RECURSIVE = ' + 'YES' if not args['--recursive'] else 'NO',
             'SOURCE_BROWSER = YES',
             'INLINE_SOURCES = YES',
-            'GENERATE_HTML = YES',
+            'GENERATE_HTML = ' + ('NO' if tags_only else 'YES'),
+            'GENERATE_LATEX = NO',
+            'GENERATE_TAGFILE = ' + quote(unit.tag_file),
+            'TAGFILES = ' + ' '.join(tag_files),
+            'QUIET = ' + ('NO' if verbose else 'YES'),
+            'WARN_LOGFILE = ' + quote(os.path.join(unit.unit_dir, 'warnings.log')),
     ]
-    doxygen_command =  'echo "{}" | doxygen -'.format('\n'.join(doxygen_config))
-    firefox_command = 'firefox -new-window {}'.format(html)
+    doxyfile = os.path.join(
+            unit.unit_dir, 'Doxyfile.tags' if tags_only else 'Doxyfile')
+    with open(doxyfile, 'w') as file:
+        file.write('\n'.join(doxygen_config) + '\n')
+
+    if tags_only:
+        print("Indexing {}".format(unit.title))
+    else:
+        print("Documenting {}".format(unit.title))
+    return doxyfile
+
+def write_index(output_dir, target_dir, units):
+    """
+    Return the page that should be shown to the user.  If there's only one 
+    unit, that's simply its list of classes.  Otherwise, merge the tag files 
+    from every unit into a single index linking to the namespaces, classes, and 
+    files documented by all of the units.
+    """
+    from html import escape
+
+    if len(units) == 1:
+        return os.path.join(units[0].html_dir, 'annotated.html')
+
+    sections = [
+            ('Namespaces', ('namespace',)),
+            ('Classes', ('class', 'struct', 'union')),
+            ('Files', ('file',)),
+            ('Units', ()),
+    ]
+    entries = {title: [] for title, kinds in sections}
+
+    for unit in units:
+        href = os.path.relpath(
+                os.path.join(unit.html_dir, 'annotated.html'), output_dir)
+        entries['Units'].append((unit.title, href, ''))
+
+        for kind, name, filename in read_tag_file(unit.tag_file):
+            href = os.path.relpath(
+                    os.path.join(unit.html_dir, filename), output_dir)
+            for title, kinds in sections:
+                if kind in kinds:
+                    entries[title].append((name, href, unit.title))
+
+    # Namespaces often span several units, so only link to the first unit that 
+    # documents each one.  Files and classes are listed once per unit.
+
+    body = []
+    for title, kinds in sections:
+        seen = set()
+        items = []
+        for name, href, source in sorted(entries[title]):
+            if title == 'Namespaces' and name in seen:
+                continue
+            seen.add(name)
+            items.append('<li><a href="{}">{}</a> <small>{}</small></li>'.format(
+                escape(href), escape(name), escape(source)))
+
+        if items:
+            body.append('<h2>{}</h2>\n<ul>\n{}\n</ul>'.format(
+                title, '\n'.join(items)))
+
+    index_html = os.path.join(output_dir, 'index.html')
+    with open(index_html, 'w') as file:
+        file.write('''\
+<html>
+<head><title>{0}</title></head>
+<body>
+<h1>{0}</h1>
+{1}
+</body>
+</html>
+'''.format(escape(target_dir), '\n'.join(body)))
+
+    return index_html
+
+def read_tag_file(tag_file):
+    """
+    Yield the kind, name, and HTML file of each top-level compound (e.g.  
+    namespace, class, or file) described by the given doxygen tag file.
+    """
+    import xml.etree.ElementTree as ElementTree
+
+    try:
+        tree = ElementTree.parse(tag_file)
+    except (IOError, ElementTree.ParseError):
+        return
+
+    for compound in tree.getroot().iter('compound'):
+        name = compound.findtext('name')
+        filename = compound.findtext('filename')
+        if not name or not filename:
+            continue
+
+        # Newer versions of doxygen leave the extension off of the file names 
+        # in tag files.
+
+        if not os.path.splitext(filename)[1]:
+            filename += '.html'
+
+        yield compound.get('kind'), name, filename
+
+def load_manifest(output_dir):
+    import json
+
+    path = os.path.join(output_dir, 'manifest.json')
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    import json
+
+    # Write to a temporary file and then move it into place, so that the 
+    # manifest is never left half-written if the command is interrupted.
+
+    path = os.path.join(output_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def hash_file(path):
+    import hashlib
+
+    hash = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+def quote(value):
+    return '"{}"'.format(value) if ' ' in value else value
+
+
+class DocUnit:
+    """
+    A part of the target directory that gets its own doxygen run, its own HTML 
+    output, and its own tag file.
+    """
+
+    def __init__(self, target_dir, output_dir, rel_path, recursive):
+        self.target_dir = target_dir
+        self.rel_path = rel_path
+        self.recursive = recursive
+        self.name = rel_path
+        self.slug = '__root__' if rel_path == '.' else rel_path.replace(os.sep, '.')
+        self.unit_dir = os.path.join(output_dir, 'units', self.slug)
+        self.html_dir = os.path.join(self.unit_dir, 'html')
+        self.tag_file = os.path.join(self.unit_dir, self.slug + '.tag')
+        self.input_paths = []
+        self.files = {}
+
+    def __repr__(self):
+        return 'DocUnit({})'.format(self.name)
+
+    @property
+    def title(self):
+        root_name = os.path.basename(self.target_dir)
+        if self.rel_path == '.':
+            return root_name
+        return os.path.join(root_name, self.rel_path)
+
+    def find_inputs(self):
+        """
+        Find all the source files that belong to this unit, and return them as 
+        a list of paths relative to the target directory.
+        """
+        root = os.path.normpath(os.path.join(self.target_dir, self.rel_path))
+        inputs = find_source_files(root, self.recursive)
+
+        if self.recursive:
+            self.input_paths = [root] if inputs else []
+        else:
+            self.input_paths = inputs
+
+        self.inputs = [os.path.relpath(x, self.target_dir) for x in inputs]
+        return self.inputs
+
+    def hash_inputs(self, previous_files):
+        """
+        Record a content hash for each input file.  Files whose size and 
+        modification time haven't changed since the previous run reuse the 
+        previous hash, so unchanged files don't have to be read again.
+        """
+        self.files = {}
+
+        for rel_path in self.inputs:
+            path = os.path.join(self.target_dir, rel_path)
+            stat = os.stat(path)
+            previous = previous_files.get(rel_path)
+
+            if previous and previous[:2] == [stat.st_mtime, stat.st_size]:
+                self.files[rel_path] = previous
+            else:
+                self.files[rel_path] = [
+                        stat.st_mtime, stat.st_size, hash_file(path)]
+
+    def is_stale(self, manifest):
+        if self.name not in manifest:
+            return True
+        if not os.path.exists(self.tag_file):
+            return True
+        if not os.path.exists(os.path.join(self.html_dir, 'annotated.html')):
+            return True
+
+        previous = manifest[self.name]
+        if previous.get('recursive') != self.recursive:
+            return True
+
+        previous_hashes = {k: v[2] for k, v in previous['files'].items()}
+        current_hashes = {k: v[2] for k, v in self.files.items()}
+        return previous_hashes != current_hashes
+
+    def to_manifest(self):
+        return {
+                'slug': self.slug,
+                'recursive': self.recursive,
+                'files': self.files,
+        }
 
-    helpers.shell_command(target_dir, doxygen_command)
-    if not args['--quiet']:
-        helpers.shell_command(target_dir, firefox_command)
 
@@ -4,9 +4,11 @@ import os
 
 def find_rosetta_installation():
     import subprocess
+    from . import tracing
 
     try: 
-        with open(os.devnull, 'w') as devnull:
+        with open(os.devnull, 'w') as devnull, \
+                tracing.span('find_rosetta_installation'):
             command = 'git', 'rev-parse', '--show-toplevel'
             stdout = subprocess.check_output(command, stderr=devnull)
             path = stdout.strip()
@@ -16,50 +18,142 @@ def find_rosetta_installation():
 
     return path.decode('utf8')
 
-def shell_command(directory, command, check=True, one_line=False, verbose=False):
+def get_rosetta_commit(rosetta_path=None):
+    """
+    Return the hash of the commit currently checked out in the given rosetta 
+    installation, or None if it can't be determined.
+    """
+    import subprocess
+
+    rosetta_path = rosetta_path or find_rosetta_installation()
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            command = 'git', 'rev-parse', 'HEAD'
+            stdout = subprocess.check_output(
+                    command, cwd=rosetta_path, stderr=devnull)
+            return stdout.strip().decode('utf8')
+
+    except subprocess.CalledProcessError:
+        return None
+
+def parse_args(doc, argv=None):
+    """
+    Parse the command line with docopt.  Requests for help are answered 
+    without importing docopt, since printing the usage message is the one 
+    thing every command should do instantly.
+    """
+    import sys
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if '-h' in argv or '--help' in argv:
+        print(doc.strip('\n'))
+        sys.exit()
+
+    import docopt
+    return docopt.docopt(doc, argv)
+
+def shell_command(directory, command, check=True, one_line=False, interactive=False, verbose=False):
     """
     Executes the given command in the given directory.  The command can either 
-    be given as a string or a list of words.  If the check flag is set, an 
-    exception will be raised if the command returns a non-zero value.  If the 
-    one_line flag is set, the output will be kept on one line.
+    be given as a string, which is interpreted by the shell, or a list of 
+    words, which is executed directly.  If the check flag is set, an exception 
+    will be raised if the command returns a non-zero value.  If the one_line 
+    flag is set, the output will be kept on one line.  The interactive flag 
+    must be set for commands that need to control the terminal.
+    """
+    import subprocess
+    from . import processes
+
+    result = processes.run(processes.run_process(
+            command, directory,
+            on_line=update_one_line if one_line else None,
+            interactive=interactive,
+            verbose=verbose))
+
+    if one_line:
+        print()
+
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command)
+
+    return result.returncode
+
+def exit_interrupted():
+    """
+    Exit after the user pressed Ctrl-C.  Every command's main() calls this 
+    when it catches KeyboardInterrupt.  By then, any processes that were 
+    running have been killed, because processes.run() cancels its tasks 
+    before the interrupt gets this far.  The exit status is the one a shell 
+    would use for a command killed by Ctrl-C, so that scripts don't mistake 
+    an interrupted command for a successful one.
+    """
+    import sys
+
+    print()
+    sys.exit(130)
+
+def update_one_line(line):
+    """
+    Overwrite whatever was printed on the current line of the terminal with 
+    the given line.
+    """
+    import nonstdlib
+
+    line = line.replace('\n', ' ')
+    line = nonstdlib.truncate_to_fit_terminal(line)
+    if line.strip():
+        nonstdlib.update(line)
+
+def measured_shell_command(directory, command, check=True, one_line=False, verbose=False):
+    """
+    Executes the given command exactly like shell_command(), but returns a 
+    ProcessUsage object describing how long the command took and how many 
+    resources it used, rather than just the return code.
     """
 
-    import select, subprocess, shlex, nonstdlib
+    import time, subprocess, shlex
+    from . import tracing
 
-    # If the command was given as a tuple, turn it into a string that can be 
-    # interpreted by the shell.  This creates a shell injection vulnerability, 
-    # but since all the variable arguments come directly from the user, I think 
-    # it's worth the added flexibility afforded by using the shell.
+    # This doesn't go through the asyncio layer in processes.py, because 
+    # asyncio reaps its own child processes, and the resource usage reported 
+    # when a process is reaped is exactly what this function needs.
 
-    if isinstance(command, tuple) or isinstance(command, list):
-        command = ' '.join(shlex.quote(x) for x in command)
+    is_shell = isinstance(command, str)
+    description = command if is_shell else ' '.join(shlex.quote(x) for x in command)
 
     # If verbose output is requested, print the command being run and the 
     # directory its being run from.
 
     if verbose:
         print('$ cd', directory)
-        print('$', command)
+        print('$', description)
 
     # Run the command.  If the one_line option is given, grab every line 
     # printed to stdout and force it to overwrite the previous line.  Otherwise 
     # just run the command like normal.
 
-    process = subprocess.Popen(
-            command, cwd=directory, shell=True,
-            stdout=subprocess.PIPE if one_line else None)
+    span = tracing.span(
+            'process: ' + os.path.basename(description.split()[0]),
+            command=description, directory=directory)
 
-    if not one_line:
-        process.wait()
-    else:
-        while process.poll() is None:
-            select.select([process.stdout.fileno()], [], [])
-            stdout = process.stdout.readline().decode()
-            stdout = stdout.replace('\n', ' ')
-            stdout = nonstdlib.truncate_to_fit_terminal(stdout)
-            if stdout.strip():
-                nonstdlib.update(stdout)
-        print()
+    with span:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(
+                command, cwd=directory, shell=is_shell,
+                stdout=subprocess.PIPE if one_line else None)
+
+        if one_line:
+            for stdout in iter(process.stdout.readline, b''):
+                update_one_line(stdout.decode(errors='replace'))
+            print()
+
+        # Reap the process with wait4() rather than wait(), because wait4() 
+        # also reports the resources used by the process (and by any children 
+        # it waited for, e.g. when the command is run through a shell).
+
+        usage = ProcessUsage(process, start_time)
 
     # Check the return code to see if the command failed.  If it did and the 
     # 'check' flag is set, raise an exception.  Otherwise just pass the return 
@@ -68,7 +162,61 @@ def shell_command(directory, command, check=True, one_line=False, verbose=False)
     if check and process.returncode != 0:
         raise subprocess.CalledProcessError(process.returncode, command)
 
-    return process.returncode
+    return usage
+
+class ProcessUsage:
+    """
+    The wall time, CPU time, peak memory, and page faults of a child process, 
+    as reported by wait4() when the process was reaped.
+    """
+
+    def __init__(self, process, start_time):
+        import time
+
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = decode_wait_status(status)
+
+        self.returncode = process.returncode
+        self.wall_time = time.perf_counter() - start_time
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss * 1024  # Linux reports kilobytes.
+        self.minor_faults = rusage.ru_minflt
+        self.major_faults = rusage.ru_majflt
+
+    def __repr__(self):
+        return 'ProcessUsage(returncode={0.returncode}, wall_time={0.wall_time:.3f}, max_rss={0.max_rss})'.format(self)
+
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
+
+    def to_dict(self):
+        return dict(
+                wall_time=self.wall_time,
+                user_time=self.user_time,
+                system_time=self.system_time,
+                max_rss=self.max_rss,
+                minor_faults=self.minor_faults,
+                major_faults=self.major_faults,
+        )
+
+def decode_wait_status(status):
+    """
+    Convert a status from os.wait*() into a return code, following the same 
+    convention as subprocess (i.e. negative for processes killed by signals).
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+def format_bytes(num_bytes):
+    for unit in 'B', 'KB', 'MB', 'GB':
+        if abs(num_bytes) < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024
+    return '{:.1f} TB'.format(num_bytes)
 
 class FatalBuildError (Exception):
 
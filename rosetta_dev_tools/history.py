@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""\
+Keep a record of the tests and benchmarks that have been run in a rosetta 
+checkout, so that later runs can be compared against earlier ones.
+
+The history is stored in '.rdt_history' in the root of the checkout, right 
+next to '.rdt_state.sqlite'.  Each line of that file is one JSON record, and 
+new records are only ever appended, so the file never has to be rewritten and 
+concurrent runs can't clobber each other's results.
+"""
+
+import os, json
+from . import helpers
+
+def get_history_path():
+    rosetta_path = helpers.find_rosetta_installation()
+    return os.path.join(rosetta_path, '.rdt_history')
+
+def add_record(kind, **fields):
+    """
+    Append a record of the given kind to the history, and return it.  The 
+    current time and git commit are added to the record automatically.
+    """
+    import time
+
+    record = dict(fields)
+    record['kind'] = kind
+    record.setdefault('time', time.time())
+    record.setdefault('commit', helpers.get_rosetta_commit())
+
+    # Write the whole record with a single call, so that records from 
+    # concurrent processes don't get interleaved.
+
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with open(get_history_path(), 'a') as file:
+        file.write(line)
+
+    return record
+
+def find_records(kind=None, **fields):
+    """
+    Return every record of the given kind with the given field values, oldest 
+    first.  Lines that can't be parsed (e.g. because a run was killed while 
+    writing it) are skipped.
+    """
+    records = []
+
+    try:
+        file = open(get_history_path())
+    except FileNotFoundError:
+        return records
+
+    with file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            if kind is not None and record.get('kind') != kind:
+                continue
+            if any(record.get(k) != v for k, v in fields.items()):
+                continue
+
+            records.append(record)
+
+    return records
+
@@ -0,0 +1,692 @@
+#!/usr/bin/env python3
+
+"""\
+Run rosetta's integration tests in parallel and compare them to the reference.
+
+Each test in 'source/test/integration/tests' is copied into 'new/<test>' and 
+its command is run there, just like 'integration.py' does, except that several 
+tests run at once.  The output of every test that passes is also saved in 
+'.rdt_integration' in the root of your checkout, keyed by a hash of the test's 
+inputs (including any scripts or other files in 'source' that its command 
+mentions) and of the binaries it runs.  If neither has changed since the last 
+run, the saved output is copied into 'new/<test>' instead of running the test 
+again.  Tests whose commands mention directories in 'source' (other than their 
+own) are always run, since there's no telling which files they read.
+
+The output of each test is then compared to 'ref/<test>'.  Files are compared 
+by size and hash first (and the hashes are remembered, so the reference files 
+usually aren't read at all), and only the files that actually differ are 
+diffed.
+
+Usage:
+    rdt_integration [<tests>...] [options]
+
+Arguments:
+    <tests>
+        The names of the integration tests to run.  By default, every test is 
+        run.
+
+Options:
+    -b, --build <build>         [default: release]
+        Which build configuration to compile and test.
+
+    -j, --jobs NUM
+        How many tests to run at once.  By default, one test is run per CPU.  
+        This is also the number of jobs used to build rosetta.
+
+    -n, --no-build
+        Don't build rosetta before running the tests.
+
+    -f, --rerun
+        Run every test, even if its output was saved from an earlier run with 
+        the same inputs and binaries.
+
+    -t, --timeout SECONDS       [default: 1800]
+        Kill any test that runs for longer than this.
+
+    -r, --save-ref
+        Replace the reference output of each test that passes with its new 
+        output, e.g. after running the tests on master.
+
+    -d, --diff-lines NUM        [default: 20]
+        How many lines of each differing file to show.
+
+    -v, --verbose
+        Output each command line that gets run, in case something needs to be 
+        debugged.
+"""
+
+import sys, os
+from . import helpers
+
+DIFF_CONTEXT = 3
+HASH_CHUNK_SIZE = 1 << 20
+
+def main():
+    args = helpers.parse_args(__doc__)
+
+    try:
+        num_problems = run_integration_tests(
+                args['<tests>'],
+                build=args['--build'],
+                nprocs=args['--jobs'],
+                skip_build=args['--no-build'],
+                rerun=args['--rerun'],
+                timeout=float(args['--timeout']),
+                save_ref=args['--save-ref'],
+                diff_lines=int(args['--diff-lines']),
+                verbose=args['--verbose'],
+        )
+        sys.exit(1 if num_problems else 0)
+
+    except KeyboardInterrupt:
+        helpers.exit_interrupted()
+
+    except helpers.FatalBuildError as error:
+        error.exit_gracefully()
+
+def run_integration_tests(names=None, build='release', nprocs=None, skip_build=False, rerun=False, timeout=None, save_ref=False, diff_lines=20, verbose=False):
+    """
+    Build rosetta, run the given integration tests (or all of them), and 
+    compare each one to its reference output.  Return the number of tests that 
+    failed or changed.
+    """
+    from . import processes
+    from .build import build_rosetta
+
+    rosetta_path = helpers.find_rosetta_installation()
+    tests = find_tests(rosetta_path, names)
+
+    if not skip_build:
+        error_code = build_rosetta(build, nprocs=nprocs, verbose=verbose)
+        if error_code:
+            raise BuildFailed(error_code)
+
+    runner = TestRunner(
+            rosetta_path, build,
+            nprocs=int(nprocs or os.cpu_count() or 1),
+            rerun=rerun,
+            timeout=timeout,
+            verbose=verbose,
+    )
+    runner.hashes.load()
+
+    print("Running {} integration tests.".format(len(tests)))
+    processes.run(runner.run(order_tests(tests, build)))
+
+    comparisons = {}
+    for test in tests:
+        if test in runner.failures:
+            continue
+
+        if save_ref:
+            save_reference(rosetta_path, test, runner.hashes)
+        else:
+            comparisons[test] = compare_dirs(
+                    get_ref_dir(rosetta_path, test),
+                    get_new_dir(rosetta_path, test),
+                    runner.hashes)
+
+    runner.hashes.save()
+
+    if save_ref:
+        print("Saved the output of {} tests as the reference.".format(
+            len(tests) - len(runner.failures)))
+
+    print_report(rosetta_path, tests, runner, comparisons, diff_lines)
+    return len(runner.failures) + sum(1 for x in comparisons.values() if x)
+
+def find_tests(rosetta_path, names=None):
+    """
+    Return the names of the given integration tests (or of every integration 
+    test, if no names are given), making sure that each one exists.
+    """
+    tests_dir = get_integration_dir(rosetta_path, 'tests')
+
+    try:
+        available = sorted(
+                x for x in os.listdir(tests_dir)
+                if os.path.exists(os.path.join(tests_dir, x, 'command')))
+    except FileNotFoundError:
+        raise NoIntegrationTests(tests_dir)
+
+    if not names:
+        return available
+
+    for name in names:
+        if name not in available:
+            raise UnknownIntegrationTest(name)
+
+    return list(names)
+
+def order_tests(tests, build):
+    """
+    Put the tests that took the longest last time first, so that the long 
+    tests don't end up running by themselves at the end.
+    """
+    from . import history
+
+    wall_times = {}
+    for record in history.find_records('integration_test', build=build):
+        wall_times[record['test']] = record['wall_time']
+
+    return sorted(tests, key=lambda x: -wall_times.get(x, 0))
+
+def get_integration_dir(rosetta_path, *sub_paths):
+    return os.path.join(
+            rosetta_path, 'source', 'test', 'integration', *sub_paths)
+
+def get_new_dir(rosetta_path, test):
+    return get_integration_dir(rosetta_path, 'new', test)
+
+def get_ref_dir(rosetta_path, test):
+    return get_integration_dir(rosetta_path, 'ref', test)
+
+def get_cache_dir(rosetta_path, *sub_paths):
+    return os.path.join(rosetta_path, '.rdt_integration', *sub_paths)
+
+def get_binary_extension(bin_dir, build):
+    """
+    Work out the suffix of the executables in 'source/bin' for the given 
+    build, e.g. 'linuxgccrelease'.  This is what the '%(binext)s' variable in 
+    the integration test commands expands to.
+    """
+    import re
+    from collections import Counter
+
+    pattern = re.compile(r'\.([a-z]+{})$'.format(re.escape(build)))
+
+    try:
+        names = os.listdir(bin_dir)
+    except FileNotFoundError:
+        names = []
+
+    extensions = Counter(
+            m.group(1) for m in map(pattern.search, names) if m)
+
+    if extensions:
+        return extensions.most_common(1)[0][0]
+
+    platform = 'mac' if sys.platform == 'darwin' else 'linux'
+    return platform + 'gcc' + build
+
+def get_command_variables(rosetta_path, test, build):
+    """
+    Return the variables that can be used in the 'command' file of an 
+    integration test, the same ones that 'integration.py' provides.
+    """
+    bin_dir = os.path.join(rosetta_path, 'source', 'bin')
+    extension = get_binary_extension(bin_dir, build)
+
+    return CommandVariables(
+            bin=bin_dir,
+            binext=extension,
+            mode=build,
+            database=os.path.join(rosetta_path, 'database'),
+            minidir=os.path.join(rosetta_path, 'source'),
+            workdir=get_new_dir(rosetta_path, test),
+            testname=test,
+            python=sys.executable,
+            additional_flags='',
+    )
+
+def find_binaries(command, variables):
+    """
+    Return the path to every executable in 'source/bin' that the given 
+    (already expanded) command runs.
+    """
+    import re
+
+    pattern = re.escape(variables['bin']) + r'/([^\s;|&<>()\'"]+)'
+    paths = {os.path.join(variables['bin'], x)
+             for x in re.findall(pattern, command)}
+
+    return sorted(x for x in paths if os.path.isfile(x))
+
+def find_source_files(test_dir, command, variables):
+    """
+    Return every file in the 'source' directory that the given (already 
+    expanded) command mentions, e.g. scripts run with %(python)s, apart from 
+    the binaries in 'source/bin' and the test's own input and output 
+    directories.  Return None if the command mentions anything else in that 
+    directory, like a subdirectory, the directory itself, or a file that 
+    doesn't exist yet.  There's no telling what the test reads from those, so 
+    its output can't be reused safely.
+    """
+    import re
+
+    minidir = variables['minidir']
+    pattern = re.escape(minidir) + r'(/[^\s;|&<>()\'":,=]*)?'
+    own_dirs = [os.path.normpath(x) for x in (test_dir, variables['workdir'])]
+    paths = set()
+
+    def is_inside(path, dir):
+        return path == dir or path.startswith(dir + os.sep)
+
+    for match in re.finditer(pattern, command):
+        path = os.path.normpath(minidir + (match.group(1) or ''))
+
+        if any(is_inside(path, x) for x in own_dirs):
+            continue
+        if not os.path.isfile(path):
+            return None
+        if os.path.dirname(path) != os.path.normpath(variables['bin']):
+            paths.add(path)
+
+    return sorted(paths)
+
+def find_shared_libraries(build_path):
+    """
+    Return every shared library in the given build directory.  Executables 
+    built with '--shared-libs' can produce different output without changing 
+    themselves, so these are part of the binary hash too.
+    """
+    libraries = []
+
+    for dir, subdirs, files in os.walk(build_path):
+        subdirs[:] = [x for x in subdirs if x != 'CMakeFiles']
+        libraries += [
+                os.path.join(dir, x) for x in files
+                if x.endswith(('.so', '.dylib'))]
+
+    return sorted(libraries)
+
+def hash_inputs(test_dir, command, database_hash, hashes, source_files=()):
+    """
+    Return a hash of everything the test reads: the files in its directory, 
+    its expanded command, the database, and any files in the 'source' 
+    directory that the command mentions.
+    """
+    import hashlib
+
+    digest = hashlib.sha256(command.encode() + b'\0' + database_hash.encode())
+
+    for path in walk_files(test_dir):
+        digest.update(os.path.relpath(path, test_dir).encode() + b'\0')
+        digest.update(hashes.get(path).encode())
+
+    for path in source_files:
+        digest.update(path.encode() + b'\0' + hashes.get(path).encode())
+
+    return digest.hexdigest()
+
+def hash_database(database_path):
+    """
+    Return a hash of the names, sizes, and modification times of the files in 
+    the database.  The database is hashed by metadata rather than content, 
+    because it's big and almost never changes.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+
+    for path in walk_files(database_path):
+        stat = os.stat(path)
+        digest.update('{}\0{}\0{}\n'.format(
+            path, stat.st_size, stat.st_mtime_ns).encode())
+
+    return digest.hexdigest()
+
+def hash_binaries(paths, hashes):
+    import hashlib
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode() + b'\0' + hashes.get(path).encode())
+    return digest.hexdigest()
+
+def walk_files(root):
+    for dir, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            yield os.path.join(dir, name)
+
+def hash_file(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def replace_dir(src, dest):
+    """
+    Replace the given destination directory with a copy of the given source 
+    directory.
+    """
+    import shutil
+
+    shutil.rmtree(dest, ignore_errors=True)
+    shutil.copytree(src, dest, symlinks=True)
+
+def compare_dirs(ref_dir, new_dir, hashes):
+    """
+    Compare every file in the reference directory with the corresponding file 
+    in the new directory.  Return a list of (path, status) tuples for the 
+    files that differ, where <status> is 'added', 'removed', or 'changed'.  
+    Files with different sizes are known to differ without being read, and 
+    files with the same size are compared by their (cached) hashes.
+    """
+    ref_files = {os.path.relpath(x, ref_dir) for x in walk_files(ref_dir)}
+    new_files = {os.path.relpath(x, new_dir) for x in walk_files(new_dir)}
+    differences = []
+
+    for path in sorted(ref_files | new_files):
+        if path not in new_files:
+            differences.append((path, 'removed'))
+            continue
+        if path not in ref_files:
+            differences.append((path, 'added'))
+            continue
+
+        ref_path = os.path.join(ref_dir, path)
+        new_path = os.path.join(new_dir, path)
+
+        if os.path.getsize(ref_path) != os.path.getsize(new_path):
+            differences.append((path, 'changed'))
+        elif hashes.get(ref_path) != hashes.get(new_path):
+            differences.append((path, 'changed'))
+
+    return differences
+
+def diff_files(ref_path, new_path, max_lines=20):
+    """
+    Return a unified diff of the given files, showing no more than 
+    <max_lines> lines.  The files are read in step until the first line that 
+    differs, so a small change near the end of a big file doesn't require 
+    either file to be held in memory.
+    """
+    import difflib, re
+    from collections import deque
+    from itertools import islice, zip_longest
+
+    before = deque(maxlen=DIFF_CONTEXT)
+    first_line = 1
+
+    with open(ref_path, errors='replace') as ref_file, \
+            open(new_path, errors='replace') as new_file:
+
+        for ref_line, new_line in zip_longest(ref_file, new_file):
+            if ref_line != new_line:
+                break
+            before.append(ref_line)
+            first_line += 1
+        else:
+            return []
+
+        # Only read enough of the rest of each file to fill the diff.
+
+        ref_lines = list(before) + [x for x in [ref_line] if x is not None]
+        new_lines = list(before) + [x for x in [new_line] if x is not None]
+        ref_lines += islice(ref_file, max_lines)
+        new_lines += islice(new_file, max_lines)
+
+    diff = difflib.unified_diff(
+            ref_lines, new_lines,
+            fromfile=ref_path, tofile=new_path,
+            n=DIFF_CONTEXT, lineterm='')
+
+    # The diff only starts a few lines before the first difference, so shift 
+    # the line numbers in the hunk headers to match the files.
+
+    offset = first_line - len(before) - 1
+    hunk_header = re.compile(r'^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@')
+    shift = lambda m: '@@ -{}{} +{}{} @@'.format(
+            int(m.group(1)) + offset, m.group(2) or '',
+            int(m.group(3)) + offset, m.group(4) or '')
+
+    return [hunk_header.sub(shift, x.rstrip('\n'))
+            for x in islice(diff, max_lines + 2)]
+
+def save_reference(rosetta_path, test, hashes):
+    ref_dir = get_ref_dir(rosetta_path, test)
+    new_dir = get_new_dir(rosetta_path, test)
+
+    replace_dir(new_dir, ref_dir)
+    hashes.copy_tree(new_dir, ref_dir)
+
+def print_report(rosetta_path, tests, runner, comparisons, diff_lines=20):
+    from nonstdlib import print_color
+
+    num_changed = 0
+
+    for test in tests:
+        differences = comparisons.get(test)
+        if not differences:
+            continue
+
+        num_changed += 1
+        print()
+        print_color("{} differs from the reference:".format(test), 'white', 'bold')
+
+        for path, status in differences:
+            print("  {:<8} {}".format(status, path))
+
+        for path, status in differences:
+            if status != 'changed':
+                continue
+            print()
+            for line in diff_files(
+                    os.path.join(get_ref_dir(rosetta_path, test), path),
+                    os.path.join(get_new_dir(rosetta_path, test), path),
+                    diff_lines):
+                print(line)
+
+    num_same = sum(1 for x in comparisons.values() if not x)
+
+    print()
+    if comparisons:
+        print("{} test{} matched the reference ({} reused from earlier runs).".format(
+            num_same, '' if num_same == 1 else 's', runner.num_reused))
+
+    if num_changed:
+        print_color("{} test{} changed.".format(
+            num_changed, '' if num_changed == 1 else 's'), 'yellow', 'bold')
+
+    for test, result in sorted(runner.failures.items()):
+        reason = 'timed out' if result.timed_out else \
+                'exit status {}'.format(result.returncode)
+        print_color("FAILED: {} ({})".format(test, reason), 'red', 'bold')
+
+
+class TestRunner:
+    """
+    Run integration tests in parallel, reusing the saved output of any test 
+    whose inputs and binaries haven't changed.
+    """
+
+    def __init__(self, rosetta_path, build, nprocs=1, rerun=False, timeout=None, verbose=False):
+        from .unit_test import get_unit_test_dir
+
+        self.rosetta_path = rosetta_path
+        self.build = build
+        self.nprocs = nprocs
+        self.rerun = rerun
+        self.timeout = timeout
+        self.verbose = verbose
+        self.hashes = HashCache(rosetta_path)
+        self.shared_libraries = find_shared_libraries(
+                get_unit_test_dir(build, rosetta_path))
+        self.database_hash = hash_database(
+                os.path.join(rosetta_path, 'database'))
+        self.failures = {}
+        self.num_reused = 0
+
+    async def run(self, tests):
+        import asyncio
+
+        self.limiter = asyncio.Semaphore(self.nprocs)
+        await asyncio.gather(*(self.run_test(x) for x in tests))
+
+    async def run_test(self, test):
+        import shutil
+        from . import processes, history
+
+        test_dir = get_integration_dir(self.rosetta_path, 'tests', test)
+        new_dir = get_new_dir(self.rosetta_path, test)
+
+        variables = get_command_variables(self.rosetta_path, test, self.build)
+        with open(os.path.join(test_dir, 'command')) as file:
+            command = file.read().strip() % variables
+
+        # Tests that read things from the 'source' directory that can't be 
+        # hashed are always run, and their output isn't saved.
+
+        source_files = find_source_files(test_dir, command, variables)
+        is_reusable = source_files is not None
+
+        binaries = find_binaries(command, variables) + self.shared_libraries
+        key = '{}-{}'.format(
+                hash_inputs(
+                    test_dir, command, self.database_hash, self.hashes,
+                    source_files or ())[:16],
+                hash_binaries(binaries, self.hashes)[:16])
+        cache_dir = get_cache_dir(self.rosetta_path, 'outputs', test, key)
+
+        if not self.rerun and is_reusable and os.path.isdir(cache_dir):
+            replace_dir(cache_dir, new_dir)
+            self.hashes.copy_tree(cache_dir, new_dir)
+
+            # Note that the output was used, so 'rdt_build --gc' keeps it.
+            os.utime(os.path.dirname(cache_dir))
+            self.num_reused += 1
+            print("Reused {}".format(test))
+            return
+
+        # Run the test in a fresh copy of its directory, the same way 
+        # 'integration.py' does.
+
+        replace_dir(test_dir, new_dir)
+        with open(os.path.join(new_dir, 'command.sh'), 'w') as file:
+            file.write(command + '\n')
+
+        result = await processes.run_process(
+                ('bash', 'command.sh'), new_dir,
+                capture=True, timeout=self.timeout,
+                limiter=self.limiter, verbose=self.verbose)
+
+        if result.returncode != 0 or result.timed_out:
+            self.failures[test] = result
+            print("Failed {} ({:.1f}s):".format(test, result.wall_time))
+            print(result.text, end='')
+            return
+
+        print("Passed {} ({:.1f}s)".format(test, result.wall_time))
+        history.add_record(
+                'integration_test',
+                test=test,
+                build=self.build,
+                wall_time=result.wall_time,
+        )
+
+        # Save the output, replacing any output saved for older inputs or 
+        # binaries, which will never be reused.  The output is hashed first, 
+        # so that it doesn't have to be read again when it's compared to the 
+        # reference, now or when it's reused later.
+
+        for path in walk_files(new_dir):
+            self.hashes.get(path)
+
+        if not is_reusable:
+            return
+
+        shutil.rmtree(os.path.dirname(cache_dir), ignore_errors=True)
+        replace_dir(new_dir, cache_dir)
+        self.hashes.copy_tree(new_dir, cache_dir)
+
+
+class CommandVariables (dict):
+    """
+    The variables for expanding integration test commands.  Variables that 
+    'integration.py' knows about but this script doesn't expand to nothing, 
+    rather than causing an error.
+    """
+
+    def __missing__(self, key):
+        return ''
+
+
+class HashCache:
+    """
+    Remember the hash of every file that's been hashed, keyed by its path, 
+    size, and modification time, so that files that haven't changed (e.g. the 
+    reference outputs and the binaries) don't have to be read again.  The 
+    hashes are kept in the state database, and only the ones that changed are 
+    written back, so concurrent runs don't lose each other's hashes.
+    """
+
+    namespace = 'integration_hashes'
+
+    def __init__(self, rosetta_path):
+        from . import state
+
+        self.store = state.open_state(rosetta_path)
+        self.hashes = {}
+        self.changes = {}
+
+    def load(self):
+        self.hashes = self.store.get_cache(self.namespace)
+
+    def save(self):
+        # Forget about files that don't exist anymore.
+
+        missing = [k for k in self.hashes if not os.path.exists(k)]
+
+        self.store.update_cache(self.namespace, self.changes, missing)
+        self.changes = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        cached = self.hashes.get(path)
+
+        if cached and cached[:2] == signature:
+            return cached[2]
+
+        digest = hash_file(path)
+        self.hashes[path] = self.changes[path] = signature + [digest]
+        return digest
+
+    def copy_tree(self, src, dest):
+        """
+        Record that the files in <dest> are copies of the files in <src>, so 
+        their hashes are known without reading them.
+        """
+        for src_path in walk_files(src):
+            cached = self.hashes.get(src_path)
+            if not cached:
+                continue
+
+            dest_path = os.path.join(dest, os.path.relpath(src_path, src))
+            stat = os.stat(dest_path)
+            self.hashes[dest_path] = self.changes[dest_path] = \
+                    [stat.st_size, stat.st_mtime_ns, cached[2]]
+
+
+class NoIntegrationTests (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = "Couldn't find any integration tests in '{0}'."
+
+    def __init__(self, tests_dir):
+        super().__init__(tests_dir)
+
+
+class UnknownIntegrationTest (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            There's no integration test called '{0}' (i.e. no directory called
+            'source/test/integration/tests/{0}' with a 'command' file)."""
+
+    def __init__(self, name):
+        super().__init__(name)
+
+
+class BuildFailed (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Rosetta failed to build (exit status {0}), so the integration tests
+            weren't run."""
+
+    def __init__(self, error_code):
+        super().__init__(error_code)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""\
+Run the same unit tests on several branches at once.
+
+Each of the given git refs is checked out into its own worktree, so your own 
+checkout is left alone.  The worktrees are reused between runs, so each build 
+only has to recompile what changed since the last one.  Every worktree is 
+built with the same artifact cache (see 'rdt_build --cache'), so code that's 
+the same on every branch is only compiled once.  Once everything is built, 
+the tests for every branch are run at the same time, as long as they fit in 
+the given CPU and memory budget, and the results are shown side by side.
+
+Usage:
+    rdt_matrix <ref>... (-t <alias>)... [options]
+
+Arguments:
+    <ref>
+        The branches (or any other commits that 'git rev-parse' understands) 
+        to test.
+
+Options:
+    -t, --test <alias>
+        A unit test alias (see 'rdt_unit_test --save-as') to run on every 
+        branch.  Give this option more than once to run several tests.
+
+    -b, --build <build>         [default: debug]
+        Which build configuration to compile and test.
+
+    -j, --jobs NUM
+        How many compilation jobs to run at once, and how many tests can run 
+        at once.  By default, one per CPU.
+
+    -m, --memory SIZE
+        How much memory the tests running at once can use between them, e.g.  
+        '16G'.  Each test is expected to use as much memory as it did the last 
+        time it was run.  By default, the memory that's available when the 
+        tests start is used.
+
+    -w, --worktree-dir <path>
+        Where to check out the branches being tested.  By default, the 
+        worktrees are placed next to your rosetta checkout.
+
+    --cache-dir DIR
+        Where to keep the artifact cache shared by the worktrees.  The default 
+        is $RDT_CACHE_DIR, or '~/.cache/rdt_artifacts' if that isn't set.
+
+    --cache-size SIZE           [default: 20G]
+        How big the artifact cache can get before the least recently used 
+        files are deleted from it.
+
+    --no-cache
+        Build each worktree without the artifact cache.
+
+    -v, --verbose
+        Output each command line that gets run, in case something needs to be 
+        debugged.
+"""
+
+import sys, os
+from . import helpers
+
+DEFAULT_TEST_MEMORY = 1 << 30
+
+def main():
+    args = helpers.parse_args(__doc__)
+
+    try:
+        num_failures = run_matrix(
+                args['<ref>'],
+                args['--test'],
+                build=args['--build'],
+                nprocs=args['--jobs'],
+                memory=args['--memory'],
+                worktree_dir=args['--worktree-dir'],
+                cache=not args['--no-cache'],
+                cache_dir=args['--cache-dir'],
+                cache_size=args['--cache-size'],
+                verbose=args['--verbose'],
+        )
+        sys.exit(1 if num_failures else 0)
+
+    except KeyboardInterrupt:
+        helpers.exit_interrupted()
+
+    except helpers.FatalBuildError as error:
+        error.exit_gracefully()
+
+def run_matrix(refs, aliases, build='debug', nprocs=None, memory=None, worktree_dir=None, cache=True, cache_dir=None, cache_size=None, verbose=False):
+    """
+    Build each of the given refs in its own worktree, then run each of the 
+    given unit test aliases on every ref that built.  Return the number of 
+    tests that failed (or couldn't be run because the build failed).
+    """
+    from . import processes
+    from .artifact_cache import parse_size
+    from .bench import list_commits, describe_commit, checkout_commit
+    from .build import build_rosetta
+    from .scheduler import read_available_memory
+    from .unit_test import pick_unit_test
+
+    rosetta_path = helpers.find_rosetta_installation()
+    worktree_dir = worktree_dir or get_default_worktree_dir(rosetta_path)
+    nprocs = int(nprocs or os.cpu_count() or 1)
+
+    tests = [
+            MatrixTest(x, *pick_unit_test(None, None, alias=x), build=build)
+            for x in aliases]
+    worktrees = []
+
+    for ref in refs:
+        commit = list_commits(rosetta_path, ref)[-1]
+        path = os.path.join(worktree_dir, get_worktree_name(ref))
+        worktrees.append(Worktree(ref, commit, path))
+
+    # Build the worktrees one at a time, each with every job.  That's about as 
+    # fast as building them all at once, and it means that anything the 
+    # branches have in common is already in the cache after the first build.
+
+    libraries = sorted({x.library for x in tests})
+
+    for worktree in worktrees:
+        print("Building {}: {}".format(
+            worktree.ref, describe_commit(rosetta_path, worktree.commit)))
+        checkout_commit(rosetta_path, worktree.path, worktree.commit, verbose)
+
+        for library in libraries:
+            error_code = build_rosetta(
+                    build, library + '.test',
+                    nprocs=str(nprocs),
+                    verbose=verbose,
+                    rosetta_path=worktree.path,
+                    cache=cache,
+                    cache_dir=cache_dir,
+                    cache_size=cache_size,
+            )
+            if error_code:
+                worktree.build_failed = True
+                break
+
+    # Run every test on every worktree that built, as many at a time as the 
+    # budget allows.
+
+    if memory is not None:
+        memory = parse_size(memory)
+    else:
+        memory = read_available_memory()[1]
+
+    runner = MatrixRunner(
+            build, ResourceBudget(nprocs, memory), verbose=verbose)
+    processes.run(runner.run(
+        [(x, y) for x in worktrees if not x.build_failed for y in tests]))
+
+    print_table(worktrees, tests, runner.results)
+
+    return sum(
+            1 for x in worktrees for y in tests
+            if x.build_failed or runner.results[x.ref, y.alias].returncode != 0)
+
+def get_default_worktree_dir(rosetta_path):
+    rosetta_path = rosetta_path.rstrip(os.sep)
+    return rosetta_path + '.rdt_matrix'
+
+def get_worktree_name(ref):
+    """
+    Return a directory name for the worktree of the given ref.  The name is 
+    readable, but characters that don't belong in a file name are replaced, 
+    so a short hash of the ref is added to keep refs like 'feature/a' and 
+    'feature_a' from sharing a worktree.
+    """
+    import re, hashlib
+
+    name = re.sub(r'[^\w-]+', '_', ref).strip('_') or 'HEAD'
+    digest = hashlib.sha1(ref.encode()).hexdigest()[:8]
+    return '{}-{}'.format(name, digest)
+
+def estimate_test_memory(alias, build='debug'):
+    """
+    Return how much memory the given test used the last time it was run in 
+    the given build, or a typical amount if it's never been run.
+    """
+    from . import history
+
+    records = history.find_records('test_run', name=alias, build=build)
+    usages = [x['max_rss'] for x in records if x.get('max_rss')]
+    return usages[-1] if usages else DEFAULT_TEST_MEMORY
+
+def print_table(worktrees, tests, results):
+    """
+    Print a table with a row for each test and a column for each ref, showing 
+    whether each test passed and how long it took.
+    """
+    from nonstdlib import color
+
+    name_width = max(len(x.alias) for x in tests)
+    column_width = max([14] + [len(x.ref) for x in worktrees])
+
+    def format_row(name, cells):
+        return '  '.join([name.ljust(name_width)] + cells)
+
+    print()
+    print(format_row('', [x.ref.ljust(column_width) for x in worktrees]))
+    print(format_row('', [x.commit[:10].ljust(column_width) for x in worktrees]))
+
+    for test in tests:
+        cells = []
+
+        for worktree in worktrees:
+            if worktree.build_failed:
+                cells.append(color(
+                    'build failed'.ljust(column_width), 'red', 'bold'))
+                continue
+
+            result = results[worktree.ref, test.alias]
+
+            if result.timed_out or result.returncode != 0:
+                text, name = 'FAIL', 'red'
+            else:
+                text, name = 'pass', 'green'
+
+            cell = '{} {:>7.1f}s'.format(text, result.wall_time)
+            cells.append(color(cell.ljust(column_width), name, 'bold'))
+
+        print(format_row(test.alias, cells))
+
+
+class Worktree:
+
+    def __init__(self, ref, commit, path):
+        self.ref = ref
+        self.commit = commit
+        self.path = path
+        self.build_failed = False
+
+    def __repr__(self):
+        return 'Worktree({!r})'.format(self.ref)
+
+
+class MatrixTest:
+
+    def __init__(self, alias, library, suite, test=None, build='debug'):
+        self.alias = alias
+        self.library = library
+        self.suite = suite
+        self.test = test
+        self.memory = estimate_test_memory(alias, build)
+
+    def __repr__(self):
+        return 'MatrixTest({!r})'.format(self.alias)
+
+
+class MatrixRunner:
+    """
+    Run each test in each worktree, keeping the tests that are running at once 
+    within the given budget.
+    """
+
+    def __init__(self, build, budget, verbose=False):
+        self.build = build
+        self.budget = budget
+        self.verbose = verbose
+        self.results = {}
+
+    async def run(self, jobs):
+        import asyncio
+
+        # Start the tests that need the most memory first, so they don't get 
+        # stuck waiting for a gap between lots of smaller tests.
+
+        jobs = sorted(jobs, key=lambda x: -x[1].memory)
+        await asyncio.gather(*(self.run_test(*x) for x in jobs))
+
+    async def run_test(self, worktree, test):
+        from . import processes
+        from .unit_test import get_unit_test_dir, get_unit_test_command
+
+        result = await processes.run_process(
+                get_unit_test_command(test.library, test.suite, test.test),
+                get_unit_test_dir(self.build, worktree.path),
+                capture=True,
+                limiter=self.budget.reserve(cpus=1, memory=test.memory),
+                verbose=self.verbose,
+        )
+        self.results[worktree.ref, test.alias] = result
+
+        print("{} {} on {} ({:.1f}s)".format(
+            'Passed' if result.returncode == 0 else 'Failed',
+            test.alias, worktree.ref, result.wall_time))
+
+        if result.returncode != 0 and self.verbose:
+            print(result.text, end='')
+
+
+class ResourceBudget:
+    """
+    Limit how many CPUs and how much memory the processes running at once are 
+    expected to use between them.  A process that needs more than the whole 
+    budget is still run, but only by itself.
+    """
+
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.condition = None
+
+    def reserve(self, cpus=1, memory=0):
+        """
+        Return an async context manager that waits until the given resources 
+        are free, and holds on to them until it exits.  This can be passed to 
+        processes.run_process() as a limiter.
+        """
+        import asyncio
+        from contextlib import asynccontextmanager
+
+        cpus = min(cpus, self.cpus)
+        memory = min(memory, self.memory)
+
+        @asynccontextmanager
+        async def reservation():
+            if self.condition is None:
+                self.condition = asyncio.Condition()
+
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.fits(cpus, memory))
+                self.used_cpus += cpus
+                self.used_memory += memory
+
+            try:
+                yield
+            finally:
+                async with self.condition:
+                    self.used_cpus -= cpus
+                    self.used_memory -= memory
+                    self.condition.notify_all()
+
+        return reservation()
+
+    def fits(self, cpus, memory):
+        return self.used_cpus + cpus <= self.cpus and \
+                self.used_memory + memory <= self.memory
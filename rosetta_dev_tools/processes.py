@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""\
+Run subprocesses with asyncio.
+
+Everything that runs more than one process at a time (e.g. --check, doxygen 
+shards) goes through run_process() and run_processes(), which take care of 
+limiting how many processes run at once, capturing output without letting it 
+grow without bound, timeouts, and killing processes that are still running 
+when the command is interrupted.  Synchronous code can use run() to wait for 
+a coroutine, and helpers.shell_command() is a synchronous wrapper around 
+run_process() for the common case of running one command.
+
+Commands given as a tuple or list are executed directly, without a shell.  
+Commands given as a string are interpreted by the shell.
+
+Each command is started in a session (and so a process group) of its own, so 
+that a timeout or Ctrl-C kills everything it started, e.g. the programs run by 
+a shell script, and not just the shell.  This also means the terminal's Ctrl-C 
+only reaches rdt itself, which then kills the process groups.  Commands that 
+need to control the terminal (e.g. 'tmux attach') have to be run with 
+<interactive> set instead.
+"""
+
+import os, signal
+
+OUTPUT_LIMIT = 1 << 20
+READ_SIZE = 1 << 16
+KILL_GRACE_PERIOD = 5
+
+def run(coroutine):
+    """
+    Run the given coroutine to completion and return its result.  If the user 
+    presses Ctrl-C, every task is cancelled (which kills any processes they 
+    started) before KeyboardInterrupt is raised.
+    """
+    import asyncio
+    return asyncio.run(coroutine)
+
+async def run_process(command, directory=None, capture=False, on_line=None, timeout=None, output_limit=OUTPUT_LIMIT, limiter=None, env=None, interactive=False, verbose=False):
+    """
+    Run the given command in the given directory and return a ProcessResult 
+    once it finishes.
+
+    If <capture> is set, stdout and stderr are collected together, keeping 
+    only the last <output_limit> bytes.  If <on_line> is given, it's called 
+    with each line the command writes to stdout, instead of that line being 
+    printed.  Otherwise the command writes straight to the terminal.  If the 
+    command runs for longer than <timeout> seconds, it's killed.  If 
+    <limiter> is given (e.g. an asyncio.Semaphore), the command doesn't start 
+    until the limiter can be acquired.  If <interactive> is set, the command 
+    stays in rdt's process group, so it can use the terminal, but only the 
+    command itself (not anything it starts) is killed if it has to be.
+    """
+    if limiter is None:
+        return await _run_process(
+                command, directory, capture, on_line, timeout, output_limit,
+                env, interactive, verbose)
+
+    async with limiter:
+        return await _run_process(
+                command, directory, capture, on_line, timeout, output_limit,
+                env, interactive, verbose)
+
+async def _run_process(command, directory, capture, on_line, timeout, output_limit, env, interactive, verbose):
+    import asyncio, subprocess, shlex, time
+    from . import tracing
+
+    is_shell = isinstance(command, str)
+    description = command if is_shell else ' '.join(shlex.quote(x) for x in command)
+
+    if verbose:
+        print('$ cd', directory)
+        print('$', description)
+
+    pipe = subprocess.PIPE if capture or on_line else None
+    options = dict(
+            cwd=directory, env=env, stdout=pipe,
+            stderr=subprocess.STDOUT if capture else None,
+            start_new_session=not interactive)
+
+    span = tracing.span(
+            'process: ' + os.path.basename(description.split()[0]),
+            command=description, directory=directory)
+
+    with span:
+        start_time = time.perf_counter()
+
+        if is_shell:
+            process = await asyncio.create_subprocess_shell(command, **options)
+        else:
+            process = await asyncio.create_subprocess_exec(*command, **options)
+
+        output = OutputBuffer(output_limit)
+        timed_out = False
+
+        try:
+            await asyncio.wait_for(
+                    _communicate(process, output, on_line), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            await terminate(process, group=not interactive)
+        except BaseException:
+            await terminate(process, group=not interactive)
+            raise
+        finally:
+            # Close the pipes now, while the event loop is still running.  
+            # Otherwise the transport is only closed when it's garbage 
+            # collected, which can be after asyncio.run() has closed the loop.
+            _close_transport(process)
+
+    return ProcessResult(
+            command, process.returncode, output,
+            wall_time=time.perf_counter() - start_time,
+            timed_out=timed_out)
+
+async def _communicate(process, output, on_line):
+    if process.stdout is not None:
+        partial_line = b''
+
+        # Read in chunks rather than lines, so a very long line can't exceed 
+        # the stream's buffer limit.
+
+        while True:
+            chunk = await process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+
+            if on_line is None:
+                output.write(chunk)
+                continue
+
+            *lines, partial_line = (partial_line + chunk).split(b'\n')
+            for line in lines:
+                on_line(line.decode(errors='replace') + '\n')
+
+        if on_line and partial_line:
+            on_line(partial_line.decode(errors='replace'))
+
+    await process.wait()
+
+async def terminate(process, group=True):
+    """
+    Ask the given process to stop, and kill it if it hasn't stopped after a 
+    few seconds.  If <group> is set, the whole process group the process leads 
+    is signalled, and anything left in the group once the process itself has 
+    stopped is killed right away.
+    """
+    import asyncio
+
+    def send_signal(signum):
+        try:
+            if group:
+                os.killpg(process.pid, signum)
+            else:
+                process.send_signal(signum)
+        except ProcessLookupError:
+            pass
+
+    if process.returncode is None:
+        send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), KILL_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            pass
+
+    # The process itself has already been reaped by now if it stopped, but its 
+    # process group lives on as long as any of its children do.
+
+    if group or process.returncode is None:
+        send_signal(signal.SIGKILL)
+        await process.wait()
+
+def _close_transport(process):
+    transport = getattr(process, '_transport', None)
+    if transport is not None:
+        transport.close()
+
+async def run_processes(commands, directory=None, nprocs=None, on_finished=None, **kwargs):
+    """
+    Run each of the given commands, with at most <nprocs> (by default, one per 
+    CPU) running at once.  The optional <on_finished> callback is called with 
+    each ProcessResult as soon as that command finishes.  Return the results 
+    in the same order as the commands.  Any other keyword arguments are passed 
+    on to run_process().
+    """
+    import asyncio
+
+    limiter = asyncio.Semaphore(int(nprocs) if nprocs else os.cpu_count() or 1)
+
+    async def run_one(command):
+        result = await run_process(command, directory, limiter=limiter, **kwargs)
+        if on_finished:
+            on_finished(result)
+        return result
+
+    return await asyncio.gather(*(run_one(x) for x in commands))
+
+
+class ProcessResult:
+
+    def __init__(self, command, returncode, output, wall_time, timed_out=False):
+        self.command = command
+        self.returncode = returncode
+        self.output = output.getvalue()
+        self.dropped_bytes = output.dropped_bytes
+        self.wall_time = wall_time
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return 'ProcessResult(returncode={0.returncode}, wall_time={0.wall_time:.3f})'.format(self)
+
+    @property
+    def text(self):
+        """
+        The captured output as a string, noting how much was dropped if the 
+        output was too big to keep all of it.
+        """
+        text = self.output.decode(errors='replace')
+        if self.dropped_bytes:
+            text = '[{} bytes of output dropped]\n'.format(self.dropped_bytes) + text
+        return text
+
+
+class OutputBuffer:
+    """
+    Keep the last <limit> bytes written to it.  The end of the output is kept, 
+    because that's where compilers and test runners report what went wrong.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.dropped_bytes = 0
+
+    def write(self, chunk):
+        self.data += chunk
+        excess = len(self.data) - self.limit
+
+        if excess > 0:
+            del self.data[:excess]
+            self.dropped_bytes += excess
+
+    def getvalue(self):
+        return bytes(self.data)
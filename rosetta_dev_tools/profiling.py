@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+"""\
+Profile unit tests with either perf or callgrind, and summarize the results.
+
+The raw samples from either profiler are converted into "folded stacks" (one 
+line per unique call stack, followed by the cost of that stack), which is the 
+format used by Brendan Gregg's flamegraph scripts.  Everything else (the 
+flamegraph, the table of hot functions, and the comparison between successive 
+profiles) is derived from the folded stacks.
+"""
+
+import os
+from . import helpers
+
+PROFILE_BUILD = 'release_symbols'
+PROFILE_BASE_BUILD = 'release'
+PROFILE_CMAKE_ARGS = (
+        '-DCMAKE_CXX_FLAGS=-g -fno-omit-frame-pointer',
+        '-DCMAKE_C_FLAGS=-g -fno-omit-frame-pointer',
+)
+PROFILERS = 'perf', 'callgrind'
+
+def get_profile_root(name):
+    """
+    Return the directory where all the profiles for the given alias are kept.
+    """
+    return os.path.join(
+            helpers.find_rosetta_installation(), '.rdt_profiles', name)
+
+def make_profile_dir(name):
+    """
+    Create a new directory for a profile of the given alias, and return its 
+    path.  The directories are named after the time they were made, down to 
+    the microsecond, so they sort in the order they were made.  If two runs 
+    still manage to pick the same name, the second gets a numbered suffix 
+    rather than overwriting the first.
+    """
+    from datetime import datetime
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    root = get_profile_root(name)
+    os.makedirs(root, exist_ok=True)
+
+    profile_dir = os.path.join(root, stamp)
+    suffix = 0
+
+    while True:
+        try:
+            os.mkdir(profile_dir)
+            return profile_dir
+        except FileExistsError:
+            suffix += 1
+            profile_dir = os.path.join(root, '{}-{}'.format(stamp, suffix))
+
+def find_previous_profile(name, profile_dir):
+    """
+    Return the most recent profile for the given alias other than the given 
+    one, or None if there isn't one.
+    """
+    root = get_profile_root(name)
+    previous = sorted(
+            x for x in os.listdir(root)
+            if os.path.join(root, x) != profile_dir
+            and os.path.exists(os.path.join(root, x, 'stacks.folded')))
+    return os.path.join(root, previous[-1]) if previous else None
+
+def record_profile(tool, directory, command, profile_dir, verbose=False):
+    """
+    Run the given command under the given profiler, and write the resulting 
+    folded stacks to 'stacks.folded' in the profile directory.  Return the exit 
+    status of the command.
+    """
+    import shutil, shlex
+
+    if tool not in PROFILERS:
+        raise UnknownProfiler(tool)
+
+    executable = 'perf' if tool == 'perf' else 'valgrind'
+    if not shutil.which(executable):
+        raise ProfilerNotFound(tool, executable)
+
+    if tool == 'perf':
+        perf_data = os.path.join(profile_dir, 'perf.data')
+        perf_script = os.path.join(profile_dir, 'perf.script')
+        profile_cmd = ('perf', 'record', '-g', '-o', perf_data, '--') + tuple(command)
+        error_code = helpers.shell_command(
+                directory, profile_cmd, check=False, verbose=verbose)
+
+        script_cmd = 'perf script -i {} > {}'.format(
+                shlex.quote(perf_data), shlex.quote(perf_script))
+        helpers.shell_command(directory, script_cmd, verbose=verbose)
+
+        with open(perf_script, errors='replace') as file:
+            stacks = fold_perf_script(file)
+
+    else:
+        callgrind_out = os.path.join(profile_dir, 'callgrind.out')
+        profile_cmd = (
+                'valgrind', '--tool=callgrind',
+                '--callgrind-out-file=' + callgrind_out) + tuple(command)
+        error_code = helpers.shell_command(
+                directory, profile_cmd, check=False, verbose=verbose)
+
+        with open(callgrind_out, errors='replace') as file:
+            stacks = fold_callgrind_output(file)
+
+    write_folded_stacks(os.path.join(profile_dir, 'stacks.folded'), stacks)
+    return error_code
+
+def fold_perf_script(lines):
+    """
+    Convert the output of 'perf script' into folded stacks.  Each sample in 
+    that output is a header line followed by one line per stack frame (leaf 
+    first), and samples are separated by blank lines.
+    """
+    stacks = {}
+    frames = None
+
+    def finish_sample():
+        if frames:
+            key = ';'.join(reversed(frames))
+            stacks[key] = stacks.get(key, 0) + 1
+
+    for line in lines:
+        line = line.rstrip('\n')
+
+        if not line.strip():
+            finish_sample()
+            frames = None
+        elif frames is None:
+            frames = []
+        else:
+            # Frame lines look like: "  7f3a... symbol+0x1c (/path/to/lib.so)"
+            fields = line.strip().split(' ', 1)
+            symbol = fields[1] if len(fields) == 2 else fields[0]
+            symbol = symbol.rsplit(' (', 1)[0]
+            symbol = symbol.rsplit('+0x', 1)[0]
+            frames.append(symbol.replace(';', ':'))
+
+    finish_sample()
+    return stacks
+
+def fold_callgrind_output(lines, min_cost_fraction=1e-4):
+    """
+    Convert a callgrind output file into folded stacks.  Callgrind only records 
+    the cost of each function and of each caller/callee pair, not full stacks, 
+    so the stacks are reconstructed by starting from the functions that are 
+    never called and splitting the cost of each function between its own code 
+    and its callees in proportion to the recorded costs.
+    """
+    self_costs = {}
+    call_costs = {}
+    names = {}
+    current_fn = None
+    current_cfn = None
+    expect_call_cost = False
+
+    def resolve(value):
+        # Callgrind compresses names by giving each one an id the first time 
+        # it appears, e.g. "(12) foo()", and just "(12)" after that.
+        value = value.strip()
+        if value.startswith('('):
+            id, _, name = value.partition(')')
+            name = name.strip()
+            if name:
+                names[id] = name
+            return names.get(id, value)
+        return value
+
+    for line in lines:
+        line = line.rstrip('\n')
+
+        if line.startswith('fn='):
+            current_fn = resolve(line[3:])
+            self_costs.setdefault(current_fn, 0)
+        elif line.startswith(('cfn=', 'cfni=')):
+            current_cfn = resolve(line.split('=', 1)[1])
+        elif line.startswith('calls='):
+            expect_call_cost = True
+        elif line[:1].isdigit() or line[:1] in '+-*':
+            fields = line.split()
+            cost = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 0
+
+            if expect_call_cost:
+                edge = current_fn, current_cfn
+                call_costs[edge] = call_costs.get(edge, 0) + cost
+                expect_call_cost = False
+            elif current_fn is not None:
+                self_costs[current_fn] += cost
+
+    # Work out the inclusive cost of each function, and who it calls.
+
+    callees = {}
+    called = set()
+    for (caller, callee), cost in call_costs.items():
+        callees.setdefault(caller, []).append((callee, cost))
+        called.add(callee)
+
+    inclusive = {
+            fn: self_costs.get(fn, 0) + sum(x[1] for x in callees.get(fn, []))
+            for fn in set(self_costs) | set(callees)
+    }
+    total = sum(inclusive[x] for x in inclusive if x not in called) or 1
+    stacks = {}
+
+    def expand(stack, fn, weight):
+        if weight < total * min_cost_fraction or not inclusive.get(fn):
+            return
+
+        stack = stack + [fn.replace(';', ':')]
+        own = weight * self_costs.get(fn, 0) / inclusive[fn]
+        if own:
+            key = ';'.join(stack)
+            stacks[key] = stacks.get(key, 0) + own
+
+        for callee, cost in callees.get(fn, []):
+            if callee.replace(';', ':') not in stack:
+                expand(stack, callee, weight * cost / inclusive[fn])
+
+    for fn in inclusive:
+        if fn not in called:
+            expand([], fn, inclusive[fn])
+
+    return {k: int(round(v)) for k, v in stacks.items() if round(v) > 0}
+
+def record_heap_profile(directory, command, profile_dir, verbose=False):
+    """
+    Run the given command under a heap profiler: heaptrack if it's installed, 
+    or else valgrind's massif tool.  Return the name of the profiler used, the 
+    exit status of the command, the peak heap size (in bytes), and a list of 
+    (bytes, site) tuples for the allocation sites contributing to that peak, 
+    largest first.
+    """
+    import shutil, shlex, glob
+
+    if shutil.which('heaptrack') and shutil.which('heaptrack_print'):
+        output_prefix = os.path.join(profile_dir, 'heaptrack')
+        profile_cmd = ('heaptrack', '-o', output_prefix) + tuple(command)
+        error_code = helpers.shell_command(
+                directory, profile_cmd, check=False, verbose=verbose)
+
+        # Heaptrack adds the process id and a compression extension to the 
+        # output file name, so look for whatever it actually wrote.
+
+        summary_path = os.path.join(profile_dir, 'heaptrack.txt')
+        outputs = [x for x in glob.glob(output_prefix + '*') if x != summary_path]
+        if not outputs:
+            raise NoHeapProfile('heaptrack', error_code)
+
+        print_cmd = 'heaptrack_print -f {} > {}'.format(
+                shlex.quote(outputs[0]), shlex.quote(summary_path))
+        helpers.shell_command(directory, print_cmd, verbose=verbose)
+
+        with open(summary_path, errors='replace') as file:
+            peak, sites = parse_heaptrack_summary(file)
+
+        return 'heaptrack', error_code, peak, sites
+
+    if shutil.which('valgrind'):
+        massif_out = os.path.join(profile_dir, 'massif.out')
+        profile_cmd = (
+                'valgrind', '--tool=massif',
+                '--massif-out-file=' + massif_out) + tuple(command)
+        error_code = helpers.shell_command(
+                directory, profile_cmd, check=False, verbose=verbose)
+
+        if not os.path.exists(massif_out):
+            raise NoHeapProfile('massif', error_code)
+
+        with open(massif_out, errors='replace') as file:
+            peak, sites = parse_massif_output(file)
+
+        return 'massif', error_code, peak, sites
+
+    raise ProfilerNotFound('a heap profiler', 'heaptrack or valgrind')
+
+def parse_massif_output(lines):
+    """
+    Find the peak snapshot in a massif output file, and return the heap size at 
+    that snapshot along with the allocation sites directly beneath the root of 
+    its allocation tree.
+    """
+    import re
+
+    tree_pattern = re.compile(r'^( *)n\d+: (\d+) (.*)$')
+    snapshot = {}
+    peak = None
+
+    for line in lines:
+        line = line.rstrip('\n')
+
+        if line.startswith('snapshot='):
+            snapshot = {'sites': []}
+        elif line.startswith('mem_heap_B='):
+            snapshot['heap'] = int(line.split('=', 1)[1])
+        elif line.startswith('heap_tree='):
+            if line.split('=', 1)[1] == 'peak':
+                peak = snapshot
+        else:
+            match = tree_pattern.match(line)
+            if match and len(match.group(1)) == 1:
+                site = match.group(3)
+
+                # Strip the address off of sites like "0x4C2B: foo() (a.cc:12)".
+                if site.startswith('0x') and ': ' in site:
+                    site = site.split(': ', 1)[1]
+
+                snapshot['sites'].append((int(match.group(2)), site))
+
+    if peak is None:
+        return 0, []
+
+    return peak.get('heap', 0), sorted(peak['sites'], reverse=True)
+
+def parse_heaptrack_summary(lines):
+    """
+    Parse the "peak memory consumers" section of the output from 
+    heaptrack_print, and return the total peak heap size along with the 
+    allocation sites responsible for it.
+    """
+    import re
+
+    consumer_pattern = re.compile(
+            r'^(\S+) peak memory consumed over \d+ calls from')
+    total_pattern = re.compile(r'^peak heap memory consumption: (\S+)')
+    sites = []
+    peak = 0
+    in_consumers = False
+    pending = None
+
+    for line in lines:
+        line = line.rstrip('\n')
+
+        if line.startswith('PEAK MEMORY CONSUMERS'):
+            in_consumers = True
+        elif line.isupper() and line.strip():
+            in_consumers = False
+
+        total = total_pattern.match(line)
+        if total:
+            peak = parse_size(total.group(1))
+
+        if not in_consumers:
+            continue
+
+        consumer = consumer_pattern.match(line)
+        if consumer:
+            pending = parse_size(consumer.group(1))
+        elif pending is not None and line.strip():
+            sites.append((pending, line.strip()))
+            pending = None
+
+    return peak or sum(x[0] for x in sites), sorted(sites, reverse=True)
+
+def parse_size(text):
+    """
+    Convert a size like "1.23MB" or "456K" (as printed by heaptrack) to bytes.
+    """
+    import re
+
+    match = re.match(r'^([\d.]+)\s*([KMGT]?)i?B?$', text.strip())
+    if not match:
+        return 0
+
+    multiplier = 1024 ** ' KMGT'.index(match.group(2) or ' ')
+    return int(float(match.group(1)) * multiplier)
+
+def print_allocation_sites(peak, sites, top=20):
+    print()
+    print("Peak heap usage: {}".format(helpers.format_bytes(peak)))
+    print()
+    print('{:>10} {:>7}  {}'.format('bytes', 'share', 'allocation site'))
+    for size, site in sites[:top]:
+        print('{:>10} {:>6.2f}%  {}'.format(
+            helpers.format_bytes(size), 100 * size / (peak or 1), site[:100]))
+
+def write_folded_stacks(path, stacks):
+    with open(path, 'w') as file:
+        for stack, count in sorted(stacks.items()):
+            file.write('{} {}\n'.format(stack, count))
+
+def read_folded_stacks(path):
+    stacks = {}
+    with open(path) as file:
+        for line in file:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+def find_hot_functions(stacks):
+    """
+    Return a dictionary mapping each function to its self and total cost, as 
+    fractions of the total cost of all the stacks.  Self cost is the cost of 
+    stacks ending in the function; total cost is the cost of stacks containing 
+    it anywhere.
+    """
+    grand_total = sum(stacks.values()) or 1
+    functions = {}
+
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        for frame in set(frames):
+            functions.setdefault(frame, [0, 0])[1] += count
+        functions.setdefault(frames[-1], [0, 0])[0] += count
+
+    return {
+            fn: (self_cost / grand_total, total_cost / grand_total)
+            for fn, (self_cost, total_cost) in functions.items()
+    }
+
+def print_hot_functions(hot_functions, top=20):
+    ranked = sorted(hot_functions.items(), key=lambda x: -x[1][0])[:top]
+
+    print()
+    print('{:>7} {:>7}  {}'.format('self', 'total', 'function'))
+    for fn, (self_cost, total_cost) in ranked:
+        print('{:>6.2f}% {:>6.2f}%  {}'.format(
+            100 * self_cost, 100 * total_cost, fn[:100]))
+
+def print_profile_diff(hot_functions, previous_functions, top=20):
+    """
+    Print the functions whose share of the self cost changed the most between 
+    the previous profile and this one.
+    """
+    changes = []
+    for fn in set(hot_functions) | set(previous_functions):
+        before = previous_functions.get(fn, (0, 0))[0]
+        after = hot_functions.get(fn, (0, 0))[0]
+        if before != after:
+            changes.append((after - before, before, after, fn))
+
+    changes.sort(key=lambda x: -abs(x[0]))
+
+    print()
+    print('{:>7} {:>7} {:>8}  {}'.format('before', 'after', 'change', 'function'))
+    for change, before, after, fn in changes[:top]:
+        print('{:>6.2f}% {:>6.2f}% {:>+7.2f}%  {}'.format(
+            100 * before, 100 * after, 100 * change, fn[:100]))
+
+def write_flamegraph(path, stacks, title='Flame Graph', width=1200, frame_height=16):
+    """
+    Draw the given folded stacks as an SVG flamegraph.  Each frame is drawn as 
+    a box whose width is proportional to its total cost, stacked on top of 
+    the frame that called it.  Hovering over a box shows the full name of the 
+    function and its cost.
+    """
+    from html import escape
+    import zlib
+
+    # Merge the stacks into a tree, where each node has a total cost and a 
+    # dictionary of children.
+
+    root = [0, {}]
+    for stack, count in stacks.items():
+        node = root
+        node[0] += count
+        for frame in stack.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+
+    total = root[0] or 1
+    boxes = []
+    max_depth = [0]
+
+    def layout(children, x, depth):
+        for name, (count, grandchildren) in sorted(children.items()):
+            box_width = width * count / total
+            if box_width >= 0.5:
+                boxes.append((name, count, x, depth, box_width))
+                max_depth[0] = max(max_depth[0], depth)
+                layout(grandchildren, x, depth + 1)
+            x += box_width
+
+    layout(root[1], 0, 0)
+
+    height = (max_depth[0] + 1) * frame_height + 40
+    svg = [
+            '<?xml version="1.0" standalone="no"?>',
+            '<svg version="1.1" width="{}" height="{}" '
+            'xmlns="http://www.w3.org/2000/svg" font-family="monospace" '
+            'font-size="11">'.format(width, height),
+            '<text x="{}" y="20" text-anchor="middle" font-size="15">{}</text>'
+            .format(width / 2, escape(title)),
+    ]
+
+    for name, count, x, depth, box_width in boxes:
+        y = height - (depth + 1) * frame_height
+
+        # Pick a warm color for each function.  Basing the color on a hash of 
+        # the name keeps it the same from one profile to the next.
+
+        hash = zlib.crc32(name.encode())
+        color = 'rgb({},{},{})'.format(
+                205 + hash % 50, 80 + (hash >> 8) % 130, (hash >> 16) % 55)
+
+        label = name if len(name) * 7 < box_width else name[:int(box_width / 7) - 2] + '..'
+        svg.append('<g><title>{} ({} samples, {:.2f}%)</title>'.format(
+            escape(name), count, 100 * count / total))
+        svg.append('<rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="{}" rx="2"/>'.format(
+            x, y, box_width, frame_height - 1, color))
+        if box_width > 21:
+            svg.append('<text x="{:.1f}" y="{}">{}</text>'.format(
+                x + 3, y + frame_height - 4, escape(label)))
+        svg.append('</g>')
+
+    svg.append('</svg>')
+
+    with open(path, 'w') as file:
+        file.write('\n'.join(svg) + '\n')
+
+
+class UnknownProfiler (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Unknown profiler '{0}'.  Use either 'perf' or 'callgrind'."""
+
+    def __init__(self, tool):
+        super().__init__(tool)
+
+
+class ProfilerNotFound (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Can't profile with '{0}' because '{1}' isn't installed."""
+
+    def __init__(self, tool, executable):
+        super().__init__(tool, executable)
+
+
+class NoHeapProfile (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            {0} didn't write a heap profile.  The test exited with status {1}, 
+            so it may have crashed before the profiler could save anything.
+            Run it without --heap-profile to see what went wrong."""
+
+    def __init__(self, profiler, error_code):
+        super().__init__(profiler, error_code)
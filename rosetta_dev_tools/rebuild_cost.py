@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+
+"""\
+Predict how long a build will take before running it.
+
+The prediction is based on three things ninja already keeps in the build 
+directory:
+
+- 'build.ninja': which targets are built from which inputs, e.g. which objects
+  are linked into which libraries and binaries.
+- '.ninja_deps': which headers each object file included the last time it was
+  compiled.
+- '.ninja_log': how long each target took to build the last time it was built.
+
+Every target that depends (directly or indirectly) on one of the changed files 
+would be rebuilt.  The build is then simulated with the given number of jobs, 
+starting targets in the order of the longest chain of targets waiting on them 
+(like ninja does), to get an estimate of the wall time.
+
+Parsing 'build.ninja' and '.ninja_deps' takes a few seconds for rosetta, so the 
+parsed graph is cached in '.rdt_build_graph' until either file changes.
+"""
+
+import os
+from . import helpers
+
+GRAPH_CACHE_NAME = '.rdt_build_graph'
+GRAPH_CACHE_VERSION = 1
+DEPS_LOG_SIGNATURE = b'# ninjadeps\n'
+DEFAULT_DURATION_MS = 1000
+NUM_SLOWEST_TARGETS = 10
+NUM_CHANGED_FILES_SHOWN = 20
+
+def predict_rebuild(build_path, build_tool, changes=(), rosetta_path=None, nprocs=None, verbose=False):
+    """
+    Print which targets would be rebuilt if the given files changed (or if 
+    the given git revision were checked out), and how long that would take.  
+    Return the predicted wall time in seconds.
+    """
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+    changed_paths = find_changed_paths(rosetta_path, changes)
+
+    graph = load_build_graph(build_path, build_tool, verbose)
+    durations = read_target_durations(build_path)
+    nprocs = int(nprocs) if nprocs else get_default_jobs()
+
+    dirty_edges = graph.find_dirty_edges(changed_paths)
+    estimate = Estimate(graph, dirty_edges, durations)
+    wall_time_ms = estimate.simulate(nprocs)
+
+    print_prediction(
+            graph, changed_paths, estimate, wall_time_ms, nprocs)
+
+    return wall_time_ms / 1000
+
+def find_changed_paths(rosetta_path, changes):
+    """
+    Return the absolute paths of the files that are changing.  <changes> is 
+    either a list of files, a single git revision (in which case the changes 
+    are the differences between the working tree and that revision), or empty 
+    (in which case the changes are the uncommitted changes in the working 
+    tree).
+    """
+    import subprocess
+
+    if changes and all(os.path.exists(x) for x in changes):
+        return sorted({os.path.abspath(x) for x in changes})
+
+    if len(changes) > 1:
+        raise UnknownChange(next(x for x in changes if not os.path.exists(x)))
+
+    revision = changes[0] if changes else 'HEAD'
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                    ('git', 'rev-parse', '--verify', '--quiet', revision + '^{commit}'),
+                    cwd=rosetta_path, stdout=devnull, stderr=devnull)
+            stdout = subprocess.check_output(
+                    ('git', 'diff', '--name-only', revision),
+                    cwd=rosetta_path, stderr=devnull)
+    except subprocess.CalledProcessError:
+        raise UnknownChange(revision)
+
+    return sorted(
+            os.path.join(rosetta_path, x)
+            for x in stdout.decode().splitlines() if x)
+
+def get_default_jobs():
+    # This is the same default that ninja uses.
+
+    num_cpus = os.cpu_count() or 1
+    return num_cpus + 2 if num_cpus > 1 else 1
+
+def load_build_graph(build_path, build_tool, verbose=False):
+    """
+    Return the build graph for the given build directory, from the cache if 
+    neither 'build.ninja' nor '.ninja_deps' has changed since it was cached.
+    """
+    import pickle
+
+    manifest_path = os.path.join(build_path, 'build.ninja')
+    deps_path = os.path.join(build_path, '.ninja_deps')
+    cache_path = os.path.join(build_path, GRAPH_CACHE_NAME)
+
+    if 'ninja' not in os.path.basename(build_tool) or not os.path.exists(manifest_path):
+        raise WhatIfRequiresNinja()
+    if not os.path.exists(deps_path):
+        raise NoDependencyLog(build_path)
+
+    signature = (
+            GRAPH_CACHE_VERSION,
+            get_file_signature(manifest_path),
+            get_file_signature(deps_path),
+    )
+
+    try:
+        with open(cache_path, 'rb') as file:
+            cached_signature, graph = pickle.load(file)
+        if cached_signature == signature:
+            return graph
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    if verbose:
+        print("Parsing the build graph in '{}'...".format(build_path))
+
+    graph = BuildGraph()
+    graph.add_manifest(manifest_path)
+    graph.add_deps(*read_deps_log(deps_path, build_path, build_tool))
+    graph.freeze()
+
+    with open(cache_path + '.tmp', 'wb') as file:
+        pickle.dump((signature, graph), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + '.tmp', cache_path)
+
+    return graph
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def iter_build_statements(manifest_path):
+    """
+    Yield the outputs, rule, and inputs of every build statement in the given 
+    ninja manifest (and any manifests it includes).  Implicit inputs are 
+    included with the explicit ones, since a change to either causes a 
+    rebuild.  Order-only inputs are left out, since they don't.
+    """
+    import re
+
+    token_pattern = re.compile(r'(?:\$.|[^$ :|])+|\|\||\||:')
+    unescape_pattern = re.compile(r'\$(.)')
+    directory = os.path.dirname(manifest_path)
+
+    with open(manifest_path, errors='replace') as file:
+        lines = iter(file)
+        for line in lines:
+
+            # A '$' at the end of a line continues the statement on the next 
+            # line.
+
+            while line.endswith('$\n') and not line.endswith('$$\n'):
+                line = line[:-2] + next(lines, '').lstrip()
+
+            if line.startswith(('include ', 'subninja ')):
+                included = line.split(None, 1)[1].strip()
+                yield from iter_build_statements(os.path.join(directory, included))
+                continue
+
+            if not line.startswith('build '):
+                continue
+
+            tokens = token_pattern.findall(line[len('build '):].rstrip('\n'))
+            colon = tokens.index(':')
+            outputs = [x for x in tokens[:colon] if x != '|']
+            rule = tokens[colon + 1]
+            inputs = tokens[colon + 2:]
+
+            if '||' in inputs:
+                inputs = inputs[:inputs.index('||')]
+            inputs = [x for x in inputs if x != '|']
+
+            yield (
+                    [unescape_pattern.sub(r'\1', x) for x in outputs],
+                    rule,
+                    [unescape_pattern.sub(r'\1', x) for x in inputs],
+            )
+
+def read_deps_log(deps_path, build_path, build_tool):
+    """
+    Return the paths in ninja's dependency log and a dictionary mapping the 
+    index of each target to the indices of the files (usually headers) it 
+    depended on the last time it was built.  The log is read directly, which 
+    is much faster than parsing the output of 'ninja -t deps', but the tool is 
+    used as a fallback for log formats that aren't understood.
+    """
+    import struct
+
+    with open(deps_path, 'rb') as file:
+        data = file.read()
+
+    header_size = len(DEPS_LOG_SIGNATURE) + 4
+    if not data.startswith(DEPS_LOG_SIGNATURE) or len(data) < header_size:
+        return read_deps_tool(build_path, build_tool)
+
+    version, = struct.unpack_from('<i', data, len(DEPS_LOG_SIGNATURE))
+    if version not in (3, 4):
+        return read_deps_tool(build_path, build_tool)
+
+    # Each record starts with its size.  If the high bit is set, it lists the 
+    # dependencies of one output: the output's id, its mtime (8 bytes since 
+    # version 4), and the ids of its inputs.  Otherwise it's a path, padded 
+    # with nulls, followed by a checksum, and its id is the number of paths 
+    # that came before it.
+
+    mtime_words = 2 if version == 4 else 1
+    paths = []
+    deps = {}
+    offset = header_size
+
+    while offset + 4 <= len(data):
+        size, = struct.unpack_from('<I', data, offset)
+        is_deps = size & 0x80000000
+        size &= 0x7fffffff
+        offset += 4
+
+        if offset + size > len(data):
+            break
+
+        if is_deps:
+            record = struct.unpack_from('<{}i'.format(size // 4), data, offset)
+            deps[record[0]] = record[1 + mtime_words:]
+        else:
+            paths.append(data[offset:offset + size - 4].rstrip(b'\0').decode(errors='replace'))
+
+        offset += size
+
+    # Later records replace earlier ones for the same output, which the 
+    # dictionary already took care of.
+
+    return paths, deps
+
+def read_deps_tool(build_path, build_tool):
+    import subprocess
+
+    stdout = subprocess.check_output((build_tool, '-t', 'deps'), cwd=build_path)
+    paths = []
+    ids = {}
+    deps = {}
+    inputs = None
+
+    def get_id(path):
+        if path not in ids:
+            ids[path] = len(paths)
+            paths.append(path)
+        return ids[path]
+
+    for line in stdout.decode(errors='replace').splitlines():
+        if not line.strip():
+            continue
+        if line.startswith((' ', '\t')):
+            inputs.append(get_id(line.strip()))
+        else:
+            inputs = deps[get_id(line.split(': #deps', 1)[0])] = []
+
+    return paths, deps
+
+def read_target_durations(build_path):
+    """
+    Return a dictionary mapping each target to how many milliseconds it took 
+    to build the last time it was built, according to '.ninja_log'.
+    """
+    durations = {}
+
+    try:
+        file = open(os.path.join(build_path, '.ninja_log'), errors='replace')
+    except FileNotFoundError:
+        return durations
+
+    with file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(fields) < 4:
+                continue
+            try:
+                durations[fields[3]] = int(fields[1]) - int(fields[0])
+            except ValueError:
+                continue
+
+    return durations
+
+def format_duration(seconds):
+    if seconds < 60:
+        return '{:.0f}s'.format(seconds)
+    if seconds < 3600:
+        return '{:.0f}m {:02.0f}s'.format(*divmod(seconds, 60))
+    return '{:.0f}h {:02.0f}m'.format(*divmod(seconds / 60, 60))
+
+def print_prediction(graph, changed_paths, estimate, wall_time_ms, nprocs):
+    if not changed_paths:
+        print("Nothing has changed.")
+        return
+
+    # Show how much of the build each changed file is responsible for, so 
+    # it's obvious which header is the expensive one.
+
+    known_paths = [x for x in changed_paths if graph.find_node(x) is not None]
+    unknown_paths = [x for x in changed_paths if graph.find_node(x) is None]
+
+    print("Changed files:")
+    for path in known_paths[:NUM_CHANGED_FILES_SHOWN]:
+        num_edges = len(graph.find_dirty_edges([path]))
+        print("  {:>6} targets  {}".format(num_edges, os.path.relpath(path)))
+    if len(known_paths) > NUM_CHANGED_FILES_SHOWN:
+        print("  ... and {} more".format(len(known_paths) - NUM_CHANGED_FILES_SHOWN))
+    if unknown_paths:
+        print("  {:>6} files aren't part of this build".format(len(unknown_paths)))
+
+    if any(x.endswith(('.settings', 'CMakeLists.txt')) for x in changed_paths):
+        print()
+        print("Warning: cmake will be rerun, which may add targets that aren't counted here.")
+
+    print()
+    print("Targets to rebuild: {} ({} compiled, {} linked or other)".format(
+        len(estimate.dirty_edges), estimate.num_compiles,
+        len(estimate.dirty_edges) - estimate.num_compiles))
+
+    if estimate.num_guessed:
+        print("Targets never built before (time guessed): {}".format(
+            estimate.num_guessed))
+
+    slowest = sorted(
+            estimate.dirty_edges, key=lambda x: estimate.durations[x],
+            reverse=True)[:NUM_SLOWEST_TARGETS]
+    if slowest:
+        print()
+        print("Slowest targets:")
+        for edge in slowest:
+            print("  {:>8}  {}".format(
+                format_duration(estimate.durations[edge] / 1000),
+                graph.describe_edge(edge)))
+
+    print()
+    print("Total CPU time:     {}".format(
+        format_duration(estimate.total_ms / 1000)))
+    print("Critical path:      {}".format(
+        format_duration(estimate.critical_path_ms / 1000)))
+    print("Predicted wall time with -j{}: {}".format(
+        nprocs, format_duration(wall_time_ms / 1000)))
+
+
+class BuildGraph:
+    """
+    The targets in a ninja build directory and the files each one depends on.  
+    Paths are stored once, as integer ids, so the graph is small enough to 
+    pickle and load quickly.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+        self.edge_rules = []
+        self.edge_outputs = []
+        self.edge_inputs = []
+        self.producers = {}
+        self.consumers = {}
+        self.build_path = None
+
+    def __getstate__(self):
+        # The id of each path can be rebuilt from the list of paths, which is 
+        # faster than pickling the dictionary.
+
+        state = dict(self.__dict__)
+        del state['ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.ids = {x: i for i, x in enumerate(self.paths)}
+
+    def get_node(self, path):
+        path = os.path.normpath(os.path.join(self.build_path, path))
+        if path not in self.ids:
+            self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return self.ids[path]
+
+    def find_node(self, path):
+        return self.ids.get(os.path.normpath(os.path.abspath(path)))
+
+    def add_manifest(self, manifest_path):
+        self.build_path = os.path.dirname(os.path.abspath(manifest_path))
+
+        for outputs, rule, inputs in iter_build_statements(manifest_path):
+            edge = len(self.edge_rules)
+            self.edge_rules.append(rule)
+            self.edge_outputs.append([self.get_node(x) for x in outputs])
+            self.edge_inputs.append([self.get_node(x) for x in inputs])
+
+            for node in self.edge_outputs[edge]:
+                self.producers[node] = edge
+            for node in self.edge_inputs[edge]:
+                self.consumers.setdefault(node, []).append(edge)
+
+    def add_deps(self, paths, deps):
+        # Each path in the log is only normalized once, even though most 
+        # headers are included by thousands of files.
+
+        from collections import defaultdict
+
+        nodes = [self.get_node(x) for x in paths]
+        consumers = defaultdict(list, self.consumers)
+
+        for output, inputs in deps.items():
+            try:
+                edge = self.producers.get(nodes[output])
+                input_nodes = list(map(nodes.__getitem__, inputs))
+            except IndexError:
+                continue
+            if edge is None:
+                continue
+
+            self.edge_inputs[edge] += input_nodes
+            for node in input_nodes:
+                consumers[node].append(edge)
+
+        self.consumers = dict(consumers)
+
+    def freeze(self):
+        """
+        Store the lists of ids as arrays, which take much less memory and are 
+        much faster to pickle and unpickle than lists of ints.
+        """
+        from array import array
+
+        self.edge_outputs = [array('i', x) for x in self.edge_outputs]
+        self.edge_inputs = [array('i', x) for x in self.edge_inputs]
+        self.consumers = {k: array('i', v) for k, v in self.consumers.items()}
+
+    def find_dirty_edges(self, changed_paths):
+        """
+        Return the set of build statements that would have to be rerun if the 
+        given files changed.  Phony statements are followed but not counted, 
+        since they don't take any time.
+        """
+        dirty = set()
+        queue = [x for x in map(self.find_node, changed_paths) if x is not None]
+
+        while queue:
+            node = queue.pop()
+            for edge in self.consumers.get(node, ()):
+                if edge not in dirty:
+                    dirty.add(edge)
+                    queue.extend(self.edge_outputs[edge])
+
+        return {x for x in dirty if self.edge_rules[x] != 'phony'}
+
+    def is_compile(self, edge):
+        return any(self.paths[x].endswith('.o') for x in self.edge_outputs[edge])
+
+    def describe_edge(self, edge):
+        return os.path.relpath(self.paths[self.edge_outputs[edge][0]], self.build_path)
+
+
+class Estimate:
+    """
+    How long each target that needs to be rebuilt is expected to take, and 
+    how long they're expected to take altogether.
+    """
+
+    def __init__(self, graph, dirty_edges, durations):
+        from statistics import median
+
+        self.graph = graph
+        self.dirty_edges = dirty_edges
+        self.durations = {}
+        self.num_guessed = 0
+        self.num_compiles = sum(graph.is_compile(x) for x in dirty_edges)
+
+        # Targets that have never been built are assumed to take as long as 
+        # a typical target of the same kind (i.e. compiling or linking).
+
+        known = {True: [], False: []}
+        for target, duration in durations.items():
+            known[target.endswith('.o')].append(duration)
+
+        typical = {
+                kind: median(values) if values else DEFAULT_DURATION_MS
+                for kind, values in known.items()
+        }
+
+        for edge in dirty_edges:
+            duration = durations.get(graph.describe_edge(edge))
+            if duration is None:
+                duration = typical[graph.is_compile(edge)]
+                self.num_guessed += 1
+            self.durations[edge] = duration
+
+        self.total_ms = sum(self.durations.values())
+        self.find_dependencies()
+        self.find_critical_paths()
+
+    def find_dependencies(self):
+        """
+        Work out which dirty targets have to wait for which other dirty 
+        targets, looking through any phony targets in between.
+        """
+        graph = self.graph
+        self.waiting_on = {x: set() for x in self.dirty_edges}
+        self.waited_on_by = {x: set() for x in self.dirty_edges}
+
+        for edge in self.dirty_edges:
+            seen = set()
+            queue = list(graph.edge_inputs[edge])
+
+            while queue:
+                node = queue.pop()
+                producer = graph.producers.get(node)
+                if producer is None or producer in seen:
+                    continue
+                seen.add(producer)
+
+                if producer in self.dirty_edges:
+                    self.waiting_on[edge].add(producer)
+                    self.waited_on_by[producer].add(edge)
+                elif graph.edge_rules[producer] == 'phony':
+                    queue.extend(graph.edge_inputs[producer])
+
+    def find_critical_paths(self):
+        """
+        Find the longest chain of targets that each target holds up, which is 
+        how ninja decides which target to start next.
+        """
+        self.critical_path = {}
+        remaining = {x: len(self.waited_on_by[x]) for x in self.dirty_edges}
+        queue = [x for x, n in remaining.items() if n == 0]
+
+        while queue:
+            edge = queue.pop()
+            self.critical_path[edge] = self.durations[edge] + max(
+                    (self.critical_path[x] for x in self.waited_on_by[edge]),
+                    default=0)
+            for dependency in self.waiting_on[edge]:
+                remaining[dependency] -= 1
+                if remaining[dependency] == 0:
+                    queue.append(dependency)
+
+        self.critical_path_ms = max(self.critical_path.values(), default=0)
+
+    def simulate(self, nprocs):
+        """
+        Return how many milliseconds it would take to build all the dirty 
+        targets with <nprocs> jobs at a time.
+        """
+        import heapq
+
+        remaining = {x: len(self.waiting_on[x]) for x in self.dirty_edges}
+        ready = [(-self.critical_path.get(x, 0), x) for x, n in remaining.items() if n == 0]
+        heapq.heapify(ready)
+        running = []
+        now = 0
+
+        while ready or running:
+            while ready and len(running) < nprocs:
+                priority, edge = heapq.heappop(ready)
+                heapq.heappush(running, (now + self.durations[edge], edge))
+
+            now, edge = heapq.heappop(running)
+            for dependent in self.waited_on_by[edge]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, (-self.critical_path.get(dependent, 0), dependent))
+
+        return now
+
+
+class WhatIfRequiresNinja (helpers.FatalBuildError):
+    exit_status = 2
+    exit_message = """\
+            The --what-if option only works with ninja, because it needs the
+            dependency log that ninja keeps in the build directory."""
+
+
+class NoDependencyLog (helpers.FatalBuildError):
+    exit_status = 4
+    exit_message = """\
+            Couldn't find ninja's dependency log in '{0}'.  Build this 
+            configuration at least once, so ninja knows which headers each
+            file includes."""
+
+    def __init__(self, build_path):
+        super().__init__(build_path)
+
+
+class UnknownChange (helpers.FatalBuildError):
+    exit_status = 4
+    exit_message = """\
+            '{0}' isn't a file or a git revision."""
+
+    def __init__(self, change):
+        super().__init__(change)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""\
+Run builds with as many concurrent jobs as there's memory for.
+
+The build tool is run as a client of a GNU make jobserver that's controlled 
+from here.  While the build runs, the memory used by each compiler (or linker) 
+process is sampled from /proc, and the number of jobserver tokens in 
+circulation is raised or lowered so that the jobs that are running, plus the 
+jobs that could be started, are expected to fit in the memory that's 
+available.  How much memory a job is expected to need comes from the peak 
+memory usage recorded for the same target in previous builds.
+
+This works with GNU make 4.0 or newer and with ninja 1.13 or newer.  Ninja 
+(and make 4.4 onwards) connect to the jobserver through a named pipe, while 
+older versions of make inherit the two ends of an anonymous pipe.
+"""
+
+import os, time
+from . import helpers
+
+SAMPLE_INTERVAL = 0.5
+DEFAULT_JOB_MEMORY = 1 << 30
+MEMORY_HEADROOM = 0.1
+MAX_TIMELINE_ROWS = 20
+
+def run_adaptive_build(build_path, build_command, max_jobs=None, verbose=False):
+    """
+    Run the given build command in the given build directory, adjusting how 
+    many jobs run at once based on how much memory is free.  The command must 
+    not have a '-j' option, since that would override the jobserver.  Return 
+    the exit status of the build tool.
+    """
+    import subprocess, shlex, tempfile
+    from . import history
+
+    style = get_jobserver_style(build_command[0])
+
+    max_jobs = int(max_jobs or os.cpu_count() or 1)
+    memory_path = os.path.join(build_path, '.rdt_target_memory')
+    governor = MemoryGovernor(max_jobs, read_target_memory(memory_path))
+
+    with tempfile.TemporaryDirectory(prefix='rdt_jobserver_') as fifo_dir:
+
+        # The governor opens its own end of the pipe, so that it can read 
+        # without blocking without changing how the build tool reads.  For an 
+        # anonymous pipe, that's done by reopening it through /proc.
+
+        if style == 'fifo':
+            fifo_path = os.path.join(fifo_dir, 'fifo')
+            os.mkfifo(fifo_path)
+            governor.open(fifo_path)
+            auth = 'fifo:' + fifo_path
+            pass_fds = ()
+        else:
+            pass_fds = os.pipe()
+            governor.open('/proc/self/fd/{}'.format(pass_fds[0]))
+            auth = '{},{}'.format(*pass_fds)
+
+        env = os.environ.copy()
+        env['MAKEFLAGS'] = ' '.join(x for x in (
+            '-j{}'.format(max_jobs),
+            '--jobserver-auth=' + auth,
+            env.get('MAKEFLAGS', ''),
+        ) if x)
+
+        if verbose:
+            print('$ cd', build_path)
+            print('$ MAKEFLAGS={}'.format(shlex.quote(env['MAKEFLAGS'])),
+                    ' '.join(shlex.quote(x) for x in build_command))
+
+        process = subprocess.Popen(
+                build_command, cwd=build_path, env=env, pass_fds=pass_fds)
+
+        for fd in pass_fds:
+            os.close(fd)
+
+        try:
+            while process.poll() is None:
+                governor.update(process.pid)
+                time.sleep(SAMPLE_INTERVAL)
+        except BaseException:
+            process.terminate()
+            process.wait()
+            raise
+        finally:
+            governor.close()
+
+    # Remember how much memory each target needed, so the next build can 
+    # plan for it, and report how many jobs were allowed to run over time.
+
+    target_memory = read_target_memory(memory_path)
+    target_memory.update(governor.observed_memory)
+    write_target_memory(memory_path, target_memory)
+    print_timeline(governor.timeline, max_jobs)
+    history.add_record(
+            'adaptive_build',
+            build_path=build_path,
+            max_jobs=max_jobs,
+            returncode=process.returncode,
+            timeline=downsample(governor.timeline, 100),
+    )
+
+    return process.returncode
+
+def get_jobserver_style(build_tool):
+    """
+    Return how the given build tool connects to a jobserver: either through a 
+    named pipe ('fifo') or through inherited file descriptors ('pipe').  Raise 
+    an error if the build tool can't be a jobserver client at all, since the 
+    build would silently run one job at a time.
+    """
+    import subprocess, re
+
+    name = os.path.basename(build_tool)
+    try:
+        stdout = subprocess.check_output((build_tool, '--version'))
+    except (OSError, subprocess.CalledProcessError):
+        raise JobserverNotSupported(name, 'unknown')
+
+    version_text = stdout.decode(errors='replace')
+    match = re.search(r'(\d+)\.(\d+)', version_text)
+    version = tuple(int(x) for x in match.groups()) if match else (0, 0)
+    minimum = (1, 13) if 'ninja' in name else (4, 0)
+
+    if version < minimum:
+        raise JobserverNotSupported(name, '.'.join(str(x) for x in version))
+
+    if 'ninja' in name or version >= (4, 4):
+        return 'fifo'
+    else:
+        return 'pipe'
+
+def read_target_memory(path):
+    import json
+
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+def write_target_memory(path, target_memory):
+    import json
+
+    with open(path + '.tmp', 'w') as file:
+        json.dump(target_memory, file, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def read_available_memory():
+    """
+    Return the total and available memory (in bytes) from /proc/meminfo.  The 
+    available memory is the kernel's estimate of how much could be allocated 
+    without swapping.
+    """
+    meminfo = {}
+    with open('/proc/meminfo') as file:
+        for line in file:
+            key, value = line.split(':', 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+
+    return meminfo['MemTotal'], meminfo.get('MemAvailable', meminfo['MemFree'])
+
+def find_build_jobs(root_pid):
+    """
+    Return a dictionary mapping the output file of each job running under the 
+    given process to the resident memory (in bytes) of that job.  A job is the 
+    topmost process with a '-o' argument (e.g. the compiler driver), and its 
+    memory includes all of its children (e.g. cc1plus or ld).
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children = {}
+    rss = {}
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as file:
+                stat = file.read()
+            with open('/proc/{}/statm'.format(name)) as file:
+                rss[int(name)] = int(file.read().split()[1]) * page_size
+        except (IOError, IndexError, ValueError):
+            continue
+
+        # The command name can contain spaces and parentheses, so the parent 
+        # pid is found by counting from the end of it.
+
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    def subtree_rss(pid):
+        return rss.get(pid, 0) + sum(subtree_rss(x) for x in children.get(pid, ()))
+
+    def find_jobs(pid):
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as file:
+                argv = file.read().decode(errors='replace').split('\0')
+        except IOError:
+            argv = []
+
+        if '-o' in argv[:-1]:
+            jobs[argv[argv.index('-o') + 1]] = subtree_rss(pid)
+        else:
+            for child in children.get(pid, ()):
+                find_jobs(child)
+
+    jobs = {}
+    for child in children.get(root_pid, ()):
+        find_jobs(child)
+
+    return jobs
+
+def downsample(timeline, max_points):
+    step = max(1, len(timeline) // max_points)
+    return timeline[::step]
+
+def print_timeline(timeline, max_jobs):
+    """
+    Print how many jobs were running, how many were allowed to run, and how 
+    much memory was available over the course of the build.
+    """
+    if not timeline:
+        return
+
+    print()
+    print("Adaptive concurrency (up to {} jobs):".format(max_jobs))
+    print("  {:>8}  {:>7}  {:>7}  {:>10}".format(
+        'time', 'running', 'allowed', 'available'))
+
+    step = max(1, len(timeline) // MAX_TIMELINE_ROWS)
+    for i in range(0, len(timeline), step):
+        chunk = timeline[i:i + step]
+        print("  {:>7.1f}s  {:>7.1f}  {:>7}  {:>10}".format(
+            chunk[0]['time'],
+            sum(x['running'] for x in chunk) / len(chunk),
+            min(x['allowed'] for x in chunk),
+            helpers.format_bytes(min(x['available'] for x in chunk))))
+
+    mean_running = sum(x['running'] for x in timeline) / len(timeline)
+    print("  Mean concurrency: {:.1f} jobs".format(mean_running))
+
+
+class MemoryGovernor:
+    """
+    The controlling end of a jobserver, which hands out as many tokens as 
+    there's expected to be memory for.
+    """
+
+    def __init__(self, max_jobs, target_memory):
+        self.max_jobs = max_jobs
+        self.target_memory = dict(target_memory)
+        self.observed_memory = {}
+        self.timeline = []
+        self.start_time = time.monotonic()
+        self.fd = None
+
+        # The client always has one implicit job, so the number of tokens in 
+        # circulation (in the pipe or held by running jobs) is one less than 
+        # the number of jobs that are allowed to run.
+
+        self.tokens = 0
+
+    def open(self, pipe_path):
+        # Open the pipe for reading and writing, so that opening it doesn't 
+        # block waiting for a client, and so it never sees end-of-file.
+
+        self.fd = os.open(pipe_path, os.O_RDWR | os.O_NONBLOCK)
+        self.set_allowed_jobs(1)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def update(self, root_pid):
+        jobs = find_build_jobs(root_pid)
+        total, available = read_available_memory()
+
+        # Plan for each target to need at least as much memory as it did last 
+        # time, but only remember what it needed this time.
+
+        for target, rss in jobs.items():
+            self.observed_memory[target] = max(rss, self.observed_memory.get(target, 0))
+            self.target_memory[target] = max(rss, self.target_memory.get(target, 0))
+
+        allowed = self.plan_allowed_jobs(jobs, total, available)
+        self.set_allowed_jobs(allowed)
+        self.timeline.append(dict(
+                time=time.monotonic() - self.start_time,
+                running=len(jobs),
+                allowed=allowed,
+                available=available,
+        ))
+
+    def plan_allowed_jobs(self, jobs, total, available):
+        """
+        Decide how many jobs should be allowed to run at once.  Running jobs 
+        are expected to grow to the peak memory they needed last time, and new 
+        jobs are expected to need about as much as a typical job.
+        """
+        typical = self.estimate_typical_job_memory()
+        growth = sum(
+                max(0, self.target_memory.get(target, typical) - rss)
+                for target, rss in jobs.items())
+        spare = available - growth - MEMORY_HEADROOM * total
+        allowed = len(jobs) + int(spare // typical)
+        return max(1, min(self.max_jobs, allowed))
+
+    def estimate_typical_job_memory(self):
+        """
+        Return the 90th percentile of the peak memory used by each target, so 
+        that most jobs will fit in the memory that's planned for them.
+        """
+        peaks = sorted(x for x in self.target_memory.values() if x > 0)
+        if not peaks:
+            return DEFAULT_JOB_MEMORY
+        return peaks[min(len(peaks) - 1, int(0.9 * len(peaks)))]
+
+    def set_allowed_jobs(self, allowed):
+        target_tokens = allowed - 1
+
+        # Tokens can be added right away.  Tokens can only be taken back once 
+        # they've been returned to the pipe, so it may take a few updates 
+        # before the number of running jobs falls to the new limit.
+
+        if target_tokens > self.tokens:
+            self.tokens += os.write(self.fd, b'+' * (target_tokens - self.tokens))
+
+        while target_tokens < self.tokens:
+            try:
+                taken = os.read(self.fd, self.tokens - target_tokens)
+            except BlockingIOError:
+                break
+            if not taken:
+                break
+            self.tokens -= len(taken)
+
+
+class JobserverNotSupported (helpers.FatalBuildError):
+    exit_status = 2
+    exit_message = """\
+            Adaptive builds need a build tool that can use a jobserver (ninja 
+            1.13 or GNU make 4.0, or newer), but {0} is version {1}.  Use 
+            --jobs instead."""
+
+    def __init__(self, build_tool, version):
+        super().__init__(build_tool, version)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""\
+Keep the state that the rdt commands share, like unit test aliases and cached 
+file hashes, in a small SQLite database.
+
+The database is '.rdt_state.sqlite' in the root of the checkout.  It's opened 
+in WAL mode, so any number of commands can read it while one of them writes, 
+and every change is made in a transaction, so commands running at the same 
+time can't corrupt it or undo each other's changes.  The database isn't 
+opened until something is actually read from it, and nothing is written 
+unless it actually changed.
+
+The first time the database is created, any aliases in the old 
+'.rdt_test.conf' file are imported into it.  After that, '.rdt_test.conf' is 
+no longer read or written.
+"""
+
+import os
+from . import helpers
+
+STATE_NAME = '.rdt_state.sqlite'
+LEGACY_CONFIG_NAME = '.rdt_test.conf'
+BUSY_TIMEOUT = 30
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS aliases (
+    name TEXT PRIMARY KEY, 
+    library TEXT NOT NULL, 
+    suite TEXT NOT NULL, 
+    test TEXT
+); 
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL, 
+    key TEXT NOT NULL, 
+    value TEXT NOT NULL, 
+    PRIMARY KEY (namespace, key)
+); 
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY, 
+    value TEXT
+);
+"""
+
+_stores = {}
+
+def get_state_path(rosetta_path=None):
+    rosetta_path = rosetta_path or helpers.find_rosetta_installation()
+    return os.path.join(rosetta_path, STATE_NAME)
+
+def open_state(rosetta_path=None):
+    """
+    Return the state store for the given checkout.  The same store is returned 
+    every time, and the database itself isn't opened until it's first used.
+    """
+    path = get_state_path(rosetta_path)
+    if path not in _stores:
+        _stores[path] = StateStore(path)
+    return _stores[path]
+
+
+class StateStore:
+    """
+    A lazily opened connection to the state database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = self.connect()
+        return self._connection
+
+    def connect(self):
+        import sqlite3
+        from . import tracing
+
+        with tracing.span('open_state'):
+            # Autocommit mode, so that reads don't hold a transaction open and 
+            # writes are only grouped when transaction() is used.
+
+            connection = sqlite3.connect(
+                    self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+
+            self._connection = connection
+            self.import_legacy_config()
+
+        return connection
+
+    def transaction(self):
+        """
+        Return a context manager that groups writes into one transaction.  The 
+        write lock is taken right away, so the transaction can't fail halfway 
+        through because another command started writing first.
+        """
+        from contextlib import contextmanager
+
+        @contextmanager
+        def transaction():
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            else:
+                connection.execute('COMMIT')
+
+        return transaction()
+
+    def import_legacy_config(self):
+        """
+        Copy the aliases from '.rdt_test.conf' into the database, if that 
+        hasn't been done yet.
+        """
+        import configparser
+
+        is_imported = self.connection.execute(
+                "SELECT 1 FROM meta WHERE key = 'imported_test_conf'").fetchone()
+        if is_imported:
+            return
+
+        config_path = os.path.join(
+                os.path.dirname(self.path), LEGACY_CONFIG_NAME)
+        config = configparser.ConfigParser()
+        config.read(config_path)
+
+        # Another command might be importing the same file at the same time, 
+        # so check again once the write lock is held.
+
+        with self.transaction() as connection:
+            is_imported = connection.execute(
+                    "SELECT 1 FROM meta WHERE key = 'imported_test_conf'").fetchone()
+            if is_imported:
+                return
+
+            for name in config.sections():
+                section = config[name]
+                if 'library' not in section or 'suite' not in section:
+                    continue
+                connection.execute(
+                        'INSERT OR IGNORE INTO aliases VALUES (?, ?, ?, ?)',
+                        (name, section['library'], section['suite'],
+                            section.get('test')))
+
+            connection.execute(
+                    "INSERT INTO meta VALUES ('imported_test_conf', ?)",
+                    (config_path,))
+
+    def get_alias(self, name):
+        """
+        Return the (library, suite, test) saved under the given alias, or None 
+        if there is no such alias.
+        """
+        row = self.connection.execute(
+                'SELECT library, suite, test FROM aliases WHERE name = ?',
+                (name,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_alias(self, name, library, suite, test=None):
+        """
+        Save the given test under the given alias.  Nothing is written if the 
+        alias already refers to the same test, which is usually the case for 
+        'repeat_previous'.
+        """
+        if self.get_alias(name) == (library, suite, test):
+            return
+
+        with self.transaction() as connection:
+            connection.execute(
+                    'INSERT OR REPLACE INTO aliases VALUES (?, ?, ?, ?)',
+                    (name, library, suite, test))
+
+    def get_cache(self, namespace):
+        """
+        Return every key and value saved in the given cache namespace, as a 
+        dictionary.  The values are whatever was passed to update_cache().
+        """
+        import json
+
+        rows = self.connection.execute(
+                'SELECT key, value FROM cache WHERE namespace = ?',
+                (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def update_cache(self, namespace, updates=(), deletions=()):
+        """
+        Save the given values (which must be JSON serializable) in the given 
+        cache namespace, and delete the given keys, all in one transaction.  
+        Keys that aren't mentioned are left alone, so commands that update the 
+        same cache at the same time don't clobber each other.
+        """
+        import json
+
+        updates = dict(updates)
+        deletions = list(deletions)
+
+        if not updates and not deletions:
+            return
+
+        with self.transaction() as connection:
+            connection.executemany(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                    ((namespace, k, json.dumps(v)) for k, v in updates.items()))
+            connection.executemany(
+                    'DELETE FROM cache WHERE namespace = ? AND key = ?',
+                    ((namespace, k) for k in deletions))
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""\
+Run many unit test suites with as few launches of the test binary as possible.
+
+Every suite calls core_init() in its setUp() method, and the first call in each 
+process loads a lot of the rosetta database.  Running each suite in its own 
+process pays that cost over and over, so suites are instead packed into 
+batches, each of which is run by a single invocation of the test binary.  
+Batches are sized so that each one is expected to take about the same amount 
+of time, based on how long each suite took in previous runs.  Suites that 
+failed the last time they were run go in the first batches, followed by the 
+suites that take the least time per expected failure, so that failures are 
+found as early as possible.
+
+If a batch fails (or crashes), there's no telling which of its suites was 
+responsible, so it's split in half and each half is run again.  This repeats 
+until every failing suite has been run on its own, while the suites that pass 
+are only rerun a handful of times.
+
+A batch only counts as passing if the test binary reports having run every 
+test in every suite of the batch.  CxxTest runners differ in how they treat 
+several suite names on the command line: some read the second one as the name 
+of a test in the first, and rosetta's passes anything after that on to 
+core_init(), which fails with an "unused free argument" error.  So before any 
+batches are run, a few quick suites are run together once to see whether the 
+test binary really runs them all.  If it doesn't, or if a batch later turns out 
+not to have run every test or fails because of its arguments, multi-suite 
+batches are given up on, and every remaining suite is run on its own, just 
+like 'rdt_unit_test' would run it.  Only real test failures are bisected.
+"""
+
+import os, re
+from . import helpers
+
+DEFAULT_SUITE_TIME = 5.0
+TEST_COUNT_PATTERN = re.compile(r'Running (?:\S+ tests \()?(\d+) tests?')
+ARGUMENT_ERROR = 'unused free argument'
+NUM_PROBE_SUITES = 3
+
+def run_test_batches(library, suites=None, build='debug', batch_time=60, nprocs=None, fail_fast=False, verbose=False):
+    """
+    Run the given suites (or every suite in the given library) in batches that 
+    are each expected to take about <batch_time> seconds, with up to <nprocs> 
+    batches running at once.  If <fail_fast> is set, stop starting new batches 
+    as soon as a failing suite has been found.  Return the number of suites 
+    that failed.
+    """
+    from . import processes, test_history
+    from .unit_test import compile_unit_test, get_unit_test_dir, find_test_names
+
+    compile_unit_test(library, build, verbose)
+
+    suites = suites or find_suites(library)
+    if not suites:
+        raise NoSuitesFound(library)
+
+    history = test_history.load_history()
+    keys = {x: test_history.get_test_key(library, x, build=build) for x in suites}
+    durations = history.get_durations(list(keys.values()), DEFAULT_SUITE_TIME)
+    suite_times = {x: durations[keys[x]] for x in suites}
+
+    batches = order_batches(suites, suite_times, batch_time, history, keys)
+    test_counts = {x: len(find_test_names(library, x)) for x in suites}
+    runner = BatchRunner(
+            library, get_unit_test_dir(build), suite_times, test_counts,
+            nprocs=int(nprocs or 1), fail_fast=fail_fast, verbose=verbose)
+
+    print("Running {} suites in {} batches.".format(len(suites), len(batches)))
+    processes.run(runner.run(batches))
+
+    # Remember how long each suite took and whether it failed, so the next run 
+    # can size and order its batches better.  Suites in batches that failed 
+    # are only recorded once they've been run in a batch that passed (or on 
+    # their own), since a crash says nothing about how long the other suites 
+    # in the batch would have taken.
+
+    results = []
+
+    for suites, wall_time in runner.passed_batches:
+        times = apportion_time(suites, suite_times, wall_time)
+        results += [(keys[x], times[x], True) for x in suites]
+
+    for suite, result in runner.failures.items():
+        results.append((keys[suite], result.wall_time, False))
+
+    test_history.add_results(results)
+
+    print_summary(runner)
+    return len(runner.failures)
+
+def find_suites(library):
+    """
+    Return the name of every suite in the given library that's listed in the 
+    library's test settings file.
+    """
+    rosetta_path = helpers.find_rosetta_installation()
+    test_dir = os.path.join(rosetta_path, 'source', 'test', library)
+    settings_path = os.path.join(
+            rosetta_path, 'source', 'test', library + '.test.settings')
+    suite_pattern = re.compile(
+            r'^\s*class\s+(\w+)\s*:\s*public\s+CxxTest::TestSuite', re.MULTILINE)
+
+    try:
+        with open(settings_path) as file:
+            settings = file.read()
+    except IOError:
+        settings = None
+
+    suites = []
+
+    for dir, subdirs, files in os.walk(test_dir):
+        for name in sorted(files):
+            if not name.endswith('.cxxtest.hh'):
+                continue
+
+            # Files that aren't in the settings file aren't compiled into the 
+            # test binary.
+
+            stem = name[:-len('.cxxtest.hh')]
+            if settings is not None and '"{}"'.format(stem) not in settings:
+                continue
+
+            with open(os.path.join(dir, name), errors='replace') as file:
+                suites += suite_pattern.findall(file.read())
+
+    return sorted(set(suites))
+
+def order_batches(suites, suite_times, batch_time, history, keys):
+    """
+    Pack the given suites into batches, and put the batches in the order they 
+    should be run.  The suites that failed last time are packed into batches 
+    of their own, which go first.  The rest of the batches are sorted by the 
+    highest priority suite in each.
+    """
+    rank = {}
+    for i, key in enumerate(history.prioritize(list(keys.values()))):
+        rank[key] = i
+
+    recent = set(history.find_recent_failures(list(keys.values())))
+    failed = [x for x in suites if keys[x] in recent]
+    others = [x for x in suites if keys[x] not in recent]
+
+    batches = []
+    for group in failed, others:
+        if not group:
+            continue
+        group_batches = pack_batches(group, suite_times, batch_time)
+        batches += sorted(group_batches, key=lambda x: min(rank[keys[y]] for y in x))
+
+    return batches
+
+def pack_batches(suites, suite_times, batch_time):
+    """
+    Divide the given suites into batches that are each expected to take about 
+    <batch_time> seconds.  A suite that's longer than <batch_time> on its own 
+    ends up in a batch by itself.
+    """
+    total_time = sum(suite_times[x] for x in suites)
+    num_batches = max(1, round(total_time / batch_time)) if batch_time > 0 else len(suites)
+    return divide_suites(suites, suite_times, min(num_batches, len(suites)))
+
+def divide_suites(suites, suite_times, num_batches):
+    """
+    Divide the given suites into the given number of batches, such that each 
+    batch is expected to take about the same amount of time.  The longest 
+    suites are placed first, each into the batch with the least work so far.
+    """
+    import heapq
+
+    batches = [(0, i, []) for i in range(num_batches)]
+
+    for suite in sorted(suites, key=lambda x: suite_times[x], reverse=True):
+        time, i, batch = heapq.heappop(batches)
+        batch.append(suite)
+        heapq.heappush(batches, (time + suite_times[suite], i, batch))
+
+    return [sorted(x[2]) for x in sorted(batches, key=lambda x: -x[0]) if x[2]]
+
+def apportion_time(suites, suite_times, wall_time):
+    """
+    Divide the wall time of a batch between its suites, in proportion to how 
+    long each suite was expected to take.
+    """
+    expected = sum(suite_times[x] for x in suites) or 1
+    return {x: wall_time * suite_times[x] / expected for x in suites}
+
+def print_summary(runner):
+    from nonstdlib import print_color
+
+    num_passed = sum(len(x) for x, wall_time in runner.passed_batches)
+    num_skipped = len(runner.suite_times) - num_passed - len(runner.failures)
+
+    print()
+    print("{} suites passed in {} runs of the test binary.".format(
+        num_passed, runner.num_launches))
+
+    if num_skipped:
+        print("{} suites weren't run, because of --fail-fast.".format(num_skipped))
+
+    for suite, result in sorted(runner.failures.items()):
+        print_color("FAILED: {} (exit status {})".format(
+            suite, result.returncode), 'red', 'bold')
+
+
+class BatchRunner:
+    """
+    Run batches of suites, splitting up any batch that fails until the 
+    failing suites have been run on their own.
+    """
+
+    def __init__(self, library, unit_test_dir, suite_times, test_counts, nprocs=1, fail_fast=False, verbose=False):
+        self.library = library
+        self.unit_test_dir = unit_test_dir
+        self.suite_times = suite_times
+        self.test_counts = test_counts
+        self.can_batch = True
+        self.nprocs = nprocs
+        self.fail_fast = fail_fast
+        self.verbose = verbose
+        self.passed_batches = []
+        self.failures = {}
+        self.num_launches = 0
+
+    async def run(self, batches):
+        import asyncio
+
+        self.limiter = asyncio.Semaphore(self.nprocs)
+
+        if any(len(x) > 1 for x in batches):
+            await self.probe_batching()
+
+        await asyncio.gather(*(self.run_batch(x) for x in batches))
+
+    async def probe_batching(self):
+        """
+        Run the quickest few suites together once, to find out whether the test 
+        binary really runs every suite it's given.  The results don't count 
+        for anything else; the suites are run again in their own batches.
+        """
+        from . import processes
+
+        suites = sorted(
+                (x for x in self.suite_times if self.test_counts.get(x)),
+                key=lambda x: self.suite_times[x])[:NUM_PROBE_SUITES]
+
+        if len(suites) > 1:
+            result = await processes.run_process(
+                    self.get_command(suites), self.unit_test_dir, capture=True)
+            self.num_launches += 1
+
+            if result.returncode == 0 and self.ran_every_test(suites, result):
+                return
+
+        self.can_batch = False
+        print("The test binary doesn't seem to run several suites at once, so "
+              "each suite will be run on its own.")
+
+    async def run_batch(self, suites):
+        # Batches are started in the order they were given, as processes become 
+        # available.  If a batch fails, it's split up without giving up its 
+        # place, so finding the failing suite doesn't have to wait for all the 
+        # batches queued behind it.
+
+        async with self.limiter:
+            await self.split_batch(suites)
+
+    async def split_batch(self, suites):
+        from . import processes
+
+        # With --fail-fast, nothing more is started once a failing suite has 
+        # been found.
+
+        if self.fail_fast and self.failures:
+            return
+
+        # Once the test binary has been caught not running a whole batch, run 
+        # each suite by itself.
+
+        if len(suites) > 1 and not self.can_batch:
+            for suite in suites:
+                await self.split_batch([suite])
+            return
+
+        result = await processes.run_process(
+                self.get_command(suites), self.unit_test_dir, capture=True)
+        self.num_launches += 1
+
+        # A batch that exited successfully without running everything, or 
+        # that failed because the test binary didn't accept its arguments, 
+        # says nothing about whether its suites pass.
+
+        is_unconfirmed = len(suites) > 1 and (
+                ARGUMENT_ERROR in result.text or (
+                    result.returncode == 0 and
+                    not self.ran_every_test(suites, result)))
+
+        if is_unconfirmed:
+            self.can_batch = False
+            print("Couldn't confirm that every suite in a batch of {} was "
+                  "run, so each suite will be run on its own.".format(
+                      len(suites)))
+            for suite in suites:
+                await self.split_batch([suite])
+            return
+
+        if result.returncode == 0:
+            self.passed_batches.append((suites, result.wall_time))
+            print("Passed {} suite{} ({:.1f}s){}".format(
+                len(suites), '' if len(suites) == 1 else 's', result.wall_time,
+                ': ' + ', '.join(suites) if self.verbose or len(suites) == 1 else ''))
+            return
+
+        if len(suites) == 1:
+            self.failures[suites[0]] = result
+            print("Failed {} (exit status {}):".format(
+                suites[0], result.returncode))
+            print(result.text, end='')
+            return
+
+        # Split the batch in half and try again.  The halves have about the 
+        # same expected run time, so neither one holds up the other for long.
+
+        print("A batch of {} suites failed (exit status {}), splitting it up.".format(
+            len(suites), result.returncode))
+
+        for half in divide_suites(suites, self.suite_times, 2):
+            await self.split_batch(half)
+
+    def ran_every_test(self, suites, result):
+        """
+        Return true if the output of the given batch shows that every test in 
+        every one of its suites was run.  A suite run on its own is trusted 
+        like any other single-suite run, since that's how the test binary is 
+        meant to be used.
+        """
+        if len(suites) == 1:
+            return True
+
+        # If a suite's tests couldn't be found, the expected count could 
+        # match even if that suite wasn't run.
+
+        if any(self.test_counts.get(x, 0) == 0 for x in suites):
+            return False
+
+        counts = [int(x) for x in TEST_COUNT_PATTERN.findall(result.text)]
+        return sum(counts) == sum(self.test_counts[x] for x in suites)
+
+    def get_command(self, suites):
+        # Like get_unit_test_command(), but with every suite in the batch.  
+        # The "-mute all" argument is needed for the same reason.
+
+        return ('./{}.test'.format(self.library),) + tuple(suites) + (
+                '-unmute' if self.verbose else '-mute', 'all')
+
+
+class NoSuitesFound (helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Couldn't find any test suites for '{0}'.  Make sure the library 
+            name is right, and that its *.cxxtest.hh files are listed in
+            'source/test/{0}.test.settings'."""
+
+    def __init__(self, library):
+        super().__init__(library)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""\
+Remember how long each unit test takes and how often it fails, so that runs 
+covering many tests can start with the ones most likely to fail quickly.
+
+The history is stored in '.rdt_test_history' in the root of the checkout, 
+right next to '.rdt_state.sqlite'.  Each run of a test appends one short line 
+to that file:
+
+    <test> <time> <duration> <passed>
+
+Once the file has many more lines than there are tests, it's compacted: the 
+lines for each test are folded into a single summary line, which starts with 
+'=' and gives the number of runs, the number of failures, the typical 
+duration, and the times of the last failure and the last run.  Appending only 
+takes a shared lock, and compacting takes an exclusive one, so concurrent runs 
+never lose each other's results.
+"""
+
+import os
+from . import helpers
+
+MAX_RUNS = 50
+DURATION_WEIGHT = 0.5
+COMPACT_SLACK = 500
+
+def get_test_history_path():
+    rosetta_path = helpers.find_rosetta_installation()
+    return os.path.join(rosetta_path, '.rdt_test_history')
+
+def get_test_key(library, suite, test=None, build='debug'):
+    """
+    Return the name a test's results are filed under.  The build is part of 
+    the name, because the same test can take very different amounts of time in 
+    debug and release mode.
+    """
+    name = '{}:{}'.format(library, suite)
+    if test is not None:
+        name += '::' + test
+    return '{}/{}'.format(build, name)
+
+def add_results(results):
+    """
+    Append the given (key, duration, passed) tuples to the history, and 
+    compact the history if it's gotten long.
+    """
+    import time
+
+    now = time.time()
+    lines = ''.join(
+            '{}\t{:.3f}\t{:.3f}\t{:d}\n'.format(key, now, duration, passed)
+            for key, duration, passed in results)
+
+    # Write everything with a single call, so that lines from concurrent 
+    # processes don't get interleaved.
+
+    path = get_test_history_path()
+    with lock_history(path, exclusive=False):
+        with open(path, 'a') as file:
+            file.write(lines)
+
+    history = TestHistory.load(path)
+    if history.needs_compaction():
+        compact_history(path)
+
+def add_result(key, duration, passed):
+    add_results([(key, duration, passed)])
+
+def load_history():
+    return TestHistory.load(get_test_history_path())
+
+def compact_history(path):
+    """
+    Rewrite the history with one summary line per test.  The new file is 
+    written next to the old one and renamed over it, so a crash can't leave a 
+    half-written history behind.
+    """
+    with lock_history(path, exclusive=True):
+        history = TestHistory.load(path)
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            for key, stats in sorted(history.stats.items()):
+                file.write(stats.to_line(key))
+
+        os.replace(tmp_path, path)
+
+def lock_history(path, exclusive):
+    """
+    Return a context manager that locks the history.  The lock is taken on a 
+    separate file, because compaction replaces the history file itself.
+    """
+    import fcntl
+    from contextlib import contextmanager
+
+    @contextmanager
+    def locked():
+        with open(path + '.lock', 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    return locked()
+
+
+class TestHistory:
+    """
+    The summarized results for every test in the history.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.num_lines = 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the given history file.  Lines that can't be parsed (e.g. because 
+        a run was killed while writing it) are skipped.
+        """
+        history = cls()
+
+        try:
+            file = open(path)
+        except FileNotFoundError:
+            return history
+
+        with file:
+            for line in file:
+                history.num_lines += 1
+                fields = line.rstrip('\n').split('\t')
+
+                try:
+                    if fields[0] == '=':
+                        key, stats = TestStats.from_line(fields)
+                        history.stats[key] = stats
+                    else:
+                        key, time, duration, passed = fields
+                        history.stats.setdefault(key, TestStats()).add_run(
+                                float(time), float(duration), passed == '1')
+                except ValueError:
+                    continue
+
+        return history
+
+    def needs_compaction(self):
+        return self.num_lines > 2 * len(self.stats) + COMPACT_SLACK
+
+    def get_durations(self, keys, default=5.0):
+        """
+        Return how long each of the given tests is expected to take.  Tests 
+        that have never been run are assumed to take as long as a typical 
+        test.
+        """
+        from statistics import median
+
+        known = [self.stats[x].duration for x in keys if x in self.stats]
+        typical = median(known) if known else default
+        return {
+                x: self.stats[x].duration if x in self.stats else typical
+                for x in keys}
+
+    def prioritize(self, keys, default=5.0):
+        """
+        Return the given tests in the order they should be run to find 
+        failures as soon as possible: first the tests that failed the last 
+        time they were run (most recent first), then the rest in order of how 
+        long they take per expected failure, so fast and flaky tests go 
+        before slow and reliable ones.
+        """
+        durations = self.get_durations(keys, default)
+
+        def sort_key(key):
+            stats = self.stats.get(key)
+
+            if stats and stats.last_run_failed:
+                return 0, -stats.last_failure
+
+            return 1, durations[key] / TestStats.get_failure_rate(stats)
+
+        return sorted(keys, key=sort_key)
+
+    def find_recent_failures(self, keys):
+        return [x for x in keys
+                if x in self.stats and self.stats[x].last_run_failed]
+
+
+class TestStats:
+    """
+    How many times a test was run and failed, how long it typically takes, 
+    and when it last failed and was last run.
+    """
+
+    def __init__(self, runs=0, failures=0, duration=None, last_failure=0, last_run=0):
+        self.runs = runs
+        self.failures = failures
+        self.duration = duration
+        self.last_failure = last_failure
+        self.last_run = last_run
+
+    def __repr__(self):
+        return 'TestStats(runs={}, failures={}, duration={})'.format(
+                self.runs, self.failures, self.duration)
+
+    @classmethod
+    def from_line(cls, fields):
+        marker, key, runs, failures, duration, last_failure, last_run = fields
+        return key, cls(
+                float(runs), float(failures), float(duration),
+                float(last_failure), float(last_run))
+
+    def to_line(self, key):
+        return '=\t{}\t{:g}\t{:g}\t{:.3f}\t{:.3f}\t{:.3f}\n'.format(
+                key, self.runs, self.failures, self.duration or 0,
+                self.last_failure, self.last_run)
+
+    @property
+    def last_run_failed(self):
+        return self.last_failure > 0 and self.last_failure >= self.last_run
+
+    @staticmethod
+    def get_failure_rate(stats):
+        # Assume one pass and one failure before any runs were recorded, so 
+        # that new tests count as likely to fail and no rate is ever zero.
+        if stats is None:
+            return 0.5
+        return (stats.failures + 1) / (stats.runs + 2)
+
+    def add_run(self, time, duration, passed):
+        self.runs += 1
+        self.last_run = max(self.last_run, time)
+
+        if not passed:
+            self.failures += 1
+            self.last_failure = max(self.last_failure, time)
+
+        # Failing runs often crash early, so they only set the duration if 
+        # the test has never passed.  Passing runs update a moving average.
+
+        if self.duration is None:
+            self.duration = duration
+        elif passed:
+            self.duration += DURATION_WEIGHT * (duration - self.duration)
+
+        # Only the most recent runs count towards the failure rate, so a test 
+        # that used to be broken isn't run first forever.
+
+        if self.runs > MAX_RUNS:
+            self.failures *= MAX_RUNS / self.runs
+            self.runs = MAX_RUNS
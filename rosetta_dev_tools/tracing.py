@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""\
+Record where the time goes in rdt commands, in Chrome's trace event format.
+
+Tracing is off unless it's turned on, either with the --trace option of a 
+command or by setting $RDT_TRACE to the path of the file to write.  When it's 
+on, each stage of the command (e.g. finding rosetta, running cmake, running 
+ninja, running the test) is recorded as a span, and the trace is written when 
+the command exits.  Open the file in chrome://tracing or ui.perfetto.dev to 
+see it.
+
+When tracing is off, span() returns a shared do-nothing context manager, so 
+the spans cost almost nothing.
+"""
+
+import os, time
+
+TRACE_VARIABLE = 'RDT_TRACE'
+NINJA_LANE_OFFSET = 1000
+
+_tracer = None
+
+def start_tracing(path=None):
+    """
+    Start recording a trace to the given path, or to the path in $RDT_TRACE if 
+    no path is given.  If neither is set, tracing stays off.
+    """
+    global _tracer
+    import atexit
+
+    path = path or os.environ.get(TRACE_VARIABLE)
+
+    if path:
+        _tracer = Tracer(path)
+        atexit.register(_tracer.save)
+    else:
+        _tracer = False
+
+    return _tracer or None
+
+def get_tracer():
+    if _tracer is None:
+        start_tracing()
+    return _tracer or None
+
+def is_enabled():
+    return get_tracer() is not None
+
+def span(name, category='rdt', **args):
+    """
+    Return a context manager that records the time spent inside it as a span 
+    with the given name.  Any keyword arguments are shown with the span in the 
+    trace viewer.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, category, args)
+
+def get_ninja_log_size(build_path):
+    try:
+        return os.path.getsize(os.path.join(build_path, '.ninja_log'))
+    except OSError:
+        return 0
+
+def trace_ninja_log(build_path, offset, start_time):
+    """
+    Add a span for every target ninja built, using the entries added to 
+    '.ninja_log' after the given offset.  Ninja records times in milliseconds 
+    since it started, which was at <start_time> (from time.perf_counter()).  
+    Targets that were built at the same time are put in separate rows.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        return
+
+    # If the log shrank, ninja recompacted it before building, and there's no 
+    # way to tell which entries came from this build.
+
+    log_path = os.path.join(build_path, '.ninja_log')
+    if get_ninja_log_size(build_path) < offset:
+        return
+
+    # Each line of the log is: start (ms), end (ms), mtime, target, hash.  A 
+    # new log starts with a header line, which is skipped.
+
+    entries = []
+    with open(log_path, errors='replace') as file:
+        file.seek(offset)
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(fields) < 4:
+                continue
+            entries.append((int(fields[0]), int(fields[1]), fields[3]))
+
+    lane_ends = []
+    for start_ms, end_ms, target in sorted(entries):
+        for lane, lane_end in enumerate(lane_ends):
+            if lane_end <= start_ms:
+                break
+        else:
+            lane = len(lane_ends)
+            lane_ends.append(0)
+            tracer.name_thread(
+                    NINJA_LANE_OFFSET + lane, 'ninja job {}'.format(lane + 1))
+
+        lane_ends[lane] = end_ms
+        tracer.add_event(
+                os.path.basename(target), 'ninja',
+                start=start_time + start_ms / 1000,
+                duration=(end_ms - start_ms) / 1000,
+                tid=NINJA_LANE_OFFSET + lane,
+                args={'target': target})
+
+
+class Tracer:
+    """
+    Collect trace events in memory, and write them all to a file at the end.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_ids = {}
+        self.name_thread(self.get_thread_id(), 'main')
+
+    def get_thread_id(self):
+        """
+        Return a small number for the current thread, since the trace viewer 
+        sorts threads by id and python's thread idents are huge.
+        """
+        import threading
+
+        ident = threading.get_ident()
+        if ident not in self.thread_ids:
+            self.thread_ids[ident] = len(self.thread_ids) + 1
+        return self.thread_ids[ident]
+
+    def name_thread(self, tid, name):
+        self.events.append({
+                'name': 'thread_name', 'ph': 'M',
+                'pid': self.pid, 'tid': tid,
+                'args': {'name': name},
+        })
+
+    def add_event(self, name, category, start, duration, tid=None, args=None):
+        """
+        Add a complete ('X') event.  The start time comes from 
+        time.perf_counter() and both times are in seconds; the trace format 
+        wants microseconds.
+        """
+        event = {
+                'name': name, 'cat': category, 'ph': 'X',
+                'ts': start * 1e6, 'dur': duration * 1e6,
+                'pid': self.pid,
+                'tid': tid if tid is not None else self.get_thread_id(),
+        }
+        if args:
+            event['args'] = {k: str(v) for k, v in args.items()}
+        self.events.append(event)
+
+    def save(self):
+        import json
+
+        trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(trace, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Span:
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add_event(
+                self.name, self.category,
+                start=self.start,
+                duration=time.perf_counter() - self.start,
+                args=self.args)
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
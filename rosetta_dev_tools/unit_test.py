@@ -9,6 +9,7 @@ because the CxxTest executable passes unrecognized arguments onto rosetta, and
 rosetta doesn't know what to do with it.
 
 Usage:
+    rdt_test --batch <library> [<suites>...] [options]
     rdt_test [<alias>] [options]
     rdt_test <library> <suite> [<test>] [options]
 
@@ -19,7 +20,87 @@ Options:
 
     -d, --gdb
         Run the unit test in the debugger.  Once the debugger starts, enter 'r' 
-        to start running the test.
+        to start running the test.  The first time a newly linked test binary 
+        is debugged, an index of its debugging symbols is built and cached, 
+        which makes every later startup much faster.
+
+    -g, --gdb-session
+        Like --gdb, but keep the debugger running in a tmux session between 
+        runs.  Detach from the session (Ctrl-b d) instead of quitting gdb, and 
+        the next run of the same test will reattach to it instantly instead of 
+        loading all the debugging symbols again.
+
+    -B, --batch
+        Run the given suites (or every suite in the given library) with as few 
+        runs of the test binary as possible, so that the rosetta database only 
+        has to be loaded once for many suites.  The suites are packed into 
+        batches based on how long each one took in previous runs.  If a batch 
+        fails, it's split up and run again until the failing suites have been 
+        run on their own.
+
+    --batch-time SECONDS        [default: 60]
+        How long each batch should take, with --batch.
+
+    -x, --fail-fast
+        Stop starting new batches as soon as a failing suite has been found, 
+        with --batch.  Suites that failed the last time they were run are 
+        always run first, followed by the suites that are fastest and most 
+        likely to fail.
+
+    -j, --jobs NUM
+        How many batches to run at once, with --batch.  By default, one batch 
+        is run at a time.
+
+    -b, --build <build>         [default: debug]
+        Which build configuration (e.g. debug or release) to compile and run 
+        the unit test in.
+
+    -n, --benchmark NUM
+        Run the unit test NUM times and report how long it took.  If a whole 
+        suite is given, each test in the suite is timed separately.  The 
+        results are saved, and compared against previous results to flag any 
+        tests that have gotten slower.  You'll usually want to benchmark in 
+        release mode, e.g. '--build release'.
+
+    -w, --warmup NUM            [default: 1]
+        How many untimed runs to make before the timed runs, when benchmarking.
+
+    -l, --label <label>
+        Save the benchmark results under the given label (e.g. the name of the 
+        branch being tested), so they can be used as a baseline later.
+
+    -c, --compare-to <label>
+        Compare the benchmark results to the most recent results saved with 
+        the given label.  By default, the results are compared to the previous 
+        benchmark of the same test.
+
+    -t, --threshold PERCENT     [default: 5]
+        How much slower (in percent) a test has to get before it's flagged as a 
+        regression.
+
+    -p, --profile <profiler>
+        Run the unit test under a profiler, either 'perf' or 'callgrind'.  The 
+        test is compiled in release mode with debugging symbols (in a separate 
+        'build_release_symbols' directory) regardless of the --build option.  
+        The profile is summarized as a flamegraph and a table of the hottest 
+        functions, which is compared to the previous profile of the same test.  
+        Profiles are kept in '.rdt_profiles' in the root of your checkout.
+
+    -m, --heap-profile
+        Run the unit test under a heap profiler (heaptrack if it's installed, 
+        otherwise valgrind's massif tool) and summarize which parts of the code 
+        allocated the most memory at the peak.
+
+    --top NUM                   [default: 20]
+        How many functions (or allocation sites) to show in the profiling 
+        summary.
+
+    --trace FILE
+        Record how long each stage (e.g. finding rosetta, running cmake, 
+        building each target, and running the test) takes and write it to the 
+        given file in Chrome's trace format, which can be opened in 
+        chrome://tracing or ui.perfetto.dev.  Setting $RDT_TRACE to a file 
+        name does the same thing.
 
     -v, --verbose
         Output each command line that gets run, in case something needs to be 
@@ -27,16 +108,30 @@ Options:
 """
 
 import sys, os
-from . import helpers
+from . import helpers, tracing
 
 def main():
-    import docopt
-    args = docopt.docopt(__doc__)
+    args = helpers.parse_args(__doc__)
+    tracing.start_tracing(args['--trace'])
 
     if not args['<library>'] and not args['<alias>']:
         args['<alias>'] = 'repeat_previous'
 
     try:
+        if args['--batch']:
+            from .test_batches import run_test_batches
+
+            num_failures = run_test_batches(
+                    args['<library>'],
+                    suites=args['<suites>'],
+                    build=args['--build'],
+                    batch_time=float(args['--batch-time']),
+                    nprocs=args['--jobs'],
+                    fail_fast=args['--fail-fast'],
+                    verbose=args['--verbose'],
+            )
+            sys.exit(1 if num_failures else 0)
+
         library, suite, test = pick_unit_test(
                 library=args['<library>'],
                 suite=args['<suite>'],
@@ -44,86 +139,468 @@ def main():
                 alias=args['<alias>'],
                 save_as=args['--save-as'],
         )
-        run_unit_test(
-                library, suite, test,
-                gdb=args['--gdb'],
-                verbose=args['--verbose'],
-        )
+        name = get_test_name(
+                library, suite, test, args['<alias>'], args['--save-as'])
+
+        if args['--profile']:
+            profile_unit_test(
+                    library, suite, test,
+                    profiler=args['--profile'],
+                    name=name,
+                    top=int(args['--top']),
+                    verbose=args['--verbose'],
+            )
+        elif args['--heap-profile']:
+            heap_profile_unit_test(
+                    library, suite, test,
+                    build=args['--build'],
+                    name=name,
+                    top=int(args['--top']),
+                    verbose=args['--verbose'],
+            )
+        elif args['--benchmark']:
+            benchmark_unit_test(
+                    library, suite, test,
+                    name=name,
+                    build=args['--build'],
+                    num_runs=parse_run_count(args['--benchmark']),
+                    num_warmups=int(args['--warmup']),
+                    label=args['--label'],
+                    baseline=args['--compare-to'],
+                    threshold=float(args['--threshold']),
+                    verbose=args['--verbose'],
+            )
+        else:
+            run_unit_test(
+                    library, suite, test,
+                    name=name,
+                    build=args['--build'],
+                    gdb=args['--gdb'],
+                    gdb_session=args['--gdb-session'],
+                    verbose=args['--verbose'],
+            )
+    except KeyboardInterrupt:
+        helpers.exit_interrupted()
+
     except helpers.FatalBuildError as error:
         error.exit_gracefully()
 
 def pick_unit_test(library, suite, test=None, alias=None, save_as=None):
-    # Read the unit testing config file, which gives aliases to commonly used 
-    # test settings.
-
-    import configparser
+    # Aliases give names to commonly used test settings.  They're kept in the 
+    # state database, which is only opened if an alias is actually used.
 
-    rosetta_path = helpers.find_rosetta_installation()
-    config_path = os.path.join(rosetta_path, '.rdt_test.conf')
+    from . import state
 
-    config = configparser.ConfigParser()
-    config.read(config_path)
+    store = state.open_state()
 
     # If an alias is given, read the library, suite, and test settings from the 
-    # config file.  Complain if the given alias is not in the config file.
+    # database.  Complain if the given alias doesn't exist.
 
     if alias is not None:
-        try:
-            library = config[alias]['library']
-            suite = config[alias]['suite']
-            test = config[alias].get('test')
-        except KeyError:
+        with tracing.span('read_alias'):
+            settings = store.get_alias(alias)
+        if settings is None:
             raise BadAliasError(alias)
+        library, suite, test = settings
 
     # If a "Save As" alias is given, save the library, suite, and test settings 
-    # under that alias.
+    # under that alias.  This happens on almost every run (for the 
+    # 'repeat_previous' alias), but nothing is written unless the settings 
+    # changed.
 
     if save_as is not None:
-        if save_as not in config:
-            config.add_section(save_as)
-
-        config[save_as]['library'] = library
-        config[save_as]['suite'] = suite
-        if test is not None:
-            config[save_as]['test'] = test
-
-        with open(config_path, 'w') as file:
-            config.write(file)
+        store.set_alias(save_as, library, suite, test)
 
     return library, suite, test
 
-def run_unit_test(library, suite, test=None, gdb=False, verbose=False):
+def run_unit_test(library, suite, test=None, name=None, build='debug', gdb=False, gdb_session=False, verbose=False):
+    from . import history, test_history, debugger
+
     # Compile the unit test.
 
+    compile_unit_test(library, build, verbose)
+
+    # Make sure gdb won't have to index the test binary from scratch.  If the 
+    # debugger should be kept running between runs, hand the test off to it.
+
+    unit_test_cmd = ()
+    unit_test_dir = get_unit_test_dir(build)
+
+    if gdb or gdb_session:
+        binary_path = os.path.join(unit_test_dir, library + '.test')
+        debugger.prepare_gdb_index(binary_path, verbose=verbose)
+
+    if gdb_session:
+        debugger.attach_gdb_session(
+                name or get_test_name(library, suite, test),
+                unit_test_dir,
+                get_unit_test_command(library, suite, test, verbose),
+                verbose=verbose)
+        return
+
+    if gdb:
+        unit_test_cmd += debugger.get_gdb_command() + ('--args',)
+
+    # Run the unit test.
+
+    unit_test_cmd += get_unit_test_command(library, suite, test, verbose)
+
+    with tracing.span('run_unit_test', library=library, suite=suite, test=test):
+        usage = helpers.measured_shell_command(
+                unit_test_dir, unit_test_cmd, check=False, verbose=verbose)
+
+    # Report how much time and memory the test used, and keep a record of it 
+    # so that changes in memory usage can be tracked over time.  Runs in the 
+    # debugger are skipped, since they mostly measure how long you spent in 
+    # the debugger.
+
+    if not gdb:
+        print_resource_usage(usage)
+        history.add_record(
+                'test_run',
+                name=name or get_test_name(library, suite, test),
+                library=library,
+                suite=suite,
+                test=test,
+                build=build,
+                returncode=usage.returncode,
+                **usage.to_dict()
+        )
+        test_history.add_result(
+                test_history.get_test_key(library, suite, test, build),
+                usage.wall_time, usage.returncode == 0)
+
+def print_resource_usage(usage):
+    print("Wall time: {:.2f}s  CPU time: {:.2f}s (user {:.2f}s, system {:.2f}s)  Peak memory: {}  Page faults: {} minor, {} major".format(
+        usage.wall_time, usage.cpu_time, usage.user_time, usage.system_time,
+        helpers.format_bytes(usage.max_rss),
+        usage.minor_faults, usage.major_faults))
+
+def compile_unit_test(library, build='debug', verbose=False):
     from .build import build_rosetta
 
-    error_code = build_rosetta(
-            'debug', library + '.test',
-            verbose=verbose,
-    )
+    with tracing.span('compile_unit_test', library=library, build=build):
+        error_code = build_rosetta(
+                build, library + '.test',
+                verbose=verbose,
+        )
     if error_code:
         sys.exit(error_code)
 
-    # Run the unit test.
+def get_unit_test_dir(build='debug', rosetta_path=None):
+    return os.path.join(
+            rosetta_path or helpers.find_rosetta_installation(),
+            'source', 'cmake', 'build_' + build)
 
-    unit_test_cmd = ()
-    unit_test_dir = os.path.join(
-            helpers.find_rosetta_installation(),
-            'source', 'cmake', 'build_debug')
-    if gdb:
-        unit_test_cmd += 'gdb', '--args'
-    
+def get_unit_test_command(library, suite, test=None, verbose=False):
     # The "-mute all" argument is actually critically important because it 
     # covers up a bug in core_init().  If only one argument is passed the unit 
     # test script, core_init() tries to add "-mute all" and ends up failing, I 
     # think because it gets $0 wrong.
 
-    unit_test_cmd += './{}.test'.format(library), suite,
+    unit_test_cmd = './{}.test'.format(library), suite,
     if test is not None: unit_test_cmd += test,
     unit_test_cmd += '-unmute' if verbose else '-mute', 'all'
+    return unit_test_cmd
+
+def get_test_name(library, suite, test=None, alias=None, save_as=None):
+    """
+    Return the name that results for the given test should be saved under.  
+    That's the alias the test was run with, if it had one, or else the name of 
+    the test itself.
+    """
+    for name in alias, save_as:
+        if name and name != 'repeat_previous':
+            return name
+
+    return '.'.join(x for x in (library, suite, test) if x)
+
+def find_test_names(library, suite):
+    """
+    Return the names of the test_*() methods in the given suite, in the order 
+    they're defined.  The suite is found by looking for a *.cxxtest.hh file 
+    with the same name in the library's test directory.  An empty list is 
+    returned if the suite can't be found.
+    """
+    import re
+
+    test_dir = os.path.join(
+            helpers.find_rosetta_installation(), 'source', 'test', library)
+    test_pattern = re.compile(r'^\s*void\s+(test_\w+)\s*\(', re.MULTILINE)
+
+    for dir, subdirs, files in os.walk(test_dir):
+        if suite + '.cxxtest.hh' in files:
+            with open(os.path.join(dir, suite + '.cxxtest.hh')) as file:
+                return test_pattern.findall(file.read())
+
+    return []
+
+def benchmark_unit_test(library, suite, test=None, name=None, build='debug', num_runs=5, num_warmups=1, label=None, baseline=None, threshold=5, verbose=False):
+    """
+    Run the given unit test (or each test in the given suite) several times, 
+    report statistics on how long each run took, and save the results to the 
+    history so they can be compared against later.
+    """
+    from . import history
+
+    compile_unit_test(library, build, verbose)
+
+    # Time each test in the suite separately, so that it's possible to tell 
+    # which test got slower.  If the tests can't be found, time the whole 
+    # suite at once.
+
+    if test is not None:
+        tests = [test]
+    else:
+        tests = find_test_names(library, suite) or [None]
+
+    results = []
+    alias = name
+
+    for test in tests:
+        name = suite if test is None else '{}::{}'.format(suite, test)
+        usages = time_unit_test(
+                library, suite, test, build, num_runs, num_warmups, verbose)
+        samples = [x.wall_time for x in usages]
+
+        # Find the results to compare against before recording the new ones, 
+        # so that a run doesn't get compared against itself.
+
+        reference = find_baseline(library, suite, test, build, baseline)
+        record = history.add_record(
+                'benchmark',
+                name=alias or get_test_name(library, suite, test),
+                library=library,
+                suite=suite,
+                test=test,
+                build=build,
+                label=label,
+                samples=samples,
+                max_rss=max(x.max_rss for x in usages),
+                cpu_time=summarize_timings([x.cpu_time for x in usages])['median'],
+                **summarize_timings(samples)
+        )
+        results.append((name, record, reference))
+
+    print_benchmark_report(results, threshold)
+
+def time_unit_test(library, suite, test, build, num_runs, num_warmups, verbose=False):
+    """
+    Run the given unit test the given number of times (plus some warmup runs 
+    that aren't timed), and return the resource usage (e.g. wall time and peak 
+    memory) of each timed run.
+    """
+    unit_test_dir = get_unit_test_dir(build)
+    unit_test_cmd = get_unit_test_command(library, suite, test, verbose)
+    name = suite if test is None else '{}::{}'.format(suite, test)
+    samples = []
+
+    for i in range(num_warmups + num_runs):
+        is_warmup = i < num_warmups
+        print("{} {} ({}/{})".format(
+            'Warming up' if is_warmup else 'Timing',
+            name,
+            i + 1 if is_warmup else i - num_warmups + 1,
+            num_warmups if is_warmup else num_runs))
+
+        usage = helpers.measured_shell_command(
+                unit_test_dir, unit_test_cmd,
+                check=False, one_line=not verbose, verbose=verbose)
+
+        # Don't record timings for tests that fail, because a failing test 
+        # might be much faster or slower than a working one.
+
+        if usage.returncode:
+            raise UnitTestFailed(name, usage.returncode)
+        if not is_warmup:
+            samples.append(usage)
+
+    return samples
+
+def profile_unit_test(library, suite, test=None, profiler='perf', name=None, top=20, verbose=False):
+    """
+    Run the given unit test under the given profiler, then write a flamegraph 
+    and print the hottest functions, along with how they changed since the 
+    last time the test was profiled.
+    """
+    from . import profiling
+    from .build import build_rosetta, derive_build_dir
+
+    # Compile the unit test with optimization and debugging symbols.  Frame 
+    # pointers are kept so that perf can reconstruct call stacks.
+
+    build = profiling.PROFILE_BUILD
+    derive_build_dir(build, profiling.PROFILE_BASE_BUILD)
+
+    error_code = build_rosetta(
+            build, library + '.test',
+            verbose=verbose,
+            cmake_args=profiling.PROFILE_CMAKE_ARGS,
+    )
+    if error_code:
+        sys.exit(error_code)
 
-    helpers.shell_command(
-            unit_test_dir, unit_test_cmd, check=False, verbose=verbose)
+    # Run the unit test under the profiler.
+
+    name = name or get_test_name(library, suite, test)
+    profile_dir = profiling.make_profile_dir(name)
+    unit_test_dir = get_unit_test_dir(build)
+    unit_test_cmd = get_unit_test_command(library, suite, test, verbose)
+
+    error_code = profiling.record_profile(
+            profiler, unit_test_dir, unit_test_cmd, profile_dir, verbose)
+    if error_code:
+        print("Warning: '{}' failed, so the profile may be incomplete.".format(
+            ' '.join(unit_test_cmd)))
+
+    # Summarize the profile, and compare it to the previous one.
+
+    stacks = profiling.read_folded_stacks(
+            os.path.join(profile_dir, 'stacks.folded'))
+    hot_functions = profiling.find_hot_functions(stacks)
+    flamegraph = os.path.join(profile_dir, 'flamegraph.svg')
+    profiling.write_flamegraph(
+            flamegraph, stacks, title='{} ({})'.format(name, profiler))
+
+    print("Profile saved to {}".format(profile_dir))
+    print("Flamegraph: {}".format(flamegraph))
+    profiling.print_hot_functions(hot_functions, top)
+
+    previous_dir = profiling.find_previous_profile(name, profile_dir)
+    if previous_dir:
+        previous_stacks = profiling.read_folded_stacks(
+                os.path.join(previous_dir, 'stacks.folded'))
+        previous_functions = profiling.find_hot_functions(previous_stacks)
+
+        print()
+        print("Changes since {}:".format(os.path.basename(previous_dir)))
+        profiling.print_profile_diff(hot_functions, previous_functions, top)
+
+def heap_profile_unit_test(library, suite, test=None, build='debug', name=None, top=20, verbose=False):
+    """
+    Run the given unit test under a heap profiler, print the allocation sites 
+    responsible for the most memory at the peak, and save a summary of the 
+    profile to the history.
+    """
+    from . import profiling, history
+
+    compile_unit_test(library, build, verbose)
+
+    name = name or get_test_name(library, suite, test)
+    profile_dir = profiling.make_profile_dir(name)
+    unit_test_dir = get_unit_test_dir(build)
+    unit_test_cmd = get_unit_test_command(library, suite, test, verbose)
+
+    profiler, error_code, peak, sites = profiling.record_heap_profile(
+            unit_test_dir, unit_test_cmd, profile_dir, verbose)
+    if error_code:
+        print("Warning: '{}' failed, so the profile may be incomplete.".format(
+            ' '.join(unit_test_cmd)))
+
+    print("Heap profile saved to {}".format(profile_dir))
+    profiling.print_allocation_sites(peak, sites, top)
+
+    history.add_record(
+            'heap_profile',
+            name=name,
+            library=library,
+            suite=suite,
+            test=test,
+            build=build,
+            profiler=profiler,
+            peak_heap=peak,
+            sites=sites[:top],
+    )
+
+def parse_run_count(value):
+    """
+    Return the number of benchmark runs given on the command line, which has 
+    to be a positive integer.  Without any runs, there'd be nothing to 
+    summarize.
+    """
+    try:
+        num_runs = int(value)
+    except ValueError:
+        raise BadRunCount(value)
+
+    if num_runs < 1:
+        raise BadRunCount(value)
+
+    return num_runs
+
+def summarize_timings(samples):
+    import statistics
+
+    return dict(
+            min=min(samples),
+            median=statistics.median(samples),
+            mean=statistics.mean(samples),
+            stdev=statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    )
+
+def find_baseline(library, suite, test, build, label=None):
+    """
+    Return the most recent benchmark of the given test, either with the given 
+    label or (if no label is given) without any restrictions.  Return None if 
+    the test has never been benchmarked before.
+    """
+    from . import history
+
+    fields = dict(library=library, suite=suite, test=test, build=build)
+    if label is not None:
+        fields['label'] = label
+
+    records = history.find_records('benchmark', **fields)
+    return records[-1] if records else None
+
+def is_regression(record, reference, threshold):
+    """
+    Decide whether the given benchmark is significantly slower than the 
+    reference.  The median has to be more than <threshold> percent slower, and 
+    the difference also has to be bigger than the noise in the reference.
+    """
+    if reference is None:
+        return False
+
+    difference = record['median'] - reference['median']
+    tolerance = max(
+            reference['median'] * threshold / 100,
+            2 * reference['stdev'])
+    return difference > tolerance
+
+def print_benchmark_report(results, threshold):
+    from nonstdlib import print_color
+
+    header = '{:<40} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9} {:>8}'
+    row = '{:<40} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>10} {:>9} {:>8}'
+
+    print()
+    print(header.format(
+        'Test', 'min', 'median', 'mean', 'stdev', 'peak mem', 'baseline',
+        'change'))
+
+    for name, record, reference in results:
+        if reference is None:
+            baseline = change = '-'
+        else:
+            baseline = '{:.3f}s'.format(reference['median'])
+            change = '-'
+
+            # A test that's too fast for the clock has no meaningful change.
+
+            if reference['median'] > 0:
+                change = '{:+.1f}%'.format(
+                        100 * (record['median'] / reference['median'] - 1))
+
+        line = row.format(
+                name[-40:], record['min'], record['median'], record['mean'],
+                record['stdev'], helpers.format_bytes(record['max_rss']),
+                baseline, change)
+
+        if is_regression(record, reference, threshold):
+            print_color(line + '  (regression)', 'red', 'bold')
+        else:
+            print(line)
 
 
 class BadAliasError(helpers.FatalBuildError):
@@ -134,4 +611,24 @@ class BadAliasError(helpers.FatalBuildError):
         super().__init__(alias)
 
 
+class BadRunCount(helpers.FatalBuildError):
+    exit_status = 1
+    exit_message = """\
+            Can't benchmark with '--benchmark {0}'.  The number of runs has to
+            be a whole number, at least 1."""
+
+    def __init__(self, value):
+        super().__init__(value)
+
+
+class UnitTestFailed(helpers.FatalBuildError):
+    exit_status = 2
+    exit_message = """\
+            '{0}' failed with exit status {1}, so it won't be benchmarked.  Run
+            it without --benchmark to see what went wrong."""
+
+    def __init__(self, name, error_code):
+        super().__init__(name, error_code)
+
+
 
@@ -31,9 +31,13 @@ setup(
             'rdt_build=rosetta_dev_tools.build:main',
             'rdt_unit_test=rosetta_dev_tools.unit_test:main',
             'rdt_doxygen=rosetta_dev_tools.doxygen:main',
+            'rdt_bench=rosetta_dev_tools.bench:main',
+            'rdt_integration=rosetta_dev_tools.integration:main',
+            'rdt_matrix=rosetta_dev_tools.matrix:main',
         ],
     },
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
         'docopt==0.6.2',
         'nonstdlib>=1.5',
@@ -48,5 +52,6 @@ setup(
     classifiers=[
         'Intended Audience :: Developers',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 )